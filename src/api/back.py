@@ -1,54 +1,1107 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Literal, Optional, Union
+
 import faiss
 import numpy as np
 import pandas as pd
-import ruclip
-import torch
 import uvicorn
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, Extra, Field, StrictInt
+from starlette.concurrency import run_in_threadpool
+
+import config
+import metrics
+from catalog import content_hashes, get_full_desc
+from catalog_index import normalize_rows
+from diversity import mmr_rerank
+from filters import SearchFilter
+from index_backends import describe_index
+from lexical_index import reciprocal_rank_fusion
+from metrics import SlowRequestProfiler, timed
+from micro_batcher import MicroBatcher
+from pagination import CursorError, Page, StaleCursorError, decode_cursor, next_cursor
+from query_cache import CachedQuery, QueryCache
+from session_profiles import SessionStore, item_key
+from snapshot import Snapshot, SnapshotManager, set_current_version, snapshot_paths
+from startup import NotReadyError, StartupPhases
+from synthetic import StubTextEncoder
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-N_REC = 11
+SEARCH_MODES = ("dense", "hybrid", "lexical", "image")
+EVENT_WEIGHTS = {"view": config.SESSION_VIEW_WEIGHT, "cart": config.SESSION_CART_WEIGHT}
+# запросы разной длины для прогрева энкодера
+WARMUP_TEXTS = ["крем", "шампунь для окрашенных волос", "увлажняющий крем для лица с гиалуроновой кислотой и spf 30"]
+
+startup = StartupPhases()
+# снимок данных и энкодеры загружаются в фоне после запуска сервера, см. load_models
+text_encoder = None
+image_encoder = None
+faiss.omp_set_num_threads(config.WORKER_THREADS)
+snapshots = SnapshotManager()
+sessions = SessionStore(
+	config.SESSION_STORE_DIR, config.SESSION_STORE_SIZE, config.SESSION_TTL, config.SESSION_HALF_LIFE,
+	config.SESSION_MAX_SEEN, config.SESSION_MAX_EVENTS
+)
+profiler = SlowRequestProfiler(config.PROFILE_SAMPLE_RATE, config.PROFILE_THRESHOLD_MS, config.PROFILE_DIR)
+
+
+class FilterParams(BaseModel):
+	category: Optional[List[str]] = None
+	brand: Optional[List[str]] = None
+	price_min: Optional[float] = None
+	price_max: Optional[float] = None
+
+	def to_filter(self) -> Optional[SearchFilter]:
+		return SearchFilter.create(self.category, self.brand, self.price_min, self.price_max)
+
+
+class RecommendationBatchRequest(FilterParams):
+	product_indexes: List[str] = Field(..., max_items=config.MAX_BATCH_SIZE)
+	hydrate: bool = False
+	image_weight: float = Field(0.0, ge=0, le=1)
+	diversify: bool = False
+	k: int = Field(config.DEFAULT_K, ge=1, le=config.MAX_K)
+	offset: int = Field(0, ge=0)
+
+
+class SearchBatchRequest(FilterParams):
+	user_text_inputs: List[str] = Field(..., max_items=config.MAX_BATCH_SIZE)
+	hydrate: bool = False
+	mode: str = config.SEARCH_MODE
+	k: int = Field(config.DEFAULT_K, ge=1, le=config.MAX_K)
+	offset: int = Field(0, ge=0)
+
+
+class SessionEvent(BaseModel):
+	sku: str
+	type: Literal["view", "cart"] = "view"
+	# unix секунды, по умолчанию время запроса
+	timestamp: Optional[float] = None
+
+
+class PersonalizedRequest(FilterParams):
+	session_id: str = Field(..., min_length=1, max_length=256)
+	events: List[SessionEvent] = Field([], max_items=config.MAX_BATCH_SIZE)
+	hydrate: bool = False
+	k: int = Field(config.DEFAULT_K, ge=1, le=config.MAX_K)
+
+
+class Product(BaseModel):
+	sku: str
+	category_type: str
+	dimension18: str
+	brand: str
+	price: Union[StrictInt, float]
+	country: Optional[str] = None
+	category: Optional[str] = None
+
+	class Config:
+		# остальные колонки products.csv сохраняются как есть
+		extra = Extra.allow
+
+
+class UpsertRequest(BaseModel):
+	products: List[Product] = Field(..., max_items=config.MAX_BATCH_SIZE)
+
+
+class DeleteRequest(BaseModel):
+	skus: List[str] = Field(..., max_items=config.MAX_BATCH_SIZE)
+
+
+def get_filter(
+	category: Optional[List[str]] = Query(None),
+	brand: Optional[List[str]] = Query(None),
+	price_min: Optional[float] = None,
+	price_max: Optional[float] = None
+) -> Optional[SearchFilter]:
+	return SearchFilter.create(category, brand, price_min, price_max)
+
+
+def make_response(snapshot: Snapshot, indexes: list, hydrate: bool = False, batch: bool = False) -> dict:
+	"""
+	Build response with found skus and, if asked, their display fields from the product store.
+	"""
+	res = {"indexes": indexes, "snapshot": snapshot.version}
+	if hydrate:
+		store = snapshot.product_store
+		with timed("hydrate"):
+			res["products"] = [store.records(skus) for skus in indexes] if batch else store.records(indexes)
+	return res
+
+
+def get_page(snapshot: Snapshot, k: int, offset: int, cursor: Optional[str] = None, key: tuple = None) -> Page:
+	"""
+	Page asked by k and offset or by a cursor of the previous page of the query key, which overrides offset.
+	"""
+	if cursor is not None:
+		try:
+			offset = decode_cursor(cursor, snapshot.version, key)
+		except StaleCursorError as err:
+			raise HTTPException(status_code=410, detail=str(err))
+		except CursorError as err:
+			raise HTTPException(status_code=400, detail=str(err))
+	page = Page(k, offset)
+	if page.end > config.MAX_RESULTS:
+		raise HTTPException(status_code=400, detail=f"offset + k must not exceed {config.MAX_RESULTS}")
+	return page
+
+
+def make_page_response(snapshot: Snapshot, key: tuple, skus: List[str], page: Page, hydrate: bool = False) -> dict:
+	"""
+	Build response with the page cut from the candidate list, its offset and the cursor of the next page.
+	"""
+	res = make_response(snapshot, skus[page.offset:page.end], hydrate)
+	res["offset"] = page.offset
+	res["next_cursor"] = next_cursor(snapshot.version, key, page, len(skus), config.MAX_RESULTS)
+	return res
+
+
+def encode_texts(texts: List[str]) -> np.ndarray:
+	"""
+	Encode texts with ruCLIP text tower.
+
+	:param: texts: texts to encode
+	:return: float32 matrix of embeddings, one row per text
+	"""
+	if text_encoder is None:
+		raise NotReadyError("text encoder")
+	return text_encoder.encode(texts, config.ENCODE_BATCH_SIZE)
+
+
+def require_text_encoder() -> None:
+	if text_encoder is None:
+		raise NotReadyError("text encoder")
+
+
+def encode_images(images: list) -> np.ndarray:
+	"""
+	Encode decoded images with ruCLIP vision tower.
+
+	:return: float32 matrix of normalized embeddings, one row per image
+	"""
+	if image_encoder is None:
+		raise NotReadyError("image encoder")
+	return image_encoder.encode(images, config.IMAGE_ENCODE_MAX_BATCH_SIZE)
+
+
+def require_single_worker() -> None:
+	"""
+	Refuse admin writes with several workers: each worker keeps its own copy of the catalog in memory,
+	an update made in one of them would not be seen by the others.
+	"""
+	if config.WORKERS > 1:
+		raise HTTPException(
+			status_code=409,
+			detail=f"admin updates need WORKERS=1, {config.WORKERS} workers would serve different catalogs; "
+				   "publish a new snapshot instead"
+		)
+
+
+def check_image_search(snapshot: Snapshot) -> None:
+	if snapshot.image_index is None:
+		raise HTTPException(status_code=400, detail=f"snapshot {snapshot.version} has no image embeddings")
+
+
+def check_search_mode(snapshot: Snapshot, mode: str) -> None:
+	"""
+	Reject unknown modes and modes needing the lexical index when it is disabled, wait for the encoder if needed.
+	"""
+	if mode not in SEARCH_MODES:
+		raise HTTPException(status_code=400, detail=f"unknown search mode {mode}, expected one of {SEARCH_MODES}")
+	if mode in ("hybrid", "lexical") and snapshot.lexical_index is None:
+		raise HTTPException(status_code=400, detail=f"search mode {mode} needs the lexical index, LEXICAL_INDEX=0")
+	if mode == "image":
+		check_image_search(snapshot)
+	if mode != "lexical":
+		require_text_encoder()
+
+
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+	"""
+	Count requests and errors, observe latency by endpoint and profile sampled slow requests.
+	"""
+	profile = profiler.start()
+	start = time.perf_counter()
+	status = 500
+	try:
+		response = await call_next(request)
+		status = response.status_code
+		return response
+	finally:
+		duration = time.perf_counter() - start
+		# путь вне маршрутов API не пишем в метки, иначе их число не ограничено
+		endpoint = request.url.path if "endpoint" in request.scope else "unmatched"
+		metrics.REQUEST_LATENCY.labels(endpoint).observe(duration)
+		metrics.REQUESTS.labels(endpoint, str(status)).inc()
+		if status >= 500:
+			metrics.ERRORS.labels(endpoint).inc()
+		if profile is not None:
+			profiler.stop(profile, endpoint, duration)
+
+
+@app.exception_handler(NotReadyError)
+async def not_ready_handler(request: Request, err: NotReadyError):
+	return JSONResponse(
+		status_code=503, content={"detail": str(err)}, headers={"Retry-After": str(config.RETRY_AFTER)}
+	)
+
+
+def dense_slots(snapshot: Snapshot, embeddings: np.ndarray, k: int, mask: Optional[np.ndarray]) -> np.ndarray:
+	"""
+	Search the vector index, only among allowed slots if mask is given.
+
+	:return: catalog slots of k nearest products for every embedding, padded with -1
+	"""
+	if mask is None:
+		with timed("index_search"):
+			return snapshot.ru_text_index.search(embeddings, k)[1]
+	with timed("filter_search"):
+		return snapshot.attribute_filter.search(
+			snapshot.ru_text_index, embeddings, k, mask, config.FILTER_EXACT_LIMIT, config.FILTER_MAX_CANDIDATES
+		)[1]
+
+
+def lexical_slots(snapshot: Snapshot, texts: List[str], k: int, mask: Optional[np.ndarray]) -> List[np.ndarray]:
+	"""
+	Search the BM25 index, only among allowed slots if mask is given, otherwise among alive products.
+
+	:return: catalog slots of up to k best products for every text
+	"""
+	allowed = snapshot.catalog_vectors.alive if mask is None else mask
+	with timed("lexical_search"):
+		return [
+			snapshot.lexical_index.search(text, k, allowed, config.LEXICAL_MAX_POSTINGS)[0]
+			for text in texts
+		]
+
+
+def image_skus(snapshot: Snapshot, embeddings: np.ndarray, k: int, search_filter: SearchFilter = None,
+			   exclude_skus: List[str] = None) -> List[List[str]]:
+	"""
+	Find products with the closest photos.
+
+	:param: snapshot: data to search in, must have the image index
+	:param: embeddings: query embeddings in the ruCLIP space, normalized here
+	:param: k: number of results
+	:param: search_filter: search only among products matching the filter
+	:param: exclude_skus: sku to exclude from results of every query, e.g. the product itself
+	:return: list of skus for every query, products deleted from the catalog are skipped
+	"""
+	image_index, catalog_vectors = snapshot.image_index, snapshot.catalog_vectors
+	embeddings = normalize_rows(embeddings)
+	mask = snapshot.image_filter.mask(search_filter)
+	with timed("image_search"):
+		if mask is None:
+			_, slots = image_index.search(embeddings, k + 1)
+		else:
+			_, slots = snapshot.image_filter.search(
+				image_index, embeddings, k + 1, mask, config.FILTER_EXACT_LIMIT, config.FILTER_MAX_CANDIDATES
+			)
+	skus = image_index.vectors.skus
+	exclude_skus = exclude_skus or [None] * len(embeddings)
+	with timed("map_skus"):
+		return [
+			[skus[slot] for slot in row if slot >= 0 and skus[slot] != exclude and skus[slot] in catalog_vectors][:k]
+			for row, exclude in zip(slots, exclude_skus)
+		]
+
+
+def blend_slots(snapshot: Snapshot, product_indexes: List[str], search_filter: SearchFilter,
+				image_weight: float, k: int) -> List[np.ndarray]:
+	"""
+	Fuse neighbors of products by description and by photo with weighted reciprocal rank fusion.
+
+	:param: snapshot: data to search in, must have the image index
+	:param: product_indexes: skus present both in the catalog and in the image index
+	:param: search_filter: recommend only products matching the filter
+	:param: image_weight: weight of photo neighbors, description neighbors get 1 - image_weight
+	:param: k: number of results
+	:return: catalog slots of similar products for every product
+	"""
+	catalog_vectors, image_vectors = snapshot.catalog_vectors, snapshot.image_index.vectors
+	slots = np.array([catalog_vectors.slot(sku) for sku in product_indexes])
+	mask = snapshot.attribute_filter.mask(search_filter)
+	n_candidates = max(config.HYBRID_CANDIDATES, k)
+	text_rows = dense_slots(snapshot, catalog_vectors.vectors(slots), n_candidates + 1, mask)
+	image_rows = image_skus(
+		snapshot, image_vectors.vectors(np.array([image_vectors.slot(sku) for sku in product_indexes])),
+		n_candidates, search_filter, product_indexes
+	)
+	res = []
+	for slot, text_row, image_row in zip(slots, text_rows, image_rows):
+		rankings = [text_row[text_row != slot], np.array([catalog_vectors.slot(sku) for sku in image_row], dtype="int64")]
+		with timed("fusion"):
+			res.append(np.array(
+				reciprocal_rank_fusion(rankings, k, config.RRF_K, [1 - image_weight, image_weight]), dtype="int64"
+			))
+	return res
+
+
+def diversify_skus(snapshot: Snapshot, product_indexes: List[str], candidates: List[np.ndarray],
+				   k: int) -> List[List[str]]:
+	"""
+	Re-rank over-fetched candidates of every product with MMR and brand and category caps, see diversity.py.
+
+	:param: snapshot: data to search in
+	:param: product_indexes: product skus, all must be in snapshot.catalog_vectors
+	:param: candidates: catalog slots of candidates of every product, without the product itself
+	:param: k: number of results
+	:return: list of similar skus for every product
+	"""
+	catalog_vectors, attribute_filter = snapshot.catalog_vectors, snapshot.attribute_filter
+	queries = catalog_vectors.vectors(np.array([catalog_vectors.slot(sku) for sku in product_indexes]))
+	res = []
+	with timed("diversify"):
+		for query, rows in zip(queries, candidates):
+			chosen = mmr_rerank(
+				query, catalog_vectors.vectors(rows), k, config.DIVERSITY_LAMBDA,
+				[attribute_filter.brand_codes[rows], attribute_filter.category_codes[rows]],
+				[config.MAX_PER_BRAND, config.MAX_PER_CATEGORY]
+			)
+			res.append([catalog_vectors.skus[slot] for slot in rows[chosen]])
+	return res
+
+
+def fuse_skus(snapshot: Snapshot, rankings: List[np.ndarray], k: int) -> List[str]:
+	"""
+	Merge dense and lexical rankings of one query with reciprocal rank fusion.
+	"""
+	skus = snapshot.catalog_vectors.skus
+	with timed("fusion"):
+		return [skus[slot] for slot in reciprocal_rank_fusion(rankings, k, config.RRF_K)]
+
+
+def fuse_batch(snapshot: Snapshot, dense: np.ndarray, lexical: List[np.ndarray], k: int) -> List[List[str]]:
+	"""
+	Fuse dense and lexical rankings of every query of a batch, see fuse_skus.
+	"""
+	return [fuse_skus(snapshot, rankings, k) for rankings in zip(dense, lexical)]
+
+
+def search_skus(snapshot: Snapshot, embeddings: np.ndarray, k: int, search_filter: SearchFilter = None,
+				exclude_skus: List[str] = None) -> List[List[str]]:
+	"""
+	Find similar products for every embedding with one index search.
+
+	:param: snapshot: data to search in
+	:param: embeddings: float32 matrix of query embeddings
+	:param: k: number of results
+	:param: search_filter: search only among products matching the filter
+	:param: exclude_skus: sku to exclude from results of every query, e.g. the product itself
+	:return: list of similar skus for every query
+	"""
+	skus = snapshot.catalog_vectors.skus
+	mask = snapshot.attribute_filter.mask(search_filter)
+	exclude_skus = exclude_skus or [None] * len(embeddings)
+	# исключаемый товар может оказаться в выдаче, поэтому ищем на один больше
+	n_search = k + 1 if any(sku is not None for sku in exclude_skus) else k
+	same_embedding_slots = dense_slots(snapshot, embeddings, n_search, mask)
+	with timed("map_skus"):
+		return [
+			[skus[slot] for slot in row[row >= 0] if skus[slot] != exclude][:k]
+			for row, exclude in zip(same_embedding_slots, exclude_skus)
+		]
 
-products = pd.read_csv("../../data/products.csv", index_col="sku")
-text_embeddings = pd.read_csv("../../data/embeddings/text_ruCLIP_embeddings.csv", index_col="sku")
-ru_clip, ru_clip_processor = ruclip.load("ruclip-vit-base-patch32-384", cache_dir="../../ruCLIP_model")
-ru_text_index = faiss.read_index("../../data/embeddings/text_ruCLIP_faiss.index")
+
+def recommend_skus(snapshot: Snapshot, product_indexes: List[str], search_filter: SearchFilter = None,
+				   image_weight: float = 0.0, diversify: bool = False, k: int = config.DEFAULT_K) -> List[List[str]]:
+	"""
+	Get similar products from the neighbor table, falling back to one live search for products missing there
+	or if the table has not enough neighbors matching the filter.
+
+	The table is computed for the embeddings store, so it is used only for products not changed since then
+	and deleted neighbors are skipped.
+
+	With image_weight > 0 products having a photo embedding get neighbors by description and by photo blended,
+	see blend_slots. With diversify at least DIVERSITY_CANDIDATES candidates are searched live, bypassing the table,
+	and re-ranked for diversity.
+
+	:param: snapshot: data to search in
+	:param: product_indexes: product skus, all must be in snapshot.catalog_vectors
+	:param: search_filter: recommend only products matching the filter
+	:param: image_weight: weight of photo similarity, 0 - by description only
+	:param: diversify: re-rank candidates with MMR and brand and category caps
+	:param: k: number of results, the product itself is never among them
+	:return: list of similar skus for every product
+	"""
+	catalog_vectors, neighbor_table = snapshot.catalog_vectors, snapshot.neighbor_table
+	mask = snapshot.attribute_filter.mask(search_filter)
+	allowed = catalog_vectors.alive if mask is None else mask
+	n_candidates = max(config.DIVERSITY_CANDIDATES, k) if diversify else k
+	candidates = [None] * len(product_indexes)
+	if image_weight > 0 and snapshot.image_index is not None:
+		blended = [
+			num for num, sku in enumerate(product_indexes)
+			if sku in snapshot.image_index.vectors and sku in catalog_vectors
+		]
+		if blended:
+			found = blend_slots(
+				snapshot, [product_indexes[num] for num in blended], search_filter, image_weight, n_candidates
+			)
+			for num, rows in zip(blended, found):
+				candidates[num] = rows
+
+	if diversify:
+		missing = [num for num, rows in enumerate(candidates) if rows is None]
+		if missing:
+			slots = [catalog_vectors.slot(product_indexes[num]) for num in missing]
+			if None in slots:
+				raise KeyError(product_indexes[missing[slots.index(None)]])
+			found = dense_slots(snapshot, catalog_vectors.vectors(np.array(slots)), n_candidates + 1, mask)
+			for num, slot, rows in zip(missing, slots, found):
+				candidates[num] = rows[(rows >= 0) & (rows != slot)]
+		return diversify_skus(snapshot, product_indexes, candidates, k)
+
+	res = [None if rows is None else [catalog_vectors.skus[slot] for slot in rows] for rows in candidates]
+	if neighbor_table is not None:
+		with timed("neighbor_table"):
+			for num, sku in enumerate(product_indexes):
+				if res[num] is not None or sku in catalog_vectors.updated:
+					continue
+				rows = neighbor_table.rows(sku)
+				if rows is not None:
+					rows = rows[allowed[rows]]
+				if rows is not None and len(rows) >= k:
+					res[num] = [catalog_vectors.skus[row] for row in rows[:k]]
+
+	missing = [num for num, found in enumerate(res) if found is None]
+	if missing:
+		slots = [catalog_vectors.slot(product_indexes[num]) for num in missing]
+		if None in slots:
+			raise KeyError(product_indexes[missing[slots.index(None)]])
+		embeddings = catalog_vectors.vectors(np.array(slots))
+		exclude_skus = [product_indexes[num] for num in missing]
+		for num, found in zip(missing, search_skus(snapshot, embeddings, k, search_filter, exclude_skus)):
+			res[num] = found
+
+	return res
+
+
+async def cached_candidates(snapshot: Snapshot, key: tuple, compute: Callable[..., Awaitable[CachedQuery]],
+							n_results: int) -> CachedQuery:
+	"""
+	Get the candidate list of a query through the search cache of the snapshot.
+
+	The list is searched with PAGE_CANDIDATES results to spare, so the next pages are cut from the cache.
+	A page deeper than the cached list searches again for twice as many results, reusing the cached embedding.
+	The cached list is kept as the head of the longer one, so the pages already served do not change even if
+	the new search orders them differently (approximate indexes, diversification).
+
+	:param: snapshot: data to search in
+	:param: key: cache key of the query
+	:param: compute: coroutine function of the number of results and the cached embedding or None
+	:param: n_results: results needed, at most MAX_RESULTS + 1
+	:return: cached or computed candidates
+	"""
+	async def compute_first() -> CachedQuery:
+		# поиск идет в своей задаче и может пережить запрос, поэтому держит снимок сам
+		with snapshots.hold(snapshot):
+			return await compute(max(n_results, config.PAGE_CANDIDATES), None)
+
+	cache = snapshot.search_cache
+	res = await cache.get_or_compute(key, compute_first)
+	if len(res.skus) >= n_results or res.exhausted:
+		return res
+	generation = cache.generation
+	head = res.skus
+	res = await compute(min(config.MAX_RESULTS + 1, max(n_results, 2 * res.limit)), res.embedding)
+	served = set(head)
+	res = res._replace(skus=head + [sku for sku in res.skus if sku not in served])
+	if not res.partial:
+		cache.put(key, res, generation)
+	return res
 
 
 @app.post("/get_recommendation")
-async def get_recommendation(product_index: str):
-	_, same_embedding_indexes = ru_text_index.search(
-		np.ascontiguousarray(
-			text_embeddings
-			.loc[str(product_index)]
-			.to_numpy()
-			.astype("float32")
-			.reshape((1, -1))),
-		N_REC
+async def get_recommendation(product_index: str, search_filter: Optional[SearchFilter] = Depends(get_filter),
+							 hydrate: bool = False, image_weight: float = Query(0.0, ge=0, le=1),
+							 diversify: bool = False, k: int = Query(config.DEFAULT_K, ge=1, le=config.MAX_K),
+							 offset: int = Query(0, ge=0), cursor: Optional[str] = None):
+	"""
+	Get products similar to the given one. image_weight > 0 blends in products with similar photos,
+	diversify limits near-identical variants and products of one brand or category. An unknown or deleted
+	sku answers 404.
+
+	The response holds k products starting from offset and next_cursor to get the next page with, null on
+	the last page. All pages are cut from one cached candidate list, so they neither repeat nor skip products.
+	"""
+	sku = str(product_index)
+	key = ("recommendation", sku, search_filter, image_weight, diversify)
+	with snapshots.use() as snapshot:
+		if sku not in snapshot.catalog_vectors:
+			raise HTTPException(status_code=404, detail=f"product {sku} not found")
+		page = get_page(snapshot, k, offset, cursor, key)
+
+		async def compute(limit: int, embedding: Optional[np.ndarray]) -> CachedQuery:
+			found = await run_in_threadpool(recommend_skus, snapshot, [sku], search_filter, image_weight, diversify, limit)
+			return CachedQuery(None, found[0], limit=limit)
+
+		# одна лишняя позиция показывает, есть ли следующая страница
+		same_sku_indexes = (await cached_candidates(snapshot, key, compute, page.end + 1)).skus
+
+		return make_page_response(snapshot, key, same_sku_indexes, page, hydrate)
+
+
+@app.post("/get_recommendation_batch")
+async def get_recommendation_batch(request: RecommendationBatchRequest):
+	"""
+	Get recommendations for many products at once. Results are in the order of product_indexes,
+	unknown skus get an empty list. Every product gets k results starting from offset.
+
+	Searches and hydration run in the threadpool, so a large batch does not stall other requests.
+	"""
+	metrics.BATCH_SIZE.labels("recommendation_request").observe(len(request.product_indexes))
+	with snapshots.use() as snapshot:
+		page = get_page(snapshot, request.k, request.offset)
+		known = [sku for sku in request.product_indexes if sku in snapshot.catalog_vectors]
+		found = {}
+		if known:
+			found = dict(zip(known, await run_in_threadpool(
+				recommend_skus, snapshot, known, request.to_filter(), request.image_weight, request.diversify, page.end
+			)))
+
+		return await run_in_threadpool(
+			make_response, snapshot, [found.get(sku, [])[page.offset:] for sku in request.product_indexes],
+			request.hydrate, True
+		)
+
+
+def personalized_skus(snapshot: Snapshot, request: "PersonalizedRequest", now: float) -> List[str]:
+	"""
+	Add events to the session profile and search products close to its mean, except the seen ones.
+
+	:return: skus, empty if the session has no events of known products
+	"""
+	catalog_vectors = snapshot.catalog_vectors
+	events = [event for event in request.events if event.sku in catalog_vectors]
+	vectors = catalog_vectors.vectors(np.array([catalog_vectors.slot(event.sku) for event in events], dtype="int64"))
+	with sessions.profile(request.session_id, catalog_vectors.dim, create=bool(events)) as profile:
+		if profile is None:
+			return []
+		with timed("session_update"):
+			for event, vector in zip(events, vectors):
+				# часы клиента могут спешить, событие не может быть позже запроса
+				timestamp = now if event.timestamp is None else min(event.timestamp, now)
+				profile.add(event.sku, vector, EVENT_WEIGHTS[event.type], timestamp)
+		query, seen = profile.mean(), profile.seen()
+	if query is None:
+		return []
+
+	mask = snapshot.attribute_filter.mask(request.to_filter())
+	# просмотренные товары отбрасываются после поиска, поэтому ищем с запасом на них
+	rows = dense_slots(snapshot, query[None], request.k + len(seen), mask)[0]
+	with timed("map_skus"):
+		found = [catalog_vectors.skus[slot] for slot in rows if slot >= 0]
+		return [sku for sku in found if item_key(sku) not in seen][:request.k]
+
+
+@app.post("/get_personalized")
+async def get_personalized(request: PersonalizedRequest):
+	"""
+	Add recent view and cart events of a session to its profile, see session_profiles.py, and recommend products
+	closest to the time-decayed mean embedding of the session, except the products it has already seen.
+
+	Events are deduplicated by (sku, timestamp), so the recent events of the session may be sent with every
+	request; events without timestamp are always new. Events of products missing in the catalog are skipped,
+	a session without known events gets no products.
+	"""
+	now = time.time()
+	with snapshots.use() as snapshot:
+		same_sku_indexes = await run_in_threadpool(personalized_skus, snapshot, request, now)
+
+		return make_response(snapshot, same_sku_indexes, request.hydrate)
+
+
+text_batcher = MicroBatcher(encode_texts, config.ENCODE_MAX_BATCH_SIZE, config.ENCODE_MAX_WAIT_MS)
+image_batcher = MicroBatcher(
+	encode_images, config.IMAGE_ENCODE_MAX_BATCH_SIZE, config.ENCODE_MAX_WAIT_MS, "image_encoder"
+)
+
+
+async def load_snapshot() -> None:
+	async with snapshots.reload_lock:
+		with startup.phase("snapshot_load"):
+			paths = await run_in_threadpool(snapshot_paths)
+			snapshot = await run_in_threadpool(Snapshot.load, paths)
+		with startup.phase("snapshot_warmup"):
+			await run_in_threadpool(snapshot.warmup)
+		snapshots.swap(snapshot)
+
+
+def create_text_encoder():
+	if config.TEXT_ENCODER == "stub":
+		return StubTextEncoder(
+			config.STUB_ENCODER_DIM, config.STUB_ENCODER_CLUSTERS, seed=config.STUB_ENCODER_SEED,
+			delay_ms=config.STUB_ENCODER_DELAY_MS, per_text_ms=config.STUB_ENCODER_PER_TEXT_MS
+		)
+
+	# torch и ruclip импортируются несколько секунд, поэтому импорт тоже в фоновом потоке
+	from text_encoder import load_text_encoder
+
+	return load_text_encoder(config.TEXT_ENCODER)
+
+
+async def load_encoder() -> None:
+	global text_encoder
+	with startup.phase("text_encoder_load"):
+		encoder = await run_in_threadpool(create_text_encoder)
+	with startup.phase("text_encoder_warmup"):
+		await run_in_threadpool(encoder.encode, WARMUP_TEXTS, config.ENCODE_BATCH_SIZE)
+	text_encoder = encoder
+	logger.info("loaded %s text encoder", config.TEXT_ENCODER)
+
+
+def create_image_encoder():
+	from image_encoder import load_image_encoder
+
+	return load_image_encoder(text_encoder)
+
+
+async def load_image_encoder() -> None:
+	"""
+	Load the image encoder. It is optional: if it fails, image search answers 503 and the rest is served.
+	"""
+	global image_encoder
+	with startup.phase("image_encoder_load", optional=True):
+		image_encoder = await run_in_threadpool(create_image_encoder)
+		logger.info("loaded image encoder")
+
+
+async def load_models() -> None:
+	"""
+	Load the snapshot, the text encoder and the image encoder if enabled. Recommendations are served as soon as
+	the snapshot is swapped in, text and image search wait for their encoders. A failed phase stops loading
+	and makes /health/live fail, except for the image encoder: without it only image search is unavailable.
+	"""
+	try:
+		await load_snapshot()
+		if config.SNAPSHOT_POLL_INTERVAL > 0:
+			app.state.snapshot_watcher = asyncio.create_task(snapshots.watch(config.SNAPSHOT_POLL_INTERVAL))
+		await load_encoder()
+		if config.IMAGE_ENCODER == "torch":
+			await load_image_encoder()
+	except asyncio.CancelledError:
+		raise
+	except Exception:
+		return
+	startup.finish()
+
+
+@app.on_event("startup")
+async def start_text_batcher():
+	await text_batcher.start()
+	await image_batcher.start()
+
+
+@app.on_event("startup")
+async def start_loading():
+	app.state.loader = asyncio.create_task(load_models())
+
+
+def update_gauges() -> None:
+	"""
+	Set cache and index gauges from the current snapshot of this worker.
+	"""
+	snapshot = snapshots.current
+	if snapshot is None:
+		return
+	index = snapshot.ru_text_index
+	metrics.set_search_cache_stats(snapshot.search_cache.stats())
+	metrics.set_session_store_stats(sessions.stats())
+	metrics.set_index_size(index.ntotal, **index.describe())
+
+
+async def refresh_gauges(interval: float) -> None:
+	# каждый воркер обновляет свои значения сам: /metrics обслуживает только один из них
+	while True:
+		update_gauges()
+		await asyncio.sleep(interval)
+
+
+@app.on_event("startup")
+async def start_gauges_refresh():
+	app.state.gauges_refresh = asyncio.create_task(refresh_gauges(config.METRICS_REFRESH_INTERVAL))
+
+
+@app.on_event("shutdown")
+async def stop_gauges_refresh():
+	app.state.gauges_refresh.cancel()
+	metrics.mark_process_dead()
+
+
+@app.on_event("shutdown")
+async def stop_loading():
+	app.state.loader.cancel()
+
+
+@app.on_event("shutdown")
+async def close_sessions():
+	sessions.close()
+
+
+@app.on_event("shutdown")
+async def stop_text_batcher():
+	await text_batcher.stop()
+	await image_batcher.stop()
+
+
+@app.on_event("shutdown")
+async def stop_snapshot_watcher():
+	watcher = getattr(app.state, "snapshot_watcher", None)
+	if watcher is not None:
+		watcher.cancel()
+
+
+async def hybrid_query(snapshot: Snapshot, user_text_input: str, search_filter: SearchFilter = None,
+					   k: int = config.PAGE_CANDIDATES, line_embedding: np.ndarray = None) -> CachedQuery:
+	"""
+	Run BM25 search in a worker thread while the query is encoded and searched in the vector index, then fuse
+	both rankings. If BM25 is not done within HYBRID_BUDGET_MS from the start, only vector results are returned.
+	The query is not encoded again if its embedding is given.
+	"""
+	deadline = time.perf_counter() + config.HYBRID_BUDGET_MS / 1000
+	mask = snapshot.attribute_filter.mask(search_filter)
+	n_candidates = max(config.HYBRID_CANDIDATES, k)
+	lexical = asyncio.ensure_future(
+		run_in_threadpool(lexical_slots, snapshot, [user_text_input], n_candidates, mask)
 	)
-	same_sku_indexes = products.iloc[same_embedding_indexes[0][1:11]].index.to_list()
+	if line_embedding is None:
+		line_embedding = await text_batcher.submit(user_text_input)
+	rankings = [(await run_in_threadpool(dense_slots, snapshot, line_embedding.reshape((1, -1)), n_candidates, mask))[0]]
+	try:
+		# shield: по таймауту BM25 досчитается в фоне, поток все равно нельзя прервать
+		rankings += await asyncio.wait_for(asyncio.shield(lexical), max(0.0, deadline - time.perf_counter()))
+	except asyncio.TimeoutError:
+		metrics.LEXICAL_TIMEOUTS.inc()
+		return CachedQuery(line_embedding, fuse_skus(snapshot, rankings, k), partial=True, limit=k)
+	return CachedQuery(line_embedding, fuse_skus(snapshot, rankings, k), limit=k)
+
+
+def search_key(user_text_input: str, search_filter: Optional[SearchFilter], mode: str) -> tuple:
+	return QueryCache.normalize(user_text_input), search_filter, mode
+
+
+async def search_query(snapshot: Snapshot, user_text_input: str, search_filter: SearchFilter = None,
+					   mode: str = "dense", n_results: int = config.DEFAULT_K) -> CachedQuery:
+	"""
+	Search one text query through the cache of the snapshot, see cached_candidates.
 
-	return {"indexes": same_sku_indexes}
+	:return: at least n_results skus unless the query has fewer results
+	"""
+	async def compute(k: int, line_embedding: Optional[np.ndarray]) -> CachedQuery:
+		if mode == "hybrid":
+			return await hybrid_query(snapshot, user_text_input, search_filter, k, line_embedding)
+		if mode == "lexical":
+			mask = snapshot.attribute_filter.mask(search_filter)
+			slots = (await run_in_threadpool(lexical_slots, snapshot, [user_text_input], k, mask))[0]
+			return CachedQuery(None, [snapshot.catalog_vectors.skus[slot] for slot in slots], limit=k)
+		if line_embedding is None:
+			line_embedding = await text_batcher.submit(user_text_input)
+		if mode == "image":
+			found = await run_in_threadpool(image_skus, snapshot, line_embedding[None], k, search_filter)
+		else:
+			found = await run_in_threadpool(search_skus, snapshot, line_embedding.reshape((1, -1)), k, search_filter)
+		return CachedQuery(line_embedding, found[0], limit=k)
+
+	key = search_key(user_text_input, search_filter, mode)
+	return await cached_candidates(snapshot, key, compute, n_results)
 
 
 @app.post("/get_search")
-async def get_search(user_text_input: str):
-	line_tokenized = ru_clip_processor(text=[user_text_input])
-
-	with torch.no_grad():
-		line_embedding = ru_clip.encode_text(line_tokenized["input_ids"])
-
-	_, same_embedding_indexes = ru_text_index.search(
-		np.ascontiguousarray(
-			line_embedding
-			.numpy()
-		),
-		N_REC
-	)
-	same_sku_indexes = products.iloc[same_embedding_indexes[0][1:11]].index.to_list()
+async def get_search(user_text_input: str, search_filter: Optional[SearchFilter] = Depends(get_filter),
+					 hydrate: bool = False, mode: str = config.SEARCH_MODE,
+					 k: int = Query(config.DEFAULT_K, ge=1, le=config.MAX_K), offset: int = Query(0, ge=0),
+					 cursor: Optional[str] = None):
+	"""
+	Search products by text. mode is dense (vector search), lexical (BM25), hybrid (both, fused) or image
+	(products whose photos match the text).
+
+	The response holds k products starting from offset and next_cursor to get the next page with, null on
+	the last page. Pages are cut from the cached candidate list of the query.
+	"""
+	key = search_key(user_text_input, search_filter, mode)
+	with snapshots.use() as snapshot:
+		check_search_mode(snapshot, mode)
+		page = get_page(snapshot, k, offset, cursor, key)
+		# одна лишняя позиция показывает, есть ли следующая страница
+		same_sku_indexes = (await search_query(snapshot, user_text_input, search_filter, mode, page.end + 1)).skus
+
+		return make_page_response(snapshot, key, same_sku_indexes, page, hydrate)
+
+
+@app.post("/get_search_batch")
+async def get_search_batch(request: SearchBatchRequest):
+	"""
+	Search many text queries at once. Results are in the order of user_text_inputs, every query gets k results
+	starting from offset. Cached candidate lists are used if they are long enough.
+
+	Hybrid mode has no latency budget here: the batch waits for BM25 results of all queries. Searches, fusion
+	and hydration run in the threadpool, so a large batch does not stall other requests.
+	"""
+	metrics.BATCH_SIZE.labels("search_request").observe(len(request.user_text_inputs))
+	search_filter, mode = request.to_filter(), request.mode
+	keys = [search_key(text, search_filter, mode) for text in request.user_text_inputs]
+	with snapshots.use() as snapshot:
+		check_search_mode(snapshot, mode)
+		page = get_page(snapshot, request.k, request.offset)
+		found = {key: snapshot.search_cache.get(key) for key in set(keys)}
+		missing = [
+			key for key, value in found.items() if value is None or (len(value.skus) < page.end and not value.exhausted)
+		]
+
+		if missing:
+			generation = snapshot.search_cache.generation
+			texts = [text for text, _, _ in missing]
+			n_results = max(page.end, config.PAGE_CANDIDATES)
+			mask = snapshot.attribute_filter.mask(search_filter)
+			lexical = None
+			if mode in ("hybrid", "lexical"):
+				n_lexical = n_results if mode == "lexical" else max(config.HYBRID_CANDIDATES, n_results)
+				lexical = asyncio.ensure_future(run_in_threadpool(lexical_slots, snapshot, texts, n_lexical, mask))
+			embeddings = [None] * len(missing)
+			if mode == "dense":
+				embeddings = await text_batcher.encode_many(texts)
+				results = await run_in_threadpool(search_skus, snapshot, embeddings, n_results, search_filter)
+			elif mode == "lexical":
+				skus = snapshot.catalog_vectors.skus
+				results = [[skus[slot] for slot in slots] for slots in await lexical]
+			elif mode == "image":
+				embeddings = await text_batcher.encode_many(texts)
+				results = await run_in_threadpool(image_skus, snapshot, embeddings, n_results, search_filter)
+			else:
+				embeddings = await text_batcher.encode_many(texts)
+				dense = await run_in_threadpool(
+					dense_slots, snapshot, embeddings, max(config.HYBRID_CANDIDATES, n_results), mask
+				)
+				results = await run_in_threadpool(fuse_batch, snapshot, dense, await lexical, n_results)
+			for key, embedding, skus in zip(missing, embeddings, results):
+				found[key] = CachedQuery(embedding, skus, limit=n_results)
+				snapshot.search_cache.put(key, found[key], generation)
+
+		return await run_in_threadpool(
+			make_response, snapshot, [found[key].skus[page.offset:page.end] for key in keys], request.hydrate, True
+		)
+
+
+@app.post("/search_by_image")
+async def search_by_image(request: Request, search_filter: Optional[SearchFilter] = Depends(get_filter),
+						  hydrate: bool = False, k: int = Query(config.DEFAULT_K, ge=1, le=config.MAX_K),
+						  offset: int = Query(0, ge=0)):
+	"""
+	Find products with photos similar to the image file sent as the request body (jpeg, png, webp).
+
+	The image is not cached, so every page is searched anew and there is no cursor.
+	"""
+	body = await request.body()
+	if len(body) > config.IMAGE_MAX_BYTES:
+		raise HTTPException(status_code=413, detail=f"image is larger than {config.IMAGE_MAX_BYTES} bytes")
+	with snapshots.use() as snapshot:
+		check_image_search(snapshot)
+		page = get_page(snapshot, k, offset)
+		if image_encoder is None:
+			if "image_encoder_load" in startup.unavailable:
+				# повтор не поможет, поэтому без Retry-After
+				raise HTTPException(status_code=503, detail="image encoder failed to load, see /health/ready")
+			raise NotReadyError("image encoder")
+		from image_encoder import load_image
+
+		try:
+			with timed("image_decode"):
+				image = await run_in_threadpool(load_image, body)
+		except ValueError as err:
+			raise HTTPException(status_code=400, detail=str(err))
+		embedding = await image_batcher.submit(image)
+		same_sku_indexes = (await run_in_threadpool(image_skus, snapshot, embedding[None], page.end, search_filter))[0]
+
+		return await run_in_threadpool(make_response, snapshot, same_sku_indexes[page.offset:], hydrate)
+
+
+@app.get("/products")
+async def get_products(skus: List[str] = Query(..., max_items=config.MAX_BATCH_SIZE)):
+	"""
+	Get display fields of products, null for unknown skus.
+	"""
+	with snapshots.use() as snapshot:
+		return {"products": snapshot.product_store.records(skus), "snapshot": snapshot.version}
+
+
+@app.get("/products/random")
+async def get_random_product(
+	category: Optional[List[str]] = Query(None),
+	brand: Optional[List[str]] = Query(None),
+	exclude_category: Optional[List[str]] = Query(None),
+	distinct_usage: bool = False
+):
+	"""
+	Get a random product matching the conditions, see ProductStore.select.
+	"""
+	with snapshots.use() as snapshot:
+		store = snapshot.product_store
+		rows = store.select(category, brand, exclude_category, distinct_usage)
+		if not len(rows):
+			raise HTTPException(status_code=404, detail="no products match the conditions")
+
+		return {"product": store.record(int(np.random.choice(rows))), "snapshot": snapshot.version}
+
+
+@app.get("/products/facets")
+async def get_product_facets(
+	category: Optional[List[str]] = Query(None),
+	exclude_category: Optional[List[str]] = Query(None)
+):
+	"""
+	Get all categories and brands of the given categories, ordered by number of products.
+	"""
+	with snapshots.use() as snapshot:
+		return {**snapshot.product_store.facets(category, exclude_category), "snapshot": snapshot.version}
+
+
+@app.post("/reload")
+async def reload(version: Optional[str] = None):
+	"""
+	Load the snapshot, by default the one in SNAPSHOTS_DIR/CURRENT, and swap it in after warmup.
+	Requests in flight finish on the previous snapshot. Updates made through the admin API are lost.
+
+	A given version also becomes current, other worker processes load it with their snapshot watchers.
+	"""
+	try:
+		snapshot = await snapshots.reload(version)
+	except ValueError as err:
+		raise HTTPException(status_code=400, detail=str(err))
+	except FileNotFoundError as err:
+		raise HTTPException(status_code=404, detail=str(err))
+	if version is not None:
+		set_current_version(version)
+
+	return {"snapshot": snapshot.version, **describe_index(snapshot.ru_text_index.index)}
+
+
+@app.post("/reload_index")
+async def reload_index():
+	"""
+	Reread the current snapshot from disk, e.g. after build_index.py.
+	"""
+	return await reload()
+
+
+@app.post("/admin/upsert", dependencies=[Depends(require_single_worker)])
+async def admin_upsert(request: UpsertRequest):
+	"""
+	Add new products and update existing ones. Only products whose full_desc changed are encoded again,
+	other fields are updated without touching the index.
+
+	Updates are kept in memory until the next snapshot, so they are accepted only with one worker. The updated
+	catalog is a copy of the snapshot swapped in like a reloaded one, requests in flight finish on the old one.
+	"""
+	new_products = pd.DataFrame([product.dict() for product in request.products]).drop_duplicates("sku", keep="last")
+	new_products = new_products.set_index("sku")
+	new_hashes = content_hashes(get_full_desc(new_products).to_list())
+
+	# обновления и перезагрузки меняют текущий снимок по очереди, иначе одно затрет другое
+	async with snapshots.reload_lock:
+		with snapshots.use() as snapshot:
+			products, catalog_vectors, index = snapshot.products, snapshot.catalog_vectors, snapshot.ru_text_index
+			known = new_products.index.isin(products.index)
+			old_hashes = np.zeros(len(new_products), dtype="uint64")
+			old_hashes[known] = content_hashes(get_full_desc(products.loc[new_products.index[known]]).to_list())
+			in_index = np.array([sku in catalog_vectors for sku in new_products.index], dtype=bool)
+			changed = ~in_index | (old_hashes != new_hashes)
+
+			changed_skus = new_products.index[changed].to_list()
+			if changed_skus:
+				embeddings = await text_batcher.encode_many(get_full_desc(new_products.loc[changed_skus]).to_list())
+				index = await run_in_threadpool(index.upsert, changed_skus, embeddings)
+
+			products = pd.concat([products.drop(index=new_products.index[known]), new_products])
+			snapshots.swap(await run_in_threadpool(snapshot.updated, index, products))
+	logger.info("upserted %d products, %d encoded", len(new_products), len(changed_skus))
+
+	return {
+		"added": new_products.index[~known].to_list(),
+		"updated": new_products.index[known & changed].to_list(),
+		"unchanged": new_products.index[~changed].to_list(),
+		"snapshot": snapshot.version
+	}
+
+
+@app.post("/admin/delete", dependencies=[Depends(require_single_worker)])
+async def admin_delete(request: DeleteRequest):
+	"""
+	Delete products from the index and the catalog, only with one worker, see admin_upsert.
+	"""
+	async with snapshots.reload_lock:
+		with snapshots.use() as snapshot:
+			index, deleted = await run_in_threadpool(snapshot.ru_text_index.delete, list(dict.fromkeys(request.skus)))
+			products = snapshot.products.drop(index=snapshot.products.index.intersection(request.skus))
+			snapshots.swap(await run_in_threadpool(snapshot.updated, index, products))
+	logger.info("deleted %d products", len(deleted))
+
+	return {"deleted": deleted, "missing": sorted(set(request.skus) - set(deleted)), "snapshot": snapshot.version}
+
+
+@app.get("/admin/stats")
+async def admin_stats():
+	with snapshots.use() as snapshot:
+		return {
+			"snapshot": snapshot.version,
+			**describe_index(snapshot.ru_text_index.index),
+			**snapshot.ru_text_index.describe()
+		}
+
+
+@app.get("/cache_stats")
+async def cache_stats():
+	with snapshots.use() as snapshot:
+		return {"snapshot": snapshot.version, **snapshot.search_cache.stats()}
+
+
+@app.get("/encoder_stats")
+async def encoder_stats():
+	return text_batcher.stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+	"""
+	Metrics in Prometheus text format, see metrics.py.
+	"""
+	update_gauges()
+	return Response(metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+
+@app.get("/health/live")
+async def health_live():
+	"""
+	The process is alive and startup has not failed, otherwise the container should be restarted.
+	"""
+	if startup.failed:
+		return JSONResponse(status_code=503, content={"status": "failed", **startup.describe()})
+	return {"status": "ok"}
+
 
-	return {"indexes": same_sku_indexes}
+@app.get("/health/ready")
+async def health_ready():
+	"""
+	Recommendations can be served. Text search additionally needs the text encoder, see "text_encoder".
+	"""
+	snapshot = snapshots.current
+	res = {
+		"snapshot": snapshot.version if snapshot is not None else None,
+		"text_encoder": text_encoder is not None,
+		"image_encoder": image_encoder is not None,
+		**startup.describe()
+	}
+	if snapshot is None:
+		return JSONResponse(status_code=503, content=res, headers={"Retry-After": str(config.RETRY_AFTER)})
+	return res
 
 
 if __name__ == "__main__":
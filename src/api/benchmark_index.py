@@ -0,0 +1,260 @@
+"""
+Offline benchmark of FAISS index configurations.
+
+Every index type is built on the catalog embeddings or a synthetic matrix of any size and searched with every
+given search parameter. Reported per configuration: recall@k against exact search, single-query and batch
+latency percentiles, build time, index size on disk and process memory growth. Results are written as JSON,
+--baseline prints the difference from a previous run with the same data.
+
+Queries are rows of the catalog matrix, as in /get_recommendation, or unseen rows for synthetic data.
+
+Usage (from src/api):
+	python benchmark_index.py --output ../../benchmarks/catalog.json
+	python benchmark_index.py --synthetic 1000000 --types flat hnsw ivf_pq --output ../../benchmarks/1m.json
+	python benchmark_index.py --synthetic 1000000 --types hnsw --ef-search 32 64 --baseline ../../benchmarks/1m.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import faiss
+import numpy as np
+
+import config
+from embedding_store import EmbeddingStore
+from index_backends import (
+	INDEX_TYPES, MemoryMappedFlatIndex, build_index, default_nlist, default_pq_m, describe_index, set_search_params
+)
+from synthetic import EMBEDDING_DIM, synthetic_embeddings
+
+logger = logging.getLogger(__name__)
+
+
+def rss_bytes() -> int:
+	"""
+	Current resident memory of the process, peak memory where /proc is not available.
+	"""
+	try:
+		with open("/proc/self/statm") as f:
+			return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except OSError:
+		scale = 1 if sys.platform == "darwin" else 1024
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def latency_stats(seconds: List[float]) -> Dict[str, float]:
+	ms = np.asarray(seconds) * 1000
+	return {
+		"p50_ms": float(np.percentile(ms, 50)),
+		"p95_ms": float(np.percentile(ms, 95)),
+		"p99_ms": float(np.percentile(ms, 99)),
+		"mean_ms": float(ms.mean())
+	}
+
+
+def recall_at_k(found: np.ndarray, exact: np.ndarray) -> float:
+	"""
+	Share of exact top-k neighbors found, averaged over queries.
+	"""
+	k = exact.shape[1]
+	hits = sum(len(np.intersect1d(row[row >= 0], true_row, assume_unique=True)) for row, true_row in zip(found, exact))
+	return hits / (k * len(exact))
+
+
+def measure_single(index: faiss.Index, queries: np.ndarray, k: int, warmup: int = 10) -> Dict[str, float]:
+	for query in queries[:warmup]:
+		index.search(query[None], k)
+	seconds = []
+	for query in queries:
+		start = time.perf_counter()
+		index.search(query[None], k)
+		seconds.append(time.perf_counter() - start)
+	return latency_stats(seconds)
+
+
+def measure_batch(index: faiss.Index, queries: np.ndarray, k: int, batch_size: int) -> dict:
+	seconds = []
+	total_start = time.perf_counter()
+	for start in range(0, len(queries), batch_size):
+		batch_start = time.perf_counter()
+		index.search(queries[start:start + batch_size], k)
+		seconds.append(time.perf_counter() - batch_start)
+	total = time.perf_counter() - total_start
+	return {"batch_size": batch_size, **latency_stats(seconds), "qps": len(queries) / total}
+
+
+def build_param_grid(index_type: str, matrix: np.ndarray, args: argparse.Namespace) -> dict:
+	"""
+	Build parameters the index type uses, defaults resolved for the matrix, so that they identify the index.
+	"""
+	if index_type == "hnsw":
+		return {"hnsw_m": args.hnsw_m, "ef_construction": args.ef_construction}
+	if index_type == "ivf_flat":
+		return {"nlist": args.nlist or default_nlist(len(matrix))}
+	if index_type == "ivf_pq":
+		return {"nlist": args.nlist or default_nlist(len(matrix)), "pq_m": args.pq_m or default_pq_m(matrix.shape[1])}
+	return {}
+
+
+def search_param_grid(index_type: str, args: argparse.Namespace) -> List[dict]:
+	if index_type == "hnsw":
+		return [{"ef_search": ef_search} for ef_search in args.ef_search]
+	if index_type.startswith("ivf"):
+		return [{"nprobe": nprobe} for nprobe in args.nprobe]
+	return [{}]
+
+
+def benchmark(matrix: np.ndarray, queries: np.ndarray, args: argparse.Namespace) -> List[dict]:
+	"""
+	Build and search every index configuration. The flat index is searched the way the API serves it
+	with INDEX_MMAP: exact search over the matrix, the built IndexFlat only gives the size on disk.
+
+	:param: matrix: float32 vectors to index
+	:param: queries: float32 query vectors
+	:param: args: parsed command line arguments
+	:return: one result dict per index type and search parameters
+	"""
+	start = time.perf_counter()
+	_, exact = faiss.knn(queries, matrix, args.k)
+	logger.info("exact neighbors of %d queries in %.1f s", len(queries), time.perf_counter() - start)
+
+	res = []
+	for index_type in args.types:
+		build_params = build_param_grid(index_type, matrix, args)
+		rss_before = rss_bytes()
+		start = time.perf_counter()
+		index = build_index(matrix, index_type, **build_params)
+		build_seconds = time.perf_counter() - start
+		rss_delta = rss_bytes() - rss_before
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			path = os.path.join(tmp_dir, "index")
+			faiss.write_index(index, path)
+			index_bytes = os.path.getsize(path)
+		if index_type == "flat":
+			index = MemoryMappedFlatIndex(matrix)
+		logger.info("built %s in %.1f s, %.1f MB", describe_index(index), build_seconds, index_bytes / 2 ** 20)
+
+		for search_params in search_param_grid(index_type, args):
+			set_search_params(index, **search_params)
+			_, found = index.search(queries, args.k)
+			result = {
+				"type": index_type,
+				"index": describe_index(index),
+				"build_params": build_params,
+				"search_params": search_params,
+				"build_seconds": build_seconds,
+				"index_bytes": index_bytes,
+				"rss_delta_bytes": rss_delta,
+				f"recall_at_{args.k}": recall_at_k(found, exact),
+				"single": measure_single(index, queries[:args.single_queries], args.k),
+				"batch": [measure_batch(index, queries, args.k, batch_size) for batch_size in args.batch_size]
+			}
+			logger.info(
+				"%s %s: recall@%d %.4f, single p50 %.3f ms p99 %.3f ms, batch of %d %.0f qps", index_type,
+				search_params, args.k, result[f"recall_at_{args.k}"], result["single"]["p50_ms"],
+				result["single"]["p99_ms"], args.batch_size[-1], result["batch"][-1]["qps"]
+			)
+			res.append(result)
+		del index
+	return res
+
+
+def result_key(result: dict) -> str:
+	return json.dumps([result["type"], result["build_params"], result["search_params"]], sort_keys=True)
+
+
+def compare(report: dict, baseline: dict) -> None:
+	"""
+	Log recall and latency changes of configurations present in both reports.
+	"""
+	if report["data"] != baseline["data"]:
+		logger.warning("baseline was run on other data: %s", baseline["data"])
+	recall = f"recall_at_{report['k']}"
+	previous = {result_key(result): result for result in baseline["results"]}
+	for result in report["results"]:
+		old = previous.get(result_key(result))
+		if old is None or recall not in old:
+			continue
+		logger.info(
+			"%s %s %s: recall %+.4f, single p95 %+.1f%%, batch qps %+.1f%%, build %+.1f%%",
+			result["type"], result["build_params"], result["search_params"], result[recall] - old[recall],
+			100 * (result["single"]["p95_ms"] / old["single"]["p95_ms"] - 1),
+			100 * (result["batch"][-1]["qps"] / old["batch"][-1]["qps"] - 1),
+			100 * (result["build_seconds"] / old["build_seconds"] - 1)
+		)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark recall, latency, build time and memory of FAISS indexes")
+	parser.add_argument("--embeddings", default=config.EMBEDDINGS_PATH, help="binary embeddings file")
+	parser.add_argument("--synthetic", type=int, default=None, help="use a synthetic matrix of this many rows instead")
+	parser.add_argument("--dim", type=int, default=EMBEDDING_DIM, help="dimension of synthetic vectors")
+	parser.add_argument("--types", nargs="+", choices=INDEX_TYPES, default=list(INDEX_TYPES), help="index types")
+	parser.add_argument("--nlist", type=int, default=None, help="number of IVF lists, default 4 * sqrt(n)")
+	parser.add_argument("--hnsw-m", type=int, default=32, help="neighbors per node of HNSW graph")
+	parser.add_argument("--ef-construction", type=int, default=200, help="HNSW build-time search depth")
+	parser.add_argument("--pq-m", type=int, default=None, help="PQ sub-quantizers, default dim / 8")
+	parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 16, 64], help="IVF search parameters to try")
+	parser.add_argument("--ef-search", type=int, nargs="+", default=[32, 64, 128], help="HNSW search parameters to try")
+	parser.add_argument("--k", type=int, default=10, help="neighbors per query, recall is measured at k")
+	parser.add_argument("--queries", type=int, default=1000, help="number of queries")
+	parser.add_argument("--single-queries", type=int, default=1000, help="queries searched one by one")
+	parser.add_argument("--batch-size", type=int, nargs="+", default=[32, 256], help="batch sizes to measure")
+	parser.add_argument("--threads", type=int, default=config.WORKER_THREADS, help="faiss threads")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", default=None, help="where to write JSON results, default stdout")
+	parser.add_argument("--baseline", default=None, help="JSON results of a previous run to compare with")
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+	faiss.omp_set_num_threads(args.threads)
+
+	rng = np.random.default_rng(args.seed)
+	if args.synthetic:
+		# запросы из того же распределения, но не из индекса
+		vectors = synthetic_embeddings(args.synthetic + args.queries, args.dim, seed=args.seed)
+		matrix, queries = vectors[:args.synthetic], vectors[args.synthetic:]
+		data = {"source": "synthetic", "rows": args.synthetic, "dim": args.dim, "seed": args.seed}
+	else:
+		store = EmbeddingStore.open(args.embeddings)
+		matrix = np.ascontiguousarray(store.matrix, dtype="float32")
+		queries = matrix[np.sort(rng.choice(len(matrix), min(args.queries, len(matrix)), replace=False))]
+		data = {"source": os.path.abspath(args.embeddings), "rows": len(matrix), "dim": matrix.shape[1],
+				"data_crc32": store.data_crc32}
+	logger.info("benchmark on %s", data)
+
+	report = {
+		"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"data": data,
+		"queries": len(queries),
+		"k": args.k,
+		"threads": args.threads,
+		"environment": {
+			"python": platform.python_version(), "faiss": faiss.__version__, "numpy": np.__version__,
+			"machine": platform.machine(), "cpu_count": os.cpu_count()
+		},
+		"results": benchmark(matrix, queries, args)
+	}
+
+	text = json.dumps(report, indent=2)
+	if args.output:
+		os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+		with open(args.output, "w") as f:
+			f.write(text + "\n")
+		logger.info("saved results to %s", args.output)
+	else:
+		print(text)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,48 @@
+"""
+Build FAISS index from the stored embeddings.
+
+Usage (from src/api):
+	python build_index.py --type hnsw
+	python build_index.py --type ivf_pq --nlist 1024 --pq-m 64
+"""
+import argparse
+import logging
+import time
+
+import faiss
+
+import config
+from catalog import sku_ids
+from embedding_store import EmbeddingStore
+from index_backends import INDEX_TYPES, build_index, describe_index, set_search_params
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Build FAISS index from stored embeddings")
+	parser.add_argument("--type", choices=INDEX_TYPES, default=config.INDEX_TYPE, help="index type")
+	parser.add_argument("--embeddings", default=config.EMBEDDINGS_PATH, help="binary embeddings file")
+	parser.add_argument("--output", default=config.INDEX_PATH, help="where to write the index")
+	parser.add_argument("--nlist", type=int, default=None, help="number of IVF lists, default 4 * sqrt(n)")
+	parser.add_argument("--hnsw-m", type=int, default=32, help="neighbors per node of HNSW graph")
+	parser.add_argument("--ef-construction", type=int, default=200, help="HNSW build-time search depth")
+	parser.add_argument("--pq-m", type=int, default=None, help="PQ sub-quantizers, default dim / 8")
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+	store = EmbeddingStore.open(args.embeddings)
+	start = time.perf_counter()
+	index = build_index(
+		store.matrix, args.type, nlist=args.nlist, hnsw_m=args.hnsw_m,
+		ef_construction=args.ef_construction, pq_m=args.pq_m, ids=sku_ids(store.skus)
+	)
+	set_search_params(index, config.INDEX_NPROBE, config.INDEX_EF_SEARCH)
+	logger.info("built %s in %.1f s", describe_index(index), time.perf_counter() - start)
+
+	faiss.write_index(index, args.output)
+	logger.info("saved index to %s", args.output)
+
+
+if __name__ == "__main__":
+	main()
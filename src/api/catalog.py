@@ -0,0 +1,70 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+MAX_DESC_LEN = 2500
+
+
+def read_products(path: str) -> pd.DataFrame:
+	"""
+	Read products catalog.
+
+	:param: path: path to products.csv
+	:return: products dataframe indexed by sku (sku is always a string)
+	"""
+	return pd.read_csv(path, index_col="sku", dtype={"sku": str})
+
+
+def get_full_desc(data: pd.DataFrame) -> pd.Series:
+	"""
+	Build the text description used to compute ruCLIP embeddings.
+
+	Vectorized version of get_full_desc from the "CLIP embeddings" notebook, returns the same strings.
+
+	:param: data: products dataframe
+	:return: descriptions indexed by sku
+	"""
+	# предполагаем, что не указан только отечественный производитель
+	country = data["country"].fillna("россия")
+	res = (
+		data["category_type"].astype(str)
+		+ " " + data["dimension18"].astype(str)
+		+ " " + data["brand"].astype(str)
+		+ " " + country.astype(str)
+		+ " " + data["price"].astype(str)
+	)
+
+	# ограничиваем длину описания до 2500 символов, чтобы мог отработать CLIP
+	return res.str.slice(0, MAX_DESC_LEN)
+
+
+def content_hashes(texts: list) -> np.ndarray:
+	"""
+	Hash descriptions to find products whose embeddings have to be recomputed.
+
+	:param: texts: descriptions from get_full_desc
+	:return: uint64 hash for every text
+	"""
+	digests = b"".join(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest() for text in texts)
+	return np.frombuffer(digests, dtype="<u8").copy()
+
+
+def sku_ids(skus: list) -> np.ndarray:
+	"""
+	Get int64 ids stored in the faiss index for skus.
+
+	Numeric skus written without leading zeros are used as is, other skus are hashed to 62 bits with the top bit
+	set, so "0123" and "123" get different ids.
+
+	:param: skus: product skus
+	:return: int64 id for every sku
+	"""
+	res = np.empty(len(skus), dtype="int64")
+	for num, sku in enumerate(skus):
+		if sku.isascii() and sku.isdigit() and len(sku) < 18 and str(int(sku)) == sku:
+			res[num] = int(sku)
+		else:
+			res[num] = (1 << 62) | int.from_bytes(hashlib.blake2b(sku.encode("utf-8"), digest_size=8).digest(), "little") >> 2
+	return res
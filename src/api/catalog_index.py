@@ -0,0 +1,296 @@
+"""
+Catalog vectors and index keyed by sku, updated by the admin API.
+
+Search results are slots: rows of the embeddings store followed by vectors added by upserts. The faiss
+index returns sku ids (catalog.sku_ids) which are mapped to the live slot of the sku, so an update never
+shifts other products. Indexes without ids (built by the notebook) are searched positionally, their rows
+are the embeddings store rows.
+
+Flat indexes remove vectors physically. HNSW and IVF can not remove vectors cheaply, old vectors are left
+as tombstones: their ids map to no slot or to the new vector of the sku, such results are re-ranked with
+the current vectors. Rebuild the index with build_index.py after many updates.
+
+Updates are copy-on-write: upsert and delete return a new index with its own vectors and leave the one that
+requests are searching untouched, the caller swaps the new one in. An update therefore copies the faiss index.
+"""
+import copy
+import logging
+from typing import List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from catalog import sku_ids
+from embedding_store import EmbeddingStore
+from index_backends import MemoryMappedFlatIndex, get_index_type, is_shared, set_search_params, unwrap_index
+
+logger = logging.getLogger(__name__)
+
+# сколько лишних кандидатов запрашиваем у индекса из-за устаревших векторов
+MAX_STALE_CANDIDATES = 1024
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+	"""
+	Scale rows to unit length, for indexes compared by cosine similarity like the image index.
+	"""
+	norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+	return np.ascontiguousarray(matrix / np.maximum(norms, 1e-12), dtype="float32")
+
+
+class CatalogVectors:
+	"""
+	Embeddings of the current catalog: the store rows plus vectors added by upserts.
+	"""
+
+	def __init__(self, store: EmbeddingStore):
+		self.store = store
+		self.n_base = len(store)
+		self.skus = list(store.skus)
+		self.ids = sku_ids(self.skus)
+		self.alive = np.ones(self.n_base, dtype=bool)
+		self.extra = np.empty((0, store.dim), dtype="float32")
+		# sku -> слот для измененных товаров, None для удаленных
+		self.updated = {}
+		self.extra_slots = {}
+
+		self.id_order = np.argsort(self.ids, kind="stable")
+		self.sorted_ids = self.ids[self.id_order]
+		if self.n_base > 1 and (self.sorted_ids[1:] == self.sorted_ids[:-1]).any():
+			duplicate = int(self.sorted_ids[1:][self.sorted_ids[1:] == self.sorted_ids[:-1]][0])
+			raise ValueError(f"{store.path} has skus with the same index id {duplicate}, e.g. duplicate skus")
+
+		norms = np.empty(self.n_base, dtype="float32")
+		for start in range(0, self.n_base, 65536):
+			block = np.asarray(store.matrix[start:start + 65536], dtype="float32")
+			norms[start:start + 65536] = np.einsum("ij,ij->i", block, block)
+		self.norms = norms
+
+	def __len__(self) -> int:
+		return len(self.skus)
+
+	def __contains__(self, sku: str) -> bool:
+		return self.slot(sku) is not None
+
+	@property
+	def dim(self) -> int:
+		return self.store.dim
+
+	def slot(self, sku: str) -> Optional[int]:
+		"""
+		Get the live slot of the product, None if it is not in the catalog.
+		"""
+		if sku in self.updated:
+			return self.updated[sku]
+		return self.store.rows.get(sku)
+
+	def vectors(self, slots: np.ndarray) -> np.ndarray:
+		"""
+		Get float32 matrix of vectors in the given slots.
+		"""
+		slots = np.asarray(slots, dtype="int64")
+		res = np.empty((len(slots), self.dim), dtype="float32")
+		base = slots < self.n_base
+		res[base] = self.store.vectors(slots[base])
+		res[~base] = self.extra[slots[~base] - self.n_base]
+		return res
+
+	def slots_for_ids(self, ids: np.ndarray) -> np.ndarray:
+		"""
+		Map sku ids returned by the index to live slots, -1 for missing and deleted products.
+		"""
+		ids = np.asarray(ids, dtype="int64")
+		res = np.full(ids.shape, -1, dtype="int64")
+		if self.n_base:
+			pos = np.minimum(np.searchsorted(self.sorted_ids, ids), self.n_base - 1)
+			found = self.sorted_ids[pos] == ids
+			res[found] = self.id_order[pos[found]]
+
+		if self.extra_slots:
+			for num in np.flatnonzero(np.isin(ids, np.fromiter(self.extra_slots, dtype="int64"))):
+				res.flat[num] = self.extra_slots[int(ids.flat[num])]
+
+		return np.where((res >= 0) & self.alive[np.maximum(res, 0)], res, -1)
+
+	def copy(self) -> "CatalogVectors":
+		"""
+		Copy for an update: what put and remove change in place is copied, the store is shared.
+		"""
+		res = copy.copy(self)
+		res.skus = list(self.skus)
+		res.alive = self.alive.copy()
+		res.updated = dict(self.updated)
+		res.extra_slots = dict(self.extra_slots)
+		return res
+
+	def put(self, skus: List[str], vectors: np.ndarray) -> np.ndarray:
+		"""
+		Add or replace vectors of the products, returns their new slots.
+		"""
+		self.remove(skus)
+		vectors = np.ascontiguousarray(vectors, dtype="float32")
+		slots = np.arange(len(self.skus), len(self.skus) + len(skus))
+		self.skus.extend(skus)
+		ids = sku_ids(skus)
+		self.ids = np.concatenate([self.ids, ids])
+		self.alive = np.concatenate([self.alive, np.ones(len(skus), dtype=bool)])
+		self.extra = np.vstack([self.extra, vectors])
+		self.norms = np.concatenate([self.norms, np.einsum("ij,ij->i", vectors, vectors)])
+		for sku, sku_id, slot in zip(skus, ids, slots):
+			self.updated[sku] = int(slot)
+			self.extra_slots[int(sku_id)] = int(slot)
+		return slots
+
+	def remove(self, skus: List[str]) -> List[str]:
+		"""
+		Remove products from the catalog, returns skus which were there.
+		"""
+		removed = []
+		for sku in skus:
+			slot = self.slot(sku)
+			if slot is None:
+				continue
+			self.alive[slot] = False
+			self.updated[sku] = None
+			self.extra_slots.pop(int(self.ids[slot]), None)
+			removed.append(sku)
+		return removed
+
+
+class CatalogIndex:
+	"""
+	Faiss index over CatalogVectors returning slots.
+	"""
+
+	def __init__(self, index, vectors: CatalogVectors, path: str = None):
+		"""
+		:param: index: index loaded by load_index
+		:param: vectors: catalog vectors the index was built from
+		:param: path: index file, used to read a shared memory-mapped index into memory before updates
+		"""
+		self.index = index
+		self.vectors = vectors
+		self.path = path
+		self.n_stale = 0
+		self.positions = None
+		if not isinstance(index, faiss.IndexIDMap2):
+			if index.ntotal != vectors.n_base:
+				raise ValueError(f"index has {index.ntotal} vectors, embeddings have {vectors.n_base} rows")
+			# индекс без идентификаторов: позиция в индексе совпадает со строкой эмбеддингов
+			self.positions = vectors.ids[:vectors.n_base].copy()
+
+	@property
+	def ntotal(self) -> int:
+		return self.index.ntotal
+
+	@property
+	def index_type(self) -> str:
+		return get_index_type(self.index)
+
+	def search(self, query: np.ndarray, k: int):
+		"""
+		Search k nearest live products.
+
+		:param: query: float32 matrix of queries
+		:param: k: number of results
+		:return: distances and slots like faiss index.search, padded with -1
+		"""
+		n_candidates = min(self.index.ntotal, k + min(self.n_stale, MAX_STALE_CANDIDATES))
+		distances, labels = self.index.search(query, max(n_candidates, 1))
+		if self.positions is not None:
+			labels = np.where(labels >= 0, self.positions[np.maximum(labels, 0)], -1)
+		slots = self.vectors.slots_for_ids(labels)
+		if self.n_stale:
+			distances, slots = self._rerank(query, slots)
+
+		order = np.argsort(slots < 0, axis=1, kind="stable")[:, :k]
+		distances = np.take_along_axis(distances, order, axis=1)
+		slots = np.take_along_axis(slots, order, axis=1)
+		if slots.shape[1] < k:
+			pad = k - slots.shape[1]
+			distances = np.hstack([distances, np.full((len(slots), pad), np.inf, dtype="float32")])
+			slots = np.hstack([slots, np.full((len(slots), pad), -1, dtype="int64")])
+		return distances, slots
+
+	def _rerank(self, query: np.ndarray, slots: np.ndarray):
+		"""
+		Recompute distances with current vectors and drop repeated slots left by tombstones.
+		"""
+		valid = slots >= 0
+		distances = np.full(slots.shape, np.inf, dtype="float32")
+		diff = np.repeat(query, valid.sum(axis=1), axis=0) - self.vectors.vectors(slots[valid])
+		distances[valid] = np.einsum("ij,ij->i", diff, diff)
+
+		# после сортировки по слоту и затем по расстоянию повторы одного слота стоят рядом
+		order = np.argsort(slots, axis=1, kind="stable")
+		order = np.take_along_axis(order, np.argsort(np.take_along_axis(distances, order, axis=1), axis=1, kind="stable"), axis=1)
+		distances = np.take_along_axis(distances, order, axis=1)
+		slots = np.take_along_axis(slots, order, axis=1)
+		repeated = np.zeros(slots.shape, dtype=bool)
+		repeated[:, 1:] = slots[:, 1:] == slots[:, :-1]
+		slots[repeated] = -1
+		distances[repeated] = np.inf
+		return distances, slots
+
+	def copy(self) -> "CatalogIndex":
+		"""
+		Writable copy of the index and its vectors. Shared read-only indexes are read into memory,
+		a memory-mapped flat index is rebuilt from the embeddings with sku ids.
+		"""
+		res = copy.copy(self)
+		res.vectors = self.vectors.copy()
+		if isinstance(self.index, MemoryMappedFlatIndex) or (self.positions is not None and self.index_type == "flat"):
+			logger.info("copying flat index into memory for updates")
+			index = faiss.IndexIDMap2(faiss.IndexFlatL2(self.vectors.dim))
+			for start in range(0, self.vectors.n_base, 65536):
+				rows = np.arange(start, min(start + 65536, self.vectors.n_base))
+				index.add_with_ids(self.vectors.store.vectors(rows), self.positions[rows])
+			res.index = index
+			res.positions = None
+		elif is_shared(self.index):
+			logger.info("reading memory-mapped index %s into memory for updates", self.path)
+			base = unwrap_index(self.index)
+			res.index = faiss.read_index(self.path)
+			set_search_params(res.index, nprobe=base.nprobe)
+		else:
+			res.index = faiss.clone_index(self.index)
+		return res
+
+	def _remove_ids(self, ids: np.ndarray) -> None:
+		if not len(ids):
+			return
+		if self.positions is None and self.index_type == "flat":
+			self.index.remove_ids(np.ascontiguousarray(ids, dtype="int64"))
+		else:
+			self.n_stale += len(ids)
+
+	def upsert(self, skus: List[str], vectors: np.ndarray) -> "CatalogIndex":
+		"""
+		Get a copy of the index with new products added and vectors of existing ones replaced.
+		"""
+		res = self.copy()
+		res._remove_ids(sku_ids([sku for sku in skus if sku in res.vectors]))
+		res.vectors.put(skus, vectors)
+
+		vectors = np.ascontiguousarray(vectors, dtype="float32")
+		if res.positions is not None:
+			res.index.add(vectors)
+			res.positions = np.concatenate([res.positions, sku_ids(skus)])
+		else:
+			res.index.add_with_ids(vectors, sku_ids(skus))
+		return res
+
+	def delete(self, skus: List[str]) -> Tuple["CatalogIndex", List[str]]:
+		"""
+		Get a copy of the index without the products and the skus which were in the catalog.
+		"""
+		found = [sku for sku in skus if sku in self.vectors]
+		if not found:
+			return self, found
+		res = self.copy()
+		res._remove_ids(sku_ids(found))
+		res.vectors.remove(found)
+		return res, found
+
+	def describe(self) -> dict:
+		return {"stale": self.n_stale, "products": int(self.vectors.alive.sum())}
@@ -0,0 +1,122 @@
+"""
+API settings. Every value can be overridden with an environment variable of the same name.
+"""
+import os
+
+
+DATA_DIR = os.getenv("DATA_DIR", "../../data")
+PRODUCTS_PATH = os.getenv("PRODUCTS_PATH", os.path.join(DATA_DIR, "products.csv"))
+EMBEDDINGS_PATH = os.getenv("EMBEDDINGS_PATH", os.path.join(DATA_DIR, "embeddings/text_ruCLIP_embeddings.bin"))
+EMBEDDINGS_CSV_PATH = os.getenv("EMBEDDINGS_CSV_PATH", os.path.join(DATA_DIR, "embeddings/text_ruCLIP_embeddings.csv"))
+INDEX_PATH = os.getenv("INDEX_PATH", os.path.join(DATA_DIR, "embeddings/text_ruCLIP_faiss.index"))
+NEIGHBORS_PATH = os.getenv("NEIGHBORS_PATH", os.path.join(DATA_DIR, "embeddings/text_ruCLIP_neighbors.npy"))
+# эмбеддинги фотографий товаров и индекс по ним (см. embed_images.py), без них поиск по картинкам выключен
+IMAGE_EMBEDDINGS_PATH = os.getenv(
+	"IMAGE_EMBEDDINGS_PATH", os.path.join(DATA_DIR, "embeddings/image_ruCLIP_embeddings.bin")
+)
+IMAGE_INDEX_PATH = os.getenv("IMAGE_INDEX_PATH", os.path.join(DATA_DIR, "embeddings/image_ruCLIP_faiss.index"))
+IMAGES_DIR = os.getenv("IMAGES_DIR", os.path.join(DATA_DIR, "images"))
+IMAGES_CSV = os.getenv("IMAGES_CSV", os.path.join(DATA_DIR, "product_images.csv"))
+# версии данных для горячей перезагрузки (см. snapshot.py) и как часто проверять смену текущей версии, 0 - не проверять
+SNAPSHOTS_DIR = os.getenv("SNAPSHOTS_DIR", os.path.join(DATA_DIR, "snapshots"))
+SNAPSHOT_POLL_INTERVAL = float(os.getenv("SNAPSHOT_POLL_INTERVAL", "5"))
+# через сколько секунд повторить запрос, если снимок или энкодер еще загружаются (заголовок Retry-After)
+RETRY_AFTER = int(os.getenv("RETRY_AFTER", "5"))
+
+MODEL_NAME = os.getenv("MODEL_NAME", "ruclip-vit-base-patch32-384")
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "../../ruCLIP_model")
+# энкодер запросов: torch, onnx или onnx_int8 (см. export_text_encoder.py), stub - без модели для нагрузочных тестов
+TEXT_ENCODER = os.getenv("TEXT_ENCODER", "torch")
+ONNX_TEXT_ENCODER_PATH = os.getenv("ONNX_TEXT_ENCODER_PATH", os.path.join(MODEL_CACHE_DIR, "text_encoder.onnx"))
+ONNX_INT8_TEXT_ENCODER_PATH = os.getenv(
+	"ONNX_INT8_TEXT_ENCODER_PATH", os.path.join(MODEL_CACHE_DIR, "text_encoder_int8.onnx")
+)
+# энкодер картинок запросов: torch или none; по умолчанию только вместе с torch энкодером текста, с ним он делит модель
+IMAGE_ENCODER = os.getenv("IMAGE_ENCODER", "torch" if TEXT_ENCODER == "torch" else "none")
+# потоки декодирования картинок, максимальный размер загружаемой картинки и сколько картинок кодировать за проход
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", "4"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(10 * 2 ** 20)))
+IMAGE_ENCODE_MAX_BATCH_SIZE = int(os.getenv("IMAGE_ENCODE_MAX_BATCH_SIZE", "16"))
+# энкодер stub (см. synthetic.py): параметры синтетических эмбеддингов и имитация времени прохода, на проход и на текст
+STUB_ENCODER_DIM = int(os.getenv("STUB_ENCODER_DIM", "512"))
+STUB_ENCODER_CLUSTERS = int(os.getenv("STUB_ENCODER_CLUSTERS", "1000"))
+STUB_ENCODER_SEED = int(os.getenv("STUB_ENCODER_SEED", "0"))
+STUB_ENCODER_DELAY_MS = float(os.getenv("STUB_ENCODER_DELAY_MS", "0"))
+STUB_ENCODER_PER_TEXT_MS = float(os.getenv("STUB_ENCODER_PER_TEXT_MS", "0"))
+
+# тип индекса, который строят build_index.py и embed_catalog.py: flat, hnsw, ivf_flat или ivf_pq
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")
+# параметры поиска, применяются к загруженному индексу того типа, к которому они относятся
+INDEX_NPROBE = int(os.getenv("INDEX_NPROBE", "16"))
+INDEX_EF_SEARCH = int(os.getenv("INDEX_EF_SEARCH", "64"))
+
+# максимальное число товаров или запросов в одном batch запросе
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10000"))
+# максимальное число текстов в одном проходе энкодера, ограничивает расход памяти
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "256"))
+# микро-батчи одиночных поисковых запросов: сколько ждать соседние запросы и сколько брать максимум
+ENCODE_MAX_WAIT_MS = float(os.getenv("ENCODE_MAX_WAIT_MS", "5"))
+ENCODE_MAX_BATCH_SIZE = int(os.getenv("ENCODE_MAX_BATCH_SIZE", "32"))
+
+# режим текстового поиска по умолчанию: dense - векторный, lexical - BM25 по текстам товаров, hybrid - слияние обоих
+SEARCH_MODE = os.getenv("SEARCH_MODE", "dense")
+# строить BM25 индекс при загрузке снимка, без него доступен только режим dense
+LEXICAL_INDEX = os.getenv("LEXICAL_INDEX", "1") == "1"
+# сколько постингов BM25 читать на запрос, ограничивает время поиска по частым словам
+LEXICAL_MAX_POSTINGS = int(os.getenv("LEXICAL_MAX_POSTINGS", "200000"))
+# hybrid: сколько ждать BM25 с начала запроса, после этого ответ только из векторного поиска;
+# сколько кандидатов каждого поиска сливать и константа reciprocal rank fusion
+HYBRID_BUDGET_MS = float(os.getenv("HYBRID_BUDGET_MS", "50"))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# разнообразие рекомендаций (diversify=true): сколько кандидатов переранжировать, вес релевантности в MMR
+# и сколько товаров одного бренда и одной категории оставлять в выдаче, 0 - без ограничения
+DIVERSITY_CANDIDATES = int(os.getenv("DIVERSITY_CANDIDATES", "200"))
+DIVERSITY_LAMBDA = float(os.getenv("DIVERSITY_LAMBDA", "0.7"))
+MAX_PER_BRAND = int(os.getenv("MAX_PER_BRAND", "3"))
+MAX_PER_CATEGORY = int(os.getenv("MAX_PER_CATEGORY", "0"))
+
+# выдача по страницам: размер страницы по умолчанию и наибольший, наибольшая глубина выдачи (offset + k)
+DEFAULT_K = int(os.getenv("DEFAULT_K", "10"))
+MAX_K = int(os.getenv("MAX_K", "100"))
+MAX_RESULTS = int(os.getenv("MAX_RESULTS", "1000"))
+# сколько результатов искать с запасом для следующих страниц, они режутся из кэша без нового поиска
+PAGE_CANDIDATES = int(os.getenv("PAGE_CANDIDATES", "50"))
+
+# персональные рекомендации по событиям сессии: каталог файла сессий, общего для воркеров (serve.py создает
+# временный, пусто - свой временный каталог у процесса), сколько сессий хранить, через сколько секунд
+# без обращений сессия удаляется, через сколько секунд вес события падает вдвое,
+# сколько последних просмотренных товаров исключать из выдачи и сколько последних событий помнить,
+# чтобы не учитывать повторно присланные
+SESSION_STORE_DIR = os.getenv("SESSION_STORE_DIR") or None
+SESSION_STORE_SIZE = int(os.getenv("SESSION_STORE_SIZE", "20000"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_HALF_LIFE = float(os.getenv("SESSION_HALF_LIFE", "600"))
+SESSION_MAX_SEEN = int(os.getenv("SESSION_MAX_SEEN", "200"))
+SESSION_MAX_EVENTS = int(os.getenv("SESSION_MAX_EVENTS", "200"))
+# веса событий просмотра и добавления в корзину
+SESSION_VIEW_WEIGHT = float(os.getenv("SESSION_VIEW_WEIGHT", "1"))
+SESSION_CART_WEIGHT = float(os.getenv("SESSION_CART_WEIGHT", "3"))
+
+# кэш эмбеддингов и результатов поисковых запросов, в нем же списки кандидатов для следующих страниц
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "10000"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))
+
+# число процессов uvicorn и потоков torch/onnxruntime/faiss в каждом из них, по умолчанию ядра делятся поровну
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "0")) or max(1, (os.cpu_count() or 1) // WORKERS)
+# открывать индекс через mmap, чтобы процессы делили одну копию данных через page cache
+INDEX_MMAP = os.getenv("INDEX_MMAP", "1") == "1"
+
+# поиск с фильтрами: сколько разрешенных товаров искать точным перебором и сколько кандидатов
+# запрашивать у приближенного индекса, если разрешенных товаров больше
+FILTER_EXACT_LIMIT = int(os.getenv("FILTER_EXACT_LIMIT", "20000"))
+FILTER_MAX_CANDIDATES = int(os.getenv("FILTER_MAX_CANDIDATES", "2048"))
+
+# как часто каждый воркер обновляет метрики кэша и индекса, секунд
+METRICS_REFRESH_INTERVAL = float(os.getenv("METRICS_REFRESH_INTERVAL", "15"))
+# профилирование случайной доли запросов, 0 - выключено; профили запросов дольше порога сохраняются в PROFILE_DIR
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_THRESHOLD_MS = float(os.getenv("PROFILE_THRESHOLD_MS", "500"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "../../profiles")
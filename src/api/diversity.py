@@ -0,0 +1,57 @@
+"""
+Diversification of recommendations: Maximal Marginal Relevance with per-brand and per-category caps.
+
+Candidates over-fetched from the index are re-ranked greedily. Every step takes the candidate with the best
+lambda * relevance - (1 - lambda) * (highest similarity to the candidates already taken), skipping candidates
+whose brand or category has reached its cap. A step is a few vectorized operations over the candidate block:
+one matrix-vector product updates the similarities to the taken candidates, only the k steps run in Python.
+"""
+from typing import Sequence
+
+import numpy as np
+
+from catalog_index import normalize_rows
+
+
+def mmr_rerank(query: np.ndarray, candidates: np.ndarray, k: int, lambda_: float = 0.7,
+			   groups: Sequence[np.ndarray] = (), caps: Sequence[int] = ()) -> np.ndarray:
+	"""
+	Choose k diverse candidates.
+
+	If the caps leave fewer than k candidates, the rest is filled by MMR without caps.
+
+	:param: query: float32 vector the candidates were found for
+	:param: candidates: float32 matrix of candidate vectors
+	:param: k: number of results
+	:param: lambda_: weight of relevance, 1 keeps the similarity order, 0 takes only diversity into account
+	:param: groups: group code of every candidate per grouping, e.g. brand codes, -1 is never capped
+	:param: caps: most candidates of one group per grouping, 0 - no cap
+	:return: positions of chosen candidates in the order of choice
+	"""
+	n_candidates = len(candidates)
+	k = min(k, n_candidates)
+	vectors = normalize_rows(candidates)
+	relevance = vectors @ normalize_rows(query.reshape((1, -1)))[0]
+	# до первого выбора штрафа нет, первым берется самый релевантный кандидат
+	max_similarity = np.zeros(n_candidates, dtype="float32")
+	available = np.ones(n_candidates, dtype=bool)
+	capped = [(codes, np.zeros(codes.max() + 1 if len(codes) else 0, dtype="int64"), cap)
+			  for codes, cap in zip(groups, caps) if cap]
+
+	res = np.empty(k, dtype="int64")
+	for step in range(k):
+		allowed = available.copy()
+		for codes, counts, cap in capped:
+			allowed &= (codes < 0) | (counts[np.maximum(codes, 0)] < cap)
+		if not allowed.any():
+			allowed = available
+		scores = np.where(allowed, lambda_ * relevance - (1 - lambda_) * max_similarity, -np.inf)
+		best = int(np.argmax(scores))
+		res[step] = best
+		available[best] = False
+		np.maximum(max_similarity, vectors @ vectors[best], out=max_similarity)
+		for codes, counts, _ in capped:
+			if codes[best] >= 0:
+				counts[codes[best]] += 1
+	return res
+
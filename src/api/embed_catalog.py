@@ -0,0 +1,171 @@
+"""
+Batched, resumable computation of ruCLIP text embeddings for the products catalog.
+
+Replaces the per-row loop of the "CLIP embeddings" notebook. Descriptions are tokenized
+in a thread pool, encoded in batches and written to the work directory chunk by chunk,
+so a crashed run continues from the last finished chunk.
+
+Usage (from src/api):
+	python embed_catalog.py --products ../../data/products.csv --output-dir ../../data/embeddings
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+import pandas as pd
+import ruclip
+import torch
+
+from catalog import get_full_desc, read_products, sku_ids
+from embedding_store import EmbeddingStore
+from index_backends import INDEX_TYPES, build_index
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "ruclip-vit-base-patch32-384"
+EMBEDDINGS_FILE = "text_ruCLIP_embeddings.csv"
+EMBEDDINGS_BIN_FILE = "text_ruCLIP_embeddings.bin"
+INDEX_FILE = "text_ruCLIP_faiss.index"
+
+
+def parse_args() -> argparse.Namespace:
+	parser = argparse.ArgumentParser(description="Compute ruCLIP text embeddings for products catalog")
+	parser.add_argument("--products", default="../../data/products.csv", help="path to products.csv")
+	parser.add_argument("--output-dir", default="../../data/embeddings", help="where to write embeddings and index")
+	parser.add_argument("--work-dir", default=None, help="directory for finished chunks, default <output-dir>/chunks")
+	parser.add_argument("--cache-dir", default="../../ruCLIP_model", help="ruCLIP model cache dir")
+	parser.add_argument("--batch-size", type=int, default=256, help="texts per encoder pass")
+	parser.add_argument("--chunk-size", type=int, default=8192, help="texts per chunk written to disk")
+	parser.add_argument("--workers", type=int, default=4, help="tokenization threads")
+	parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+	parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat", help="see build_index.py for tuning")
+	parser.add_argument("--restart", action="store_true", help="drop finished chunks and start from scratch")
+	return parser.parse_args()
+
+
+def encode_texts(ru_clip, ru_clip_processor, texts: list, batch_size: int, pool: ThreadPoolExecutor,
+				 device: str = "cpu") -> np.ndarray:
+	"""
+	Encode texts with ruCLIP text tower.
+
+	:param: ru_clip: ruCLIP model
+	:param: ru_clip_processor: ruCLIP processor
+	:param: texts: texts to encode
+	:param: batch_size: texts per encoder pass
+	:param: pool: pool used to tokenize batches ahead of the encoder
+	:param: device: torch device of the model
+	:return: float32 matrix of embeddings, one row per text
+	"""
+	batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+	tokenized = pool.map(lambda batch: ru_clip_processor(text=batch)["input_ids"], batches)
+
+	res = []
+	with torch.no_grad():
+		for input_ids in tokenized:
+			res.append(ru_clip.encode_text(input_ids.to(device)).cpu().numpy().astype("float32"))
+
+	return np.concatenate(res) if res else np.empty((0, 0), dtype="float32")
+
+
+def skus_checksum(skus: list) -> int:
+	return zlib.crc32("\n".join(skus).encode("utf-8"))
+
+
+def chunk_path(work_dir: str, num: int) -> str:
+	return os.path.join(work_dir, f"chunk_{num:05d}.npy")
+
+
+def prepare_work_dir(work_dir: str, manifest: dict, restart: bool) -> None:
+	"""
+	Create work dir or check that finished chunks there belong to the same catalog.
+	"""
+	manifest_path = os.path.join(work_dir, "manifest.json")
+	if restart and os.path.exists(work_dir):
+		shutil.rmtree(work_dir)
+
+	if os.path.exists(manifest_path):
+		with open(manifest_path) as f:
+			saved = json.load(f)
+		if saved != manifest:
+			raise SystemExit(
+				f"Chunks in {work_dir} were computed for another catalog or settings. "
+				f"Run with --restart to drop them."
+			)
+		return
+
+	os.makedirs(work_dir, exist_ok=True)
+	with open(manifest_path, "w") as f:
+		json.dump(manifest, f)
+
+
+def save_chunk(path: str, embeddings: np.ndarray) -> None:
+	# пишем во временный файл и переименовываем, чтобы после падения не осталось недописанного чанка
+	tmp_path = path + ".tmp"
+	with open(tmp_path, "wb") as f:
+		np.save(f, embeddings)
+	os.replace(tmp_path, path)
+
+
+def is_chunk_done(path: str, n_rows: int) -> bool:
+	if not os.path.exists(path):
+		return False
+	try:
+		return np.load(path, mmap_mode="r").shape[0] == n_rows
+	except ValueError:
+		return False
+
+
+def main():
+	args = parse_args()
+	logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+	work_dir = args.work_dir or os.path.join(args.output_dir, "chunks")
+	products = read_products(args.products)
+	texts = get_full_desc(products).to_list()
+	skus = products.index.to_list()
+
+	prepare_work_dir(
+		work_dir,
+		{"n_rows": len(skus), "chunk_size": args.chunk_size, "skus_crc32": skus_checksum(skus), "model": MODEL_NAME},
+		args.restart
+	)
+
+	chunks = [(num, start) for num, start in enumerate(range(0, len(texts), args.chunk_size))]
+	todo = [
+		(num, start) for num, start in chunks
+		if not is_chunk_done(chunk_path(work_dir, num), len(texts[start:start + args.chunk_size]))
+	]
+	logger.info("%d products, %d chunks, %d left to encode", len(texts), len(chunks), len(todo))
+
+	if todo:
+		ru_clip, ru_clip_processor = ruclip.load(MODEL_NAME, device=args.device, cache_dir=args.cache_dir)
+		ru_clip.eval()
+		with ThreadPoolExecutor(max_workers=args.workers) as pool:
+			for num, start in todo:
+				embeddings = encode_texts(
+					ru_clip, ru_clip_processor, texts[start:start + args.chunk_size], args.batch_size, pool, args.device
+				)
+				save_chunk(chunk_path(work_dir, num), embeddings)
+				logger.info("chunk %d/%d done", num + 1, len(chunks))
+
+	text_embeddings = np.concatenate([np.load(chunk_path(work_dir, num)) for num, _ in chunks])
+
+	os.makedirs(args.output_dir, exist_ok=True)
+	pd.DataFrame(text_embeddings, index=pd.Index(skus, name="sku")).to_csv(
+		os.path.join(args.output_dir, EMBEDDINGS_FILE)
+	)
+	EmbeddingStore.write(os.path.join(args.output_dir, EMBEDDINGS_BIN_FILE), skus, text_embeddings)
+
+	index = build_index(text_embeddings, args.index_type, ids=sku_ids(skus))
+	faiss.write_index(index, os.path.join(args.output_dir, INDEX_FILE))
+	logger.info("saved %d embeddings and index to %s", index.ntotal, args.output_dir)
+
+
+if __name__ == "__main__":
+	main()
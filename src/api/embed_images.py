@@ -0,0 +1,159 @@
+"""
+Batched, incremental computation of ruCLIP image embeddings for product photos.
+
+Photos are decoded and preprocessed in a thread pool ahead of the vision tower, embeddings are written
+to a second embeddings store with its own index. The store is checkpointed every --save-every images
+together with a manifest of the image files it was computed from, so a rebuild or a crashed run encodes
+only photos that are new or changed since.
+
+Usage (from src/api):
+	python embed_images.py --workers 8
+"""
+import argparse
+import json
+import logging
+import os
+from typing import Dict, List, Tuple
+
+import faiss
+import numpy as np
+import torch
+
+import config
+from catalog import read_products, sku_ids
+from embedding_store import EmbeddingStore
+from image_encoder import find_product_images, load_image_encoder
+from index_backends import INDEX_TYPES, build_index
+
+logger = logging.getLogger(__name__)
+
+
+def manifest_path(embeddings_path: str) -> str:
+	return os.path.splitext(embeddings_path)[0] + ".json"
+
+
+def image_signature(path: str) -> str:
+	"""
+	Identify the image file version: a replaced photo gets another signature and is encoded again.
+	"""
+	stat = os.stat(path)
+	return f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def read_stored(embeddings_path: str) -> Dict[str, tuple]:
+	"""
+	Read embeddings computed by previous runs with the current model.
+
+	:return: sku -> (image signature, embedding)
+	"""
+	try:
+		with open(manifest_path(embeddings_path)) as f:
+			manifest = json.load(f)
+		store = EmbeddingStore.open(embeddings_path)
+	except (OSError, ValueError) as err:
+		logger.info("no stored image embeddings: %s", err)
+		return {}
+	if manifest.get("model") != config.MODEL_NAME:
+		logger.info("stored image embeddings were computed by %s, encoding all images", manifest.get("model"))
+		return {}
+	signatures = manifest["images"]
+	return {
+		sku: (signatures[sku], store.vectors(slice(row, row + 1))[0])
+		for row, sku in enumerate(store.skus) if sku in signatures
+	}
+
+
+def save(embeddings_path: str, skus: List[str], signatures: List[str], blocks: List[np.ndarray]) -> None:
+	matrix = np.concatenate(blocks) if blocks else np.empty((0, 0), dtype="float32")
+	EmbeddingStore.write(embeddings_path, skus, matrix)
+	with open(manifest_path(embeddings_path) + ".tmp", "w") as f:
+		json.dump({"model": config.MODEL_NAME, "images": dict(zip(skus, signatures))}, f)
+	os.replace(manifest_path(embeddings_path) + ".tmp", manifest_path(embeddings_path))
+
+
+def encode_chunk(encoder, items: List[tuple], batch_size: int) -> Tuple[List[tuple], List[np.ndarray]]:
+	"""
+	Encode images, decoding the next batch in the pool while the model encodes the current one.
+
+	:param: encoder: image encoder
+	:param: items: (sku, path, signature) of images to encode
+	:param: batch_size: images per encoder pass
+	:return: encoded items, broken images are skipped, and blocks of their embeddings
+	"""
+	batches = [items[start:start + batch_size] for start in range(0, len(items), batch_size)]
+	done, blocks = [], []
+	pending = [encoder.pool.submit(encoder.load, path) for _, path, _ in batches[0]] if batches else []
+	for num, batch in enumerate(batches):
+		pixel_values = [future.result() for future in pending]
+		# в памяти не больше двух батчей подготовленных картинок
+		if num + 1 < len(batches):
+			pending = [encoder.pool.submit(encoder.load, path) for _, path, _ in batches[num + 1]]
+		loaded = []
+		for item, pixels in zip(batch, pixel_values):
+			if pixels is None:
+				logger.warning("can not decode %s", item[1])
+			else:
+				loaded.append((item, pixels))
+		if loaded:
+			done += [item for item, _ in loaded]
+			blocks.append(encoder.encode_pixels([pixels for _, pixels in loaded]))
+	return done, blocks
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Compute ruCLIP embeddings of product images")
+	parser.add_argument("--products", default=config.PRODUCTS_PATH, help="path to products.csv")
+	parser.add_argument("--images-dir", default=config.IMAGES_DIR, help="directory with images_N subdirectories")
+	parser.add_argument("--images-csv", default=config.IMAGES_CSV, help="csv with sku and image columns")
+	parser.add_argument("--output", default=config.IMAGE_EMBEDDINGS_PATH, help="binary image embeddings file")
+	parser.add_argument("--index", default=config.IMAGE_INDEX_PATH, help="where to write the image index")
+	parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat", help="see build_index.py for tuning")
+	parser.add_argument("--batch-size", type=int, default=64, help="images per encoder pass")
+	parser.add_argument("--save-every", type=int, default=4096, help="images encoded between checkpoints")
+	parser.add_argument("--workers", type=int, default=os.cpu_count(), help="image decoding threads")
+	parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+	parser.add_argument("--restart", action="store_true", help="encode all images again")
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+	catalog_skus = set(read_products(args.products).index)
+	images = {
+		sku: path for sku, path in find_product_images(args.images_dir, args.images_csv).items() if sku in catalog_skus
+	}
+	stored = {} if args.restart else read_stored(args.output)
+
+	# сохраненные эмбеддинги неизмененных картинок переносим как есть, остальные кодируем
+	skus, signatures, blocks, todo = [], [], [], []
+	for sku, path in images.items():
+		signature = image_signature(path)
+		if sku in stored and stored[sku][0] == signature:
+			skus.append(sku)
+			signatures.append(signature)
+			blocks.append(stored[sku][1][None])
+		else:
+			todo.append((sku, path, signature))
+	logger.info("%d products with images, %d stored, %d to encode", len(images), len(skus), len(todo))
+
+	if todo:
+		encoder = load_image_encoder(device=args.device, workers=args.workers)
+		n_done = len(skus)
+		for start in range(0, len(todo), args.save_every):
+			done, done_blocks = encode_chunk(encoder, todo[start:start + args.save_every], args.batch_size)
+			skus += [sku for sku, _, _ in done]
+			signatures += [signature for _, _, signature in done]
+			blocks += done_blocks
+			save(args.output, skus, signatures, blocks)
+			logger.info("encoded %d/%d images", min(start + args.save_every, len(todo)), len(todo))
+		logger.info("%d images could not be decoded", len(todo) - (len(skus) - n_done))
+	else:
+		# картинки удаленных из каталога товаров не должны остаться в индексе
+		save(args.output, skus, signatures, blocks)
+
+	store = EmbeddingStore.open(args.output)
+	index = build_index(store.matrix, args.index_type, ids=sku_ids(store.skus))
+	faiss.write_index(index, args.index)
+	logger.info("saved %d image embeddings and index to %s", index.ntotal, args.index)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,234 @@
+"""
+Binary memory-mapped storage for product embeddings.
+
+File layout (little-endian):
+	header     64 bytes, see HEADER_FORMAT
+	sku table  utf-8 skus joined with "\\n", row i of the matrix belongs to sku i
+	matrix     contiguous float32 or float16 matrix n_rows x dim, aligned to 64 bytes
+
+The matrix is opened with np.memmap, so startup does not depend on the catalog size and
+all API workers share the same pages through the OS page cache.
+
+Convert the embeddings csv computed by the notebook (from src/api):
+	python embedding_store.py --csv ../../data/embeddings/text_ruCLIP_embeddings.csv
+"""
+import argparse
+import fcntl
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+import pandas as pd
+
+
+MAGIC = b"GAEMB\x00\x00\x00"
+VERSION = 1
+HEADER_FORMAT = "<8sHHIQQQQII"
+HEADER_SIZE = 64
+ALIGNMENT = 64
+DTYPES = {0: np.dtype("float32"), 1: np.dtype("float16")}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+
+class StaleEmbeddingsError(ValueError):
+	"""
+	Embeddings file was written by another format version or does not match the catalog.
+	"""
+
+
+class EmbeddingStore:
+	"""
+	Read-only embeddings matrix with sku -> row lookup.
+	"""
+
+	def __init__(self, path: str, matrix: np.ndarray, skus: list, skus_crc32: int, data_crc32: int):
+		self.path = path
+		self.matrix = matrix
+		self.skus = skus
+		self.skus_crc32 = skus_crc32
+		self.data_crc32 = data_crc32
+		self.rows = {sku: row for row, sku in enumerate(skus)}
+
+	@classmethod
+	def open(cls, path: str, verify: bool = False) -> "EmbeddingStore":
+		"""
+		Open embeddings file.
+
+		:param: path: path to the binary embeddings file
+		:param: verify: check matrix checksum, reads the whole file
+		:return: opened store
+		"""
+		with open(path, "rb") as f:
+			header = f.read(HEADER_SIZE)
+			if len(header) < HEADER_SIZE:
+				raise StaleEmbeddingsError(f"{path} is truncated")
+			(magic, version, dtype_code, dim, n_rows,
+			 skus_offset, skus_size, data_offset, skus_crc32, data_crc32) = struct.unpack_from(HEADER_FORMAT, header)
+
+			if magic != MAGIC:
+				raise StaleEmbeddingsError(f"{path} is not an embeddings file")
+			if version != VERSION:
+				raise StaleEmbeddingsError(f"{path} has format version {version}, expected {VERSION}")
+
+			f.seek(skus_offset)
+			skus_bytes = f.read(skus_size)
+
+		if zlib.crc32(skus_bytes) != skus_crc32:
+			raise StaleEmbeddingsError(f"{path} has broken sku table")
+		skus = skus_bytes.decode("utf-8").split("\n") if n_rows else []
+
+		if n_rows:
+			matrix = np.memmap(path, dtype=DTYPES[dtype_code], mode="r", offset=data_offset, shape=(n_rows, dim))
+		else:
+			matrix = np.empty((0, dim), dtype=DTYPES[dtype_code])
+		if verify and _crc32(matrix) != data_crc32:
+			raise StaleEmbeddingsError(f"{path} has broken embeddings matrix")
+
+		return cls(path, np.asarray(matrix), skus, skus_crc32, data_crc32)
+
+	@staticmethod
+	def write(path: str, skus: list, matrix: np.ndarray, dtype: str = "float32") -> None:
+		"""
+		Write embeddings file. The file is replaced atomically.
+
+		:param: path: output path
+		:param: skus: product skus, one per matrix row
+		:param: matrix: embeddings matrix
+		:param: dtype: float32 or float16
+		"""
+		matrix = np.ascontiguousarray(matrix, dtype=dtype)
+		if matrix.ndim != 2 or matrix.shape[0] != len(skus):
+			raise ValueError(f"Matrix shape {matrix.shape} does not match {len(skus)} skus")
+
+		skus_bytes = "\n".join(skus).encode("utf-8")
+		data_offset = _align(HEADER_SIZE + len(skus_bytes))
+		header = struct.pack(
+			HEADER_FORMAT,
+			MAGIC, VERSION, DTYPE_CODES[matrix.dtype], matrix.shape[1], matrix.shape[0],
+			HEADER_SIZE, len(skus_bytes), data_offset, zlib.crc32(skus_bytes), _crc32(matrix)
+		).ljust(HEADER_SIZE, b"\x00")
+
+		# свое имя временного файла у каждого писателя, иначе параллельные записи мешают друг другу
+		fd, tmp_path = tempfile.mkstemp(
+			dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp"
+		)
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(header)
+				f.write(skus_bytes)
+				f.write(b"\x00" * (data_offset - HEADER_SIZE - len(skus_bytes)))
+				for start in range(0, matrix.shape[0], 4096):
+					f.write(matrix[start:start + 4096].tobytes())
+			os.chmod(tmp_path, 0o644)
+			os.replace(tmp_path, path)
+		except BaseException:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+			raise
+
+	@property
+	def dim(self) -> int:
+		return self.matrix.shape[1]
+
+	def __len__(self) -> int:
+		return self.matrix.shape[0]
+
+	def __contains__(self, sku: str) -> bool:
+		return sku in self.rows
+
+	def row(self, sku: str) -> int:
+		return self.rows[sku]
+
+	def vector(self, sku: str) -> np.ndarray:
+		"""
+		Get product embedding.
+
+		:param: sku: product sku
+		:return: float32 array of shape (1, dim), a view of the mapped file for float32 stores
+		"""
+		row = self.rows[sku]
+		return self.vectors(slice(row, row + 1))
+
+	def vectors(self, rows) -> np.ndarray:
+		"""
+		Get embeddings by rows as float32 matrix suitable for faiss.
+
+		:param: rows: slice or array of row numbers
+		:return: float32 matrix
+		"""
+		return np.ascontiguousarray(self.matrix[rows], dtype="float32")
+
+	def check_skus(self, skus: list) -> None:
+		"""
+		Raise StaleEmbeddingsError if embeddings were computed for another catalog.
+		"""
+		if zlib.crc32("\n".join(skus).encode("utf-8")) != self.skus_crc32:
+			raise StaleEmbeddingsError(f"{self.path} does not match products catalog, recompute embeddings")
+
+
+def convert_csv(csv_path: str, path: str, dtype: str = "float32") -> None:
+	"""
+	Convert embeddings csv (sku index, one column per dimension) to the binary format.
+
+	:param: csv_path: path to csv with embeddings
+	:param: path: output path
+	:param: dtype: float32 or float16
+	"""
+	embeddings = pd.read_csv(csv_path, index_col="sku", dtype={"sku": str})
+	EmbeddingStore.write(path, embeddings.index.to_list(), embeddings.to_numpy(dtype="float32"), dtype)
+
+
+def is_stale(path: str, csv_path: str) -> bool:
+	return os.path.exists(csv_path) and (not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(csv_path))
+
+
+def convert_if_stale(path: str, csv_path: str) -> None:
+	"""
+	(Re)create binary embeddings from csv if the file is missing or older than csv.
+
+	Processes converting at the same time take a file lock: the first one converts, the others find
+	the file fresh once they get the lock.
+	"""
+	if not is_stale(path, csv_path):
+		return
+	with open(path + ".lock", "a") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		try:
+			if is_stale(path, csv_path):
+				convert_csv(csv_path, path)
+		finally:
+			fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def open_or_convert(path: str, csv_path: str) -> EmbeddingStore:
+	"""
+	Open binary embeddings, (re)creating them from csv if the file is missing or older than csv.
+	"""
+	convert_if_stale(path, csv_path)
+	return EmbeddingStore.open(path)
+
+
+def _align(offset: int) -> int:
+	return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _crc32(matrix: np.ndarray) -> int:
+	crc = 0
+	for start in range(0, matrix.shape[0], 4096):
+		crc = zlib.crc32(np.ascontiguousarray(matrix[start:start + 4096]).tobytes(), crc)
+	return crc
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Convert embeddings csv to binary memory-mapped format")
+	parser.add_argument("--csv", default="../../data/embeddings/text_ruCLIP_embeddings.csv")
+	parser.add_argument("--output", default="../../data/embeddings/text_ruCLIP_embeddings.bin")
+	parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+	parser.add_argument("--verify", action="store_true", help="reopen the result and check its checksums")
+	args = parser.parse_args()
+
+	convert_csv(args.csv, args.output, args.dtype)
+	if args.verify:
+		EmbeddingStore.open(args.output, verify=True)
@@ -0,0 +1,114 @@
+"""
+Export ruCLIP text tower to ONNX, optionally quantize it to int8 and check parity with the eager model.
+
+Usage (from src/api):
+	python export_text_encoder.py --int8
+	python export_text_encoder.py --check-only --sample 1000
+
+The parity check encodes a sample of catalog descriptions with the eager model and with the exported
+ones and reports cosine similarity between embeddings and overlap of top-10 search results in the index.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+
+import config
+from catalog import get_full_desc, read_products
+from index_backends import load_index
+from text_encoder import OnnxTextEncoder, TorchTextEncoder
+
+
+class TextTower(torch.nn.Module):
+	"""
+	Wrapper exporting only CLIP.encode_text.
+	"""
+
+	def __init__(self, model):
+		super().__init__()
+		self.model = model
+
+	def forward(self, input_ids):
+		return self.model.encode_text(input_ids)
+
+
+def export(encoder: TorchTextEncoder, path: str) -> None:
+	input_ids = encoder.processor(text=["пример описания товара", "еще один"])["input_ids"]
+	with torch.no_grad():
+		torch.onnx.export(
+			TextTower(encoder.model).eval(),
+			(input_ids,),
+			path,
+			input_names=["input_ids"],
+			output_names=["text_latents"],
+			dynamic_axes={"input_ids": {0: "batch"}, "text_latents": {0: "batch"}},
+			opset_version=14,
+		)
+
+
+def quantize(path: str, int8_path: str) -> None:
+	from onnxruntime.quantization import QuantType, quantize_dynamic
+
+	quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+
+
+def check_parity(eager: np.ndarray, optimized: np.ndarray, index, k: int = 10) -> dict:
+	"""
+	Compare embeddings of the same texts.
+
+	:param: eager: embeddings from eager model
+	:param: optimized: embeddings from optimized model
+	:param: index: catalog index used to compare search results
+	:param: k: number of search results to compare
+	:return: cosine similarity and top-k overlap stats
+	"""
+	cosine = np.einsum("ij,ij->i", eager, optimized) / (
+		np.linalg.norm(eager, axis=1) * np.linalg.norm(optimized, axis=1)
+	)
+	_, eager_top = index.search(eager, k)
+	_, optimized_top = index.search(optimized, k)
+	overlap = np.array([len(set(a) & set(b)) / k for a, b in zip(eager_top, optimized_top)])
+
+	return {
+		"cosine_mean": float(cosine.mean()),
+		"cosine_min": float(cosine.min()),
+		f"top{k}_overlap_mean": float(overlap.mean()),
+		f"top{k}_overlap_min": float(overlap.min()),
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Export ruCLIP text encoder to ONNX and check parity")
+	parser.add_argument("--output", default=config.ONNX_TEXT_ENCODER_PATH)
+	parser.add_argument("--int8", action="store_true", help="also write dynamically quantized int8 model")
+	parser.add_argument("--int8-output", default=config.ONNX_INT8_TEXT_ENCODER_PATH)
+	parser.add_argument("--check-only", action="store_true", help="skip export, only check existing models")
+	parser.add_argument("--sample", type=int, default=500, help="catalog texts used for parity check")
+	args = parser.parse_args()
+
+	encoder = TorchTextEncoder(config.MODEL_NAME, config.MODEL_CACHE_DIR)
+	if not args.check_only:
+		export(encoder, args.output)
+		if args.int8:
+			quantize(args.output, args.int8_output)
+
+	products = read_products(config.PRODUCTS_PATH)
+	texts = get_full_desc(products.sample(min(args.sample, len(products)), random_state=0)).to_list()
+	index = load_index(config.INDEX_PATH, config.INDEX_NPROBE, config.INDEX_EF_SEARCH)
+	eager = encoder.encode(texts)
+
+	model_dir = os.path.join(config.MODEL_CACHE_DIR, config.MODEL_NAME)
+	report = {"onnx": check_parity(eager, OnnxTextEncoder(args.output, model_dir).encode(texts), index)}
+	if args.int8 or args.check_only:
+		try:
+			report["onnx_int8"] = check_parity(eager, OnnxTextEncoder(args.int8_output, model_dir).encode(texts), index)
+		except RuntimeError as err:
+			report["onnx_int8"] = str(err)
+
+	print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,166 @@
+"""
+Metadata filters for vector search: category, brand and price range.
+
+Rows of every category and brand and the price order are precomputed from products.csv once, so building
+the set of allowed rows for a query is a few vectorized numpy operations. Filtered search is exact over
+the allowed rows when there are few of them, otherwise the index is asked for more candidates which are
+then filtered, so a filtered query still returns a full page. Rows are slots of CatalogVectors, the filter
+is rebuilt after catalog updates.
+"""
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+from catalog_index import CatalogIndex, CatalogVectors
+
+
+class SearchFilter(NamedTuple):
+	category: Optional[tuple] = None
+	brand: Optional[tuple] = None
+	price_min: Optional[float] = None
+	price_max: Optional[float] = None
+
+	@classmethod
+	def create(cls, category: List[str] = None, brand: List[str] = None, price_min: float = None,
+			   price_max: float = None) -> Optional["SearchFilter"]:
+		"""
+		Create filter from request parameters, None if nothing is filtered. The result is hashable and
+		can be a part of a cache key.
+		"""
+		res = cls(
+			tuple(sorted(set(category))) if category else None,
+			tuple(sorted(set(brand))) if brand else None,
+			price_min,
+			price_max
+		)
+		return res if any(value is not None for value in res) else None
+
+
+class AttributeFilter:
+	"""
+	Precomputed product rows by attribute values.
+	"""
+
+	def __init__(self, products: pd.DataFrame, vectors: CatalogVectors):
+		"""
+		:param: products: products dataframe indexed by sku
+		:param: vectors: catalog vectors, used for exact search over allowed rows
+		"""
+		aligned = products.reindex(vectors.skus)
+		self.n_rows = len(vectors)
+		self.vectors = vectors
+		self.alive = vectors.alive.copy()
+		self.category_codes, self.categories = self._rows_by_value(aligned["category"])
+		self.brand_codes, self.brands = self._rows_by_value(aligned["brand"])
+
+		prices = aligned["price"].to_numpy(dtype="float64")
+		self.price_order = np.argsort(prices, kind="stable")
+		self.sorted_prices = prices[self.price_order]
+
+	@staticmethod
+	def _rows_by_value(column: pd.Series):
+		"""
+		Get the value code of every row, -1 for missing values, and rows of every value.
+		"""
+		codes, values = pd.factorize(column)
+		order = np.argsort(codes, kind="stable")
+		bounds = np.searchsorted(codes[order], np.arange(len(values) + 1))
+		return codes, {value: order[bounds[i]:bounds[i + 1]] for i, value in enumerate(values)}
+
+	def _values_mask(self, rows_by_value: dict, values: tuple) -> np.ndarray:
+		mask = np.zeros(self.n_rows, dtype=bool)
+		for value in values:
+			rows = rows_by_value.get(value)
+			if rows is not None:
+				mask[rows] = True
+		return mask
+
+	def mask(self, search_filter: Optional[SearchFilter]) -> Optional[np.ndarray]:
+		"""
+		Get boolean mask of allowed rows, None if nothing is filtered.
+		"""
+		if search_filter is None:
+			return None
+
+		mask = self.alive.copy()
+		if search_filter.category is not None:
+			mask &= self._values_mask(self.categories, search_filter.category)
+		if search_filter.brand is not None:
+			mask &= self._values_mask(self.brands, search_filter.brand)
+		if search_filter.price_min is not None or search_filter.price_max is not None:
+			low = np.searchsorted(self.sorted_prices, search_filter.price_min, "left") \
+				if search_filter.price_min is not None else 0
+			high = np.searchsorted(self.sorted_prices, search_filter.price_max, "right") \
+				if search_filter.price_max is not None else self.n_rows
+			price_mask = np.zeros(self.n_rows, dtype=bool)
+			price_mask[self.price_order[low:high]] = True
+			mask &= price_mask
+		return mask
+
+	def exact_search(self, query: np.ndarray, rows: np.ndarray, k: int, block_size: int = 8192):
+		"""
+		Exact L2 search over the given rows only.
+
+		:param: query: float32 matrix of queries
+		:param: rows: allowed rows
+		:param: k: number of results
+		:param: block_size: rows gathered from the matrix at once
+		:return: distances and rows like faiss index.search, padded with -1
+		"""
+		n_queries = query.shape[0]
+		best_distances = np.full((n_queries, 0), np.inf, dtype="float32")
+		best_rows = np.empty((n_queries, 0), dtype="int64")
+		query_norms = np.einsum("ij,ij->i", query, query)[:, None]
+
+		for start in range(0, len(rows), block_size):
+			block_rows = rows[start:start + block_size]
+			block = self.vectors.vectors(block_rows)
+			distances = query_norms + self.vectors.norms[block_rows][None, :] - 2 * (query @ block.T)
+			best_distances = np.hstack([best_distances, distances])
+			best_rows = np.hstack([best_rows, np.broadcast_to(block_rows, distances.shape)])
+			if best_distances.shape[1] > k:
+				top = np.argpartition(best_distances, k - 1, axis=1)[:, :k]
+				best_distances = np.take_along_axis(best_distances, top, axis=1)
+				best_rows = np.take_along_axis(best_rows, top, axis=1)
+
+		order = np.argsort(best_distances, axis=1, kind="stable")
+		best_distances = np.take_along_axis(best_distances, order, axis=1)
+		best_rows = np.take_along_axis(best_rows, order, axis=1)
+		if best_rows.shape[1] < k:
+			pad = k - best_rows.shape[1]
+			best_distances = np.hstack([best_distances, np.full((n_queries, pad), np.inf, dtype="float32")])
+			best_rows = np.hstack([best_rows, np.full((n_queries, pad), -1, dtype="int64")])
+
+		return best_distances, best_rows
+
+	def search(self, index: CatalogIndex, query: np.ndarray, k: int, mask: np.ndarray, exact_limit: int = 20000,
+			   max_candidates: int = 2048):
+		"""
+		Search only among allowed rows.
+
+		Flat index and small allowed sets are searched exactly over allowed rows, which costs no more than
+		an unfiltered flat search. Approximate indexes over-fetch candidates in proportion to the share of
+		allowed rows and fall back to exact search if that did not fill the page.
+
+		:param: index: catalog index
+		:param: query: float32 matrix of queries
+		:param: k: number of results
+		:param: mask: allowed rows
+		:param: exact_limit: allowed rows searched exactly with approximate indexes
+		:param: max_candidates: max number of candidates requested from approximate index
+		:return: distances and rows like faiss index.search, padded with -1
+		"""
+		rows = np.flatnonzero(mask)
+		if len(rows) <= exact_limit or index.index_type == "flat":
+			return self.exact_search(query, rows, k)
+
+		n_candidates = min(max_candidates, index.ntotal, int(k * self.n_rows / len(rows) * 1.5) + 1)
+		distances, candidates = index.search(query, n_candidates)
+		allowed = (candidates >= 0) & mask[np.maximum(candidates, 0)]
+		if allowed.sum(axis=1).min() < min(k, len(rows)):
+			return self.exact_search(query, rows, k)
+
+		# переносим разрешенные кандидаты в начало, сохраняя порядок по расстоянию
+		order = np.argsort(~allowed, axis=1, kind="stable")[:, :k]
+		return np.take_along_axis(distances, order, axis=1), np.take_along_axis(candidates, order, axis=1)
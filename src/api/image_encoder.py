@@ -0,0 +1,137 @@
+"""
+ruCLIP vision tower: product photos and query images to embeddings in the space of the text tower.
+
+Image and text embeddings of ruCLIP are compared by cosine similarity, so image embeddings are L2-normalized
+here and text queries are normalized before searching the image index: L2 distance between unit vectors
+orders results like cosine similarity.
+
+Photos are decoded and preprocessed in a thread pool (PIL and torchvision release the GIL), the model
+encodes them in batches.
+"""
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import ruclip
+import torch
+from PIL import Image
+
+import config
+from catalog_index import normalize_rows
+from metrics import timed
+
+
+# сторона картинки на входе ruclip-vit-base-patch32-384, jpeg сразу декодируется в уменьшенном размере
+INPUT_SIZE = 384
+
+
+def find_product_images(images_dir: str, images_csv: str) -> Dict[str, str]:
+	"""
+	Map every sku to the path of its first image found in images_dir/images_N.
+
+	:param: images_dir: directory with images_N subdirectories
+	:param: images_csv: csv with sku and image columns
+	:return: sku -> image path, skus without image files are skipped
+	"""
+	image_data = pd.read_csv(images_csv, dtype={"sku": str})
+	dir_by_name = {}
+	for name in sorted(os.listdir(images_dir)):
+		path = os.path.join(images_dir, name)
+		if os.path.isdir(path):
+			for image_name in os.listdir(path):
+				dir_by_name.setdefault(image_name, path)
+
+	res = {}
+	for sku, image_name in zip(image_data["sku"], image_data["image"]):
+		if sku not in res and image_name in dir_by_name:
+			res[sku] = os.path.join(dir_by_name[image_name], image_name)
+	return res
+
+
+def load_image(source) -> Image.Image:
+	"""
+	Decode an image file or bytes to RGB.
+
+	:param: source: path or image file contents
+	:return: decoded image
+	:raises ValueError: the data is not an image PIL can decode
+	"""
+	try:
+		with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+			img.draft("RGB", (INPUT_SIZE, INPUT_SIZE))
+			return img.convert("RGB")
+	except (OSError, Image.DecompressionBombError) as err:
+		raise ValueError(f"can not decode image: {err}") from err
+
+
+class TorchImageEncoder:
+	"""
+	Eager PyTorch ruCLIP vision tower with a preprocessing thread pool.
+	"""
+
+	def __init__(self, model, processor, device: str = "cpu", workers: int = 4):
+		"""
+		:param: model: ruCLIP model, may be shared with the text encoder
+		:param: processor: ruCLIP processor
+		:param: device: torch device of the model
+		:param: workers: threads decoding and preprocessing images
+		"""
+		self.model = model
+		self.processor = processor
+		self.device = device
+		self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image_preprocess")
+
+	def preprocess(self, image: Image.Image) -> torch.Tensor:
+		return self.processor.image_transform(image)
+
+	def load(self, path: str):
+		"""
+		Decode and preprocess an image file, None if it is broken.
+		"""
+		try:
+			return self.preprocess(load_image(path))
+		except ValueError:
+			return None
+
+	def encode_pixels(self, pixel_values: List[torch.Tensor]) -> np.ndarray:
+		"""
+		Encode preprocessed images in one pass.
+
+		:return: float32 matrix of normalized embeddings
+		"""
+		with torch.no_grad(), timed("image_encode"):
+			res = self.model.encode_image(torch.stack(pixel_values).to(self.device)).cpu().numpy()
+		return normalize_rows(res)
+
+	def encode(self, images: List[Image.Image], batch_size: int = 64) -> np.ndarray:
+		"""
+		Encode decoded images.
+
+		:param: images: RGB images
+		:param: batch_size: images per encoder pass, limits memory
+		:return: float32 matrix of normalized embeddings, one row per image
+		"""
+		with timed("image_preprocess"):
+			pixel_values = list(self.pool.map(self.preprocess, images))
+		return np.concatenate([
+			self.encode_pixels(pixel_values[start:start + batch_size])
+			for start in range(0, len(pixel_values), batch_size)
+		])
+
+
+def load_image_encoder(text_encoder=None, device: str = "cpu",
+					   workers: int = config.IMAGE_PREPROCESS_WORKERS) -> TorchImageEncoder:
+	"""
+	Load the vision tower, reusing the model of the torch text encoder if it is given.
+	"""
+	model = getattr(text_encoder, "model", None)
+	processor = getattr(text_encoder, "processor", None)
+	if not isinstance(model, torch.nn.Module):
+		if config.WORKER_THREADS:
+			torch.set_num_threads(config.WORKER_THREADS)
+		model, processor = ruclip.load(config.MODEL_NAME, device=device, cache_dir=config.MODEL_CACHE_DIR)
+	model.eval()
+	return TorchImageEncoder(model, processor, device, workers)
@@ -0,0 +1,218 @@
+"""
+FAISS index backends: exact flat search, HNSW graph, IVF-Flat and IVF-PQ.
+
+All indexes use L2 metric like the IndexFlatL2 built by the notebook, so they can be swapped
+without changes in the API. Indexes built with ids are wrapped in IndexIDMap2 and return sku ids
+(catalog.sku_ids) instead of embeddings rows.
+"""
+import math
+
+import faiss
+import numpy as np
+
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+
+class MemoryMappedFlatIndex:
+	"""
+	Exact L2 search over the memory-mapped embeddings matrix.
+
+	Gives the same results as IndexFlatL2 built from the same matrix, but does not copy vectors into
+	process memory, so all workers share the matrix pages through the page cache.
+	"""
+
+	def __init__(self, matrix: np.ndarray):
+		self.matrix = matrix
+		self.ntotal, self.d = matrix.shape
+
+	def search(self, x: np.ndarray, k: int):
+		return faiss.knn(np.ascontiguousarray(x, dtype="float32"), self.matrix, k)
+
+
+def default_nlist(n_rows: int) -> int:
+	"""
+	Number of IVF lists: about 4 * sqrt(n), but at least 39 training points per list.
+	"""
+	return max(1, min(int(4 * math.sqrt(n_rows)), n_rows // 39))
+
+
+def default_pq_m(dim: int) -> int:
+	"""
+	Number of PQ sub-quantizers: 8 dimensions per 1 byte code, must divide dim.
+	"""
+	m = max(1, dim // 8)
+	while dim % m:
+		m -= 1
+	return m
+
+
+def index_factory_string(index_type: str, n_rows: int, dim: int, nlist: int = None,
+						 hnsw_m: int = 32, pq_m: int = None) -> str:
+	"""
+	Get faiss.index_factory description of the index.
+
+	:param: index_type: one of INDEX_TYPES
+	:param: n_rows: number of vectors the index is built for
+	:param: dim: vectors dimension
+	:param: nlist: number of IVF lists, for ivf_* types
+	:param: hnsw_m: number of neighbors in HNSW graph, for hnsw type
+	:param: pq_m: number of PQ sub-quantizers, for ivf_pq type
+	:return: index description
+	"""
+	if index_type == "flat":
+		return "Flat"
+	if index_type == "hnsw":
+		return f"HNSW{hnsw_m}"
+	if index_type == "ivf_flat":
+		return f"IVF{nlist or default_nlist(n_rows)},Flat"
+	if index_type == "ivf_pq":
+		return f"IVF{nlist or default_nlist(n_rows)},PQ{pq_m or default_pq_m(dim)}"
+
+	raise ValueError(f"Wrong index type: {index_type}. Should be one of: {', '.join(INDEX_TYPES)}")
+
+
+def build_index(embeddings: np.ndarray, index_type: str = "flat", nlist: int = None, hnsw_m: int = 32,
+				ef_construction: int = 200, pq_m: int = None, max_train_size: int = 200_000,
+				batch_size: int = 65536, ids: np.ndarray = None) -> faiss.Index:
+	"""
+	Train index and add embeddings to it.
+
+	:param: embeddings: matrix of embeddings, may be memory-mapped
+	:param: index_type: one of INDEX_TYPES
+	:param: nlist: number of IVF lists
+	:param: hnsw_m: number of neighbors in HNSW graph
+	:param: ef_construction: HNSW build-time search depth
+	:param: pq_m: number of PQ sub-quantizers
+	:param: max_train_size: max number of vectors used for training
+	:param: batch_size: vectors added per call, limits memory for memory-mapped input
+	:param: ids: int64 id of every row, by default the index returns row numbers
+	:return: index with all embeddings added
+	"""
+	n_rows, dim = embeddings.shape
+	index = faiss.index_factory(dim, index_factory_string(index_type, n_rows, dim, nlist, hnsw_m, pq_m), faiss.METRIC_L2)
+
+	if index_type == "hnsw":
+		index.hnsw.efConstruction = ef_construction
+
+	if not index.is_trained:
+		rows = np.arange(n_rows)
+		if n_rows > max_train_size:
+			rows = np.sort(np.random.default_rng(0).choice(n_rows, max_train_size, replace=False))
+		index.train(np.ascontiguousarray(embeddings[rows], dtype="float32"))
+
+	if ids is not None:
+		index = faiss.IndexIDMap2(index)
+
+	for start in range(0, n_rows, batch_size):
+		batch = np.ascontiguousarray(embeddings[start:start + batch_size], dtype="float32")
+		if ids is None:
+			index.add(batch)
+		else:
+			index.add_with_ids(batch, np.ascontiguousarray(ids[start:start + batch_size], dtype="int64"))
+
+	return index
+
+
+def unwrap_index(index: faiss.Index) -> faiss.Index:
+	"""
+	Get the index that does the search, skipping id maps and transforms.
+	"""
+	if not isinstance(index, faiss.Index):
+		return index
+	index = faiss.downcast_index(index)
+	while isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2, faiss.IndexPreTransform)):
+		index = faiss.downcast_index(index.index)
+	return index
+
+
+def get_index_type(index: faiss.Index) -> str:
+	"""
+	Get one of INDEX_TYPES for the index, or faiss class name for other indexes.
+	"""
+	index = unwrap_index(index)
+	if isinstance(index, faiss.IndexHNSW):
+		return "hnsw"
+	if isinstance(index, faiss.IndexIVFPQ):
+		return "ivf_pq"
+	if isinstance(index, faiss.IndexIVFFlat):
+		return "ivf_flat"
+	if isinstance(index, (faiss.IndexFlat, MemoryMappedFlatIndex)):
+		return "flat"
+	return type(index).__name__
+
+
+def set_search_params(index: faiss.Index, nprobe: int = None, ef_search: int = None) -> None:
+	"""
+	Set query time parameters. Parameters not related to the index type are ignored.
+
+	:param: index: index
+	:param: nprobe: number of IVF lists visited per query
+	:param: ef_search: HNSW search depth, should be not less than k
+	"""
+	base = unwrap_index(index)
+	if nprobe is not None and isinstance(base, faiss.IndexIVF):
+		base.nprobe = min(nprobe, base.nlist)
+	if ef_search is not None and isinstance(base, faiss.IndexHNSW):
+		base.hnsw.efSearch = ef_search
+
+
+def describe_index(index: faiss.Index) -> dict:
+	"""
+	Get index type, size and current search parameters.
+	"""
+	base = unwrap_index(index)
+	res = {"type": get_index_type(index), "ntotal": index.ntotal, "dim": index.d, "shared": is_shared(index)}
+	if isinstance(base, faiss.IndexIVF):
+		res.update({"nlist": base.nlist, "nprobe": base.nprobe})
+	if isinstance(base, faiss.IndexHNSW):
+		res.update({"efSearch": base.hnsw.efSearch, "efConstruction": base.hnsw.efConstruction})
+	if isinstance(base, faiss.IndexIVFPQ):
+		res.update({"pq_m": base.pq.M})
+	return res
+
+
+def load_index(path: str, nprobe: int = None, ef_search: int = None, mmap: bool = False,
+			   embeddings: np.ndarray = None) -> faiss.Index:
+	"""
+	Read index of any supported type and set its search parameters.
+
+	With mmap=True the index data is shared between processes where possible: inverted lists of IVF indexes
+	are memory-mapped by faiss, a flat index is replaced by search over the memory-mapped embeddings matrix.
+	HNSW graphs can not be mapped and are read into process memory. A flat index wrapped in IndexIDMap2 is
+	replaced by positional search too, ids of such index are assumed to follow the embeddings rows order
+	as written by build_index.
+
+	:param: path: path to the index
+	:param: nprobe: number of IVF lists visited per query
+	:param: ef_search: HNSW search depth
+	:param: mmap: share index data between processes
+	:param: embeddings: float32 memory-mapped matrix the flat index was built from
+	:return: index
+	"""
+	with open(path, "rb") as f:
+		fourcc = f.read(4)
+		if fourcc == b"IxM2":
+			# заголовок IndexIDMap2 занимает 37 байт, за ним идет вложенный индекс
+			f.seek(37)
+			fourcc = f.read(4)
+
+	if mmap and fourcc == b"IxF2" and embeddings is not None and embeddings.dtype == np.float32:
+		return MemoryMappedFlatIndex(embeddings)
+
+	io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap and fourcc.startswith(b"Iw") else 0
+	index = faiss.read_index(path, io_flags)
+	set_search_params(index, nprobe, ef_search)
+	return index
+
+
+def is_shared(index) -> bool:
+	"""
+	Check if index data is memory-mapped and shared between processes.
+	"""
+	base = unwrap_index(index)
+	if isinstance(base, MemoryMappedFlatIndex):
+		return True
+	return isinstance(base, faiss.IndexIVF) and isinstance(
+		faiss.downcast_InvertedLists(base.invlists), faiss.OnDiskInvertedLists
+	)
@@ -0,0 +1,184 @@
+"""
+BM25 inverted index over text fields of the catalog and rank fusion with vector search results.
+
+ruCLIP embeddings blur exact tokens, so a query with a brand or a product line name can miss the products
+that contain it. The lexical index finds them by tokens: text is lowercased, "ё" is replaced with "е" and
+Russian words lose their inflectional endings, so "крема для волос" matches "крем для волос".
+
+Postings are stored as arrays: for every term a slice of doc ids (catalog slots, int32) and precomputed
+BM25 impacts (float32), sorted by impact. A query sums impacts of its terms, so no per-document statistics
+are read at query time. Terms with long posting lists are read only up to a shared budget of postings,
+starting from the highest impacts, which bounds the query latency for frequent words.
+"""
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# поля products.csv и их веса: точные названия бренда и линейки важнее описания
+FIELD_WEIGHTS = {
+	"dimension17": 3.0,
+	"dimension18": 3.0,
+	"brand": 2.0,
+	"name": 2.0,
+	"category_type": 2.0,
+	"description": 1.0,
+}
+TOKEN_PATTERN = r"[0-9a-zа-я]+"
+TOKEN_RE = re.compile(TOKEN_PATTERN)
+CYRILLIC_RE = re.compile(r"[а-я]")
+# окончания русских слов, от длинных к коротким
+ENDINGS = tuple(sorted((
+	"иями", "ями", "ами", "иях", "ях", "ах", "ого", "его", "ому", "ему", "ыми", "ими", "ой", "ей", "ий", "ый",
+	"ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю", "ом", "ем", "ым", "им", "ых", "их", "ов", "ев", "ам", "ям",
+	"а", "я", "ы", "и", "е", "о", "у", "ю", "ь", "й"
+), key=len, reverse=True))
+MIN_STEM_LEN = 3
+
+
+@lru_cache(maxsize=1 << 18)
+def stem(token: str) -> str:
+	"""
+	Strip an inflectional ending of a Russian word, other tokens are kept as is.
+	"""
+	if len(token) <= MIN_STEM_LEN + 1 or not CYRILLIC_RE.search(token):
+		return token
+	for ending in ENDINGS:
+		if token.endswith(ending) and len(token) - len(ending) >= MIN_STEM_LEN:
+			return token[:-len(ending)]
+	return token
+
+
+def normalize(text: str) -> str:
+	return text.lower().replace("ё", "е")
+
+
+def tokenize(text: str) -> List[str]:
+	"""
+	Split text into stemmed terms.
+	"""
+	return [stem(token) for token in TOKEN_RE.findall(normalize(text))]
+
+
+def reciprocal_rank_fusion(rankings: List[np.ndarray], k: int, rrf_k: int = 60,
+						   weights: List[float] = None) -> List[int]:
+	"""
+	Merge ranked lists: every item gets sum of weight / (rrf_k + rank) over the lists it is in.
+
+	:param: rankings: lists of items, best first, -1 is skipped
+	:param: k: number of results
+	:param: rrf_k: constant damping the weight of top ranks
+	:param: weights: weight of every list, 1 by default
+	:return: top k items, ties keep the order of the first list
+	"""
+	scores = {}
+	for ranking, weight in zip(rankings, weights or [1.0] * len(rankings)):
+		for rank, item in enumerate(ranking):
+			if item >= 0:
+				scores[int(item)] = scores.get(int(item), 0.0) + weight / (rrf_k + rank + 1)
+	return sorted(scores, key=scores.get, reverse=True)[:k]
+
+
+class LexicalIndex:
+	def __init__(self, vocabulary: Dict[str, int], offsets: np.ndarray, doc_ids: np.ndarray, impacts: np.ndarray):
+		"""
+		:param: vocabulary: term -> term id
+		:param: offsets: start of postings of every term and the end of the last one
+		:param: doc_ids: int32 catalog slots of all postings, grouped by term
+		:param: impacts: float32 BM25 score of the term in the document, sorted descending within a term
+		"""
+		self.vocabulary = vocabulary
+		self.offsets = offsets
+		self.doc_ids = doc_ids
+		self.impacts = impacts
+
+	@classmethod
+	def from_frame(cls, products: pd.DataFrame, k1: float = 1.2, b: float = 0.75) -> "LexicalIndex":
+		"""
+		Build the index, document i is row i of products, i.e. catalog slot i if products are aligned with it.
+		"""
+		n_docs = len(products)
+		docs, tokens, weights = [], [], []
+		for field, weight in FIELD_WEIGHTS.items():
+			if field not in products:
+				continue
+			found = products[field].fillna("").astype(str).map(normalize).str.findall(TOKEN_PATTERN)
+			found.index = np.arange(n_docs)
+			exploded = found.explode().dropna()
+			docs.append(exploded.index.to_numpy(dtype="int64"))
+			tokens.append(exploded.to_numpy())
+			weights.append(np.full(len(exploded), weight, dtype="float32"))
+		docs, weights = np.concatenate(docs), np.concatenate(weights)
+		tokens = pd.Series(np.concatenate(tokens))
+
+		# стемминг по уникальным токенам, их на порядки меньше, чем вхождений
+		token_codes, unique_tokens = pd.factorize(tokens)
+		term_codes, terms = pd.factorize(pd.Series([stem(token) for token in unique_tokens]))
+		term_codes = term_codes[token_codes]
+
+		# взвешенная частота термина в документе с учетом весов полей
+		keys, inverse = np.unique(term_codes.astype("int64") * n_docs + docs, return_inverse=True)
+		tf = np.bincount(inverse, weights=weights).astype("float32")
+		term_ids, doc_ids = keys // n_docs, (keys % n_docs).astype("int32")
+		offsets = np.searchsorted(term_ids, np.arange(len(terms) + 1)).astype("int64")
+
+		doc_len = np.bincount(docs, weights=weights, minlength=n_docs).astype("float32")
+		avg_len = max(float(doc_len.mean()), 1e-6) if n_docs else 1.0
+		df = np.diff(offsets)
+		idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype("float32")
+		norm = k1 * (1 - b + b * doc_len[doc_ids] / avg_len)
+		impacts = (idf[term_ids] * tf * (k1 + 1) / (tf + norm)).astype("float32")
+
+		# внутри термина сначала самые высокие вклады, чтобы бюджет отрезал наименее важные
+		order = np.lexsort((-impacts, term_ids))
+		return cls({term: num for num, term in enumerate(terms)}, offsets, doc_ids[order], impacts[order])
+
+	def __len__(self) -> int:
+		return len(self.vocabulary)
+
+	def search(self, text: str, k: int, mask: Optional[np.ndarray] = None,
+			   max_postings: int = 200_000) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Find documents with the highest BM25 score.
+
+		:param: text: query
+		:param: k: number of results
+		:param: mask: allowed catalog slots
+		:param: max_postings: postings read per query, shared by terms, rare terms are read first
+		:return: doc ids and scores, best first, may be shorter than k
+		"""
+		term_ids = {self.vocabulary[term] for term in tokenize(text) if term in self.vocabulary}
+		if not term_ids:
+			return np.empty(0, dtype="int32"), np.empty(0, dtype="float32")
+
+		starts = self.offsets[sorted(term_ids)]
+		lengths = self.offsets[np.array(sorted(term_ids)) + 1] - starts
+		docs, impacts = [], []
+		budget = max_postings
+		for num, term in enumerate(np.argsort(lengths, kind="stable")):
+			take = min(int(lengths[term]), budget // (len(lengths) - num))
+			start = starts[term]
+			docs.append(self.doc_ids[start:start + take])
+			impacts.append(self.impacts[start:start + take])
+			budget -= take
+		docs, impacts = np.concatenate(docs), np.concatenate(impacts)
+		if mask is not None:
+			allowed = mask[docs]
+			docs, impacts = docs[allowed], impacts[allowed]
+		if not len(docs):
+			return docs, impacts
+
+		unique_docs, inverse = np.unique(docs, return_inverse=True)
+		scores = np.bincount(inverse, weights=impacts).astype("float32")
+		if len(scores) > k:
+			top = np.argpartition(-scores, k - 1)[:k]
+		else:
+			top = np.arange(len(scores))
+		top = top[np.lexsort((unique_docs[top], -scores[top]))]
+		return unique_docs[top], scores[top]
+
+	def describe(self) -> dict:
+		return {"terms": len(self), "postings": len(self.doc_ids)}
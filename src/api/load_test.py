@@ -0,0 +1,345 @@
+"""
+HTTP load test of the API on a synthetic catalog with the stub text encoder, runs fully offline.
+
+Products, embeddings and an index of the given size are generated in a data directory, then serve.py is started
+on them with TEXT_ENCODER=stub and /get_search and /get_recommendation are driven in two modes:
+
+open loop     requests arrive as a Poisson process of the given rate, whether responses came back or not.
+              Latency is counted from the planned arrival, so an overloaded API shows growing latency
+              instead of a silently lower request rate.
+concurrency   N clients send requests back to back, shows the throughput ceiling.
+
+Every run reports throughput, errors and latency percentiles, the results are written as JSON. The client needs
+spare cores: a large max_lag_ms means the client could not keep the schedule and the results are not valid.
+
+Usage (from src/api):
+	python load_test.py --rows 100000 --workers 2 --rates 100 200 400 --concurrency 1 8 32 --output ../../benchmarks/load.json
+	python load_test.py --url http://localhost:8080 --endpoints recommendation --rates 50
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import faiss
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from catalog import sku_ids
+from embedding_store import EmbeddingStore
+from index_backends import INDEX_TYPES, build_index
+from neighbor_table import NeighborTable, compute_neighbors
+from synthetic import CATEGORY_TYPES, EMBEDDING_DIM, default_clusters, synthetic_catalog, synthetic_embeddings
+
+logger = logging.getLogger(__name__)
+
+API_DIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = {"search": "/get_search", "recommendation": "/get_recommendation"}
+
+
+def data_paths(data_dir: str) -> dict:
+	"""
+	Settings of the API that point it to the data directory.
+	"""
+	return {
+		"DATA_DIR": data_dir,
+		"PRODUCTS_PATH": os.path.join(data_dir, "products.csv"),
+		"EMBEDDINGS_PATH": os.path.join(data_dir, "embeddings", "text_ruCLIP_embeddings.bin"),
+		"EMBEDDINGS_CSV_PATH": os.path.join(data_dir, "embeddings", "text_ruCLIP_embeddings.csv"),
+		"INDEX_PATH": os.path.join(data_dir, "embeddings", "text_ruCLIP_faiss.index"),
+		"NEIGHBORS_PATH": os.path.join(data_dir, "embeddings", "text_ruCLIP_neighbors.npy"),
+		"SNAPSHOTS_DIR": os.path.join(data_dir, "snapshots")
+	}
+
+
+def prepare_data(data_dir: str, rows: int, dim: int, index_type: str, neighbors_k: int, seed: int) -> List[str]:
+	"""
+	Generate catalog, embeddings, index and optionally the neighbor table, files that exist are kept.
+
+	:return: skus of the catalog
+	"""
+	paths = data_paths(data_dir)
+	os.makedirs(os.path.dirname(paths["EMBEDDINGS_PATH"]), exist_ok=True)
+	products = synthetic_catalog(rows, seed=seed)
+	skus = products.index.to_list()
+	if not os.path.exists(paths["PRODUCTS_PATH"]):
+		products.to_csv(paths["PRODUCTS_PATH"])
+
+	if not os.path.exists(paths["EMBEDDINGS_PATH"]):
+		start = time.perf_counter()
+		EmbeddingStore.write(paths["EMBEDDINGS_PATH"], skus, synthetic_embeddings(rows, dim, seed=seed))
+		logger.info("generated %d x %d embeddings in %.1f s", rows, dim, time.perf_counter() - start)
+	store = EmbeddingStore.open(paths["EMBEDDINGS_PATH"])
+	if store.skus != skus or store.dim != dim:
+		raise SystemExit(f"{data_dir} holds other data, remove it or change --data-dir")
+
+	if not os.path.exists(paths["INDEX_PATH"]):
+		start = time.perf_counter()
+		faiss.write_index(build_index(store.matrix, index_type, ids=sku_ids(skus)), paths["INDEX_PATH"])
+		logger.info("built %s index in %.1f s", index_type, time.perf_counter() - start)
+
+	if neighbors_k and not os.path.exists(paths["NEIGHBORS_PATH"]):
+		NeighborTable.write(paths["NEIGHBORS_PATH"], compute_neighbors(store.matrix, neighbors_k), store)
+	return skus
+
+
+def free_port() -> int:
+	with socket.socket() as sock:
+		sock.bind(("127.0.0.1", 0))
+		return sock.getsockname()[1]
+
+
+def log_tail(path: str, n_lines: int = 20) -> str:
+	with open(path, errors="replace") as f:
+		return "".join(f.readlines()[-n_lines:])
+
+
+def start_api(env: dict, workers: int, port: int, log_path: str, timeout: float) -> subprocess.Popen:
+	"""
+	Run serve.py and wait until both the snapshot and the text encoder are ready.
+	"""
+	with open(log_path, "w") as log:
+		process = subprocess.Popen(
+			[sys.executable, "serve.py", "--workers", str(workers), "--port", str(port), "--host", "127.0.0.1"],
+			cwd=API_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+		)
+	url = f"http://127.0.0.1:{port}"
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		if process.poll() is not None:
+			raise RuntimeError(f"API exited with code {process.returncode}:\n{log_tail(log_path)}")
+		try:
+			response = requests.get(url + "/health/ready", timeout=1)
+			if response.status_code == 200 and response.json()["text_encoder"]:
+				logger.info("API is ready: %s", response.json())
+				return process
+		except requests.RequestException:
+			pass
+		time.sleep(0.5)
+
+	process.terminate()
+	raise RuntimeError(f"API is not ready after {timeout} s:\n{log_tail(log_path)}")
+
+
+class Workload:
+	"""
+	Random requests to the API endpoints, one keep-alive session per client thread.
+	"""
+
+	def __init__(self, url: str, skus: List[str], n_queries: int, hydrate: bool, pool_size: int, seed: int):
+		self.url = url
+		self.skus = skus
+		rng = np.random.default_rng(seed)
+		types = np.array(CATEGORY_TYPES)[rng.integers(0, len(CATEGORY_TYPES), n_queries)]
+		self.texts = [f"{category_type} {num}" for num, category_type in enumerate(types)]
+		self.hydrate = hydrate
+		self.pool_size = pool_size
+		self.local = threading.local()
+
+	def session(self) -> requests.Session:
+		session = getattr(self.local, "session", None)
+		if session is None:
+			session = self.local.session = requests.Session()
+			session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+			self.local.rng = np.random.default_rng(threading.get_ident())
+		return session
+
+	def send(self, endpoint: str) -> int:
+		"""
+		Send one request, return the status code or 0 for a connection error.
+		"""
+		session = self.session()
+		rng = self.local.rng
+		if endpoint == "search":
+			params = {"user_text_input": self.texts[rng.integers(0, len(self.texts))]}
+		else:
+			params = {"product_index": self.skus[rng.integers(0, len(self.skus))]}
+		if self.hydrate:
+			params["hydrate"] = "true"
+		try:
+			return session.post(self.url + ENDPOINTS[endpoint], params=params, timeout=30).status_code
+		except requests.RequestException:
+			return 0
+
+
+def summarize(outcomes: List[Tuple[float, int]], elapsed: float) -> dict:
+	latencies = np.array([latency for latency, _ in outcomes]) * 1000
+	errors = sum(status != 200 for _, status in outcomes)
+	res = {"requests": len(outcomes), "errors": errors, "throughput_rps": (len(outcomes) - errors) / elapsed}
+	if len(latencies):
+		for name, q in (("p50_ms", 50), ("p90_ms", 90), ("p99_ms", 99), ("p999_ms", 99.9)):
+			res[name] = float(np.percentile(latencies, q))
+		res["max_ms"] = float(latencies.max())
+	return res
+
+
+def run_open_loop(workload: Workload, endpoint: str, rate: float, duration: float, max_in_flight: int,
+				  seed: int) -> dict:
+	"""
+	Send requests at Poisson arrivals of the given rate, latency is counted from the planned arrival time.
+	"""
+	arrivals = np.cumsum(np.random.default_rng(seed).exponential(1 / rate, int(rate * duration * 1.5) + 16))
+	arrivals = arrivals[arrivals < duration]
+
+	def send(planned: float) -> Tuple[float, int]:
+		status = workload.send(endpoint)
+		return time.perf_counter() - planned, status
+
+	max_lag = 0.0
+	with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+		start = time.perf_counter()
+		futures = []
+		for arrival in arrivals:
+			delay = start + arrival - time.perf_counter()
+			if delay > 0:
+				time.sleep(delay)
+			else:
+				max_lag = max(max_lag, -delay)
+			futures.append(pool.submit(send, start + arrival))
+		outcomes = [future.result() for future in futures]
+		elapsed = time.perf_counter() - start
+	return {"endpoint": endpoint, "rate": rate, **summarize(outcomes, elapsed), "max_lag_ms": 1000 * max_lag}
+
+
+def run_concurrency(workload: Workload, endpoint: str, n_clients: int, duration: float) -> dict:
+	"""
+	Run n_clients clients sending requests back to back for duration seconds.
+	"""
+	outcomes = []
+	lock = threading.Lock()
+
+	def client(deadline: float) -> None:
+		res = []
+		while time.perf_counter() < deadline:
+			start = time.perf_counter()
+			status = workload.send(endpoint)
+			res.append((time.perf_counter() - start, status))
+		with lock:
+			outcomes.extend(res)
+
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=n_clients) as pool:
+		list(pool.map(client, [start + duration] * n_clients))
+	return {"endpoint": endpoint, "concurrency": n_clients, **summarize(outcomes, time.perf_counter() - start)}
+
+
+def sample_skus(url: str, n: int) -> List[str]:
+	"""
+	Get skus of a running API through /products/random.
+	"""
+	with requests.Session() as session:
+		return list({session.get(url + "/products/random", timeout=10).json()["product"]["sku"] for _ in range(n)})
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Load test of the API with a synthetic catalog and a stub encoder")
+	parser.add_argument("--url", default=None, help="test a running API instead of starting one")
+	parser.add_argument("--rows", type=int, default=100_000, help="products in the synthetic catalog")
+	parser.add_argument("--dim", type=int, default=EMBEDDING_DIM, help="embeddings dimension")
+	parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat", help="index type")
+	parser.add_argument("--neighbors", type=int, default=0, help="also precompute the neighbor table with k neighbors")
+	parser.add_argument("--data-dir", default=None, help="keep generated data here and reuse it, default temporary")
+	parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+	parser.add_argument("--threads", type=int, default=0, help="faiss threads per worker, default cores / workers")
+	parser.add_argument("--encoder-delay-ms", type=float, default=0, help="imitated time of one encoder pass")
+	parser.add_argument("--encoder-per-text-ms", type=float, default=0, help="imitated encoder time per text")
+	parser.add_argument("--no-cache", action="store_true", help="disable the search cache of the API")
+	parser.add_argument("--endpoints", nargs="+", choices=list(ENDPOINTS), default=list(ENDPOINTS))
+	parser.add_argument("--rates", type=float, nargs="*", default=[50, 100, 200], help="open loop requests per second")
+	parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 4, 16], help="clients of concurrency runs")
+	parser.add_argument("--duration", type=float, default=20, help="seconds per run")
+	parser.add_argument("--warmup", type=float, default=3, help="seconds of requests before the runs")
+	parser.add_argument("--max-in-flight", type=int, default=256, help="open loop client threads")
+	parser.add_argument("--queries", type=int, default=100_000, help="distinct search texts")
+	parser.add_argument("--hydrate", action="store_true", help="request product records too")
+	parser.add_argument("--startup-timeout", type=float, default=600)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", default=None, help="where to write JSON results, default stdout")
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+	tmp_dir = tempfile.TemporaryDirectory(prefix="load_test_")
+	process = None
+	try:
+		if args.url:
+			url = args.url.rstrip("/")
+			skus = sample_skus(url, 1000)
+			target = {"url": url}
+		else:
+			data_dir = os.path.abspath(args.data_dir or tmp_dir.name)
+			skus = prepare_data(data_dir, args.rows, args.dim, args.index_type, args.neighbors, args.seed)
+			env = {
+				**os.environ, **data_paths(data_dir),
+				"TEXT_ENCODER": "stub",
+				"STUB_ENCODER_DIM": str(args.dim),
+				"STUB_ENCODER_CLUSTERS": str(default_clusters(args.rows)),
+				"STUB_ENCODER_SEED": str(args.seed),
+				"STUB_ENCODER_DELAY_MS": str(args.encoder_delay_ms),
+				"STUB_ENCODER_PER_TEXT_MS": str(args.encoder_per_text_ms),
+				"SNAPSHOT_POLL_INTERVAL": "0",
+				"WORKER_THREADS": str(args.threads)
+			}
+			if args.no_cache:
+				env["SEARCH_CACHE_SIZE"] = "0"
+			port = free_port()
+			url = f"http://127.0.0.1:{port}"
+			log_path = os.path.join(tmp_dir.name, "api.log")
+			process = start_api(env, args.workers, port, log_path, args.startup_timeout)
+			target = {
+				"rows": args.rows, "dim": args.dim, "index_type": args.index_type, "neighbors": args.neighbors,
+				"workers": args.workers, "threads": args.threads or None, "search_cache": not args.no_cache,
+				"encoder_delay_ms": args.encoder_delay_ms, "encoder_per_text_ms": args.encoder_per_text_ms
+			}
+
+		workload = Workload(url, skus, args.queries, args.hydrate, args.max_in_flight, args.seed)
+		for endpoint in args.endpoints:
+			run_concurrency(workload, endpoint, 4, args.warmup)
+
+		open_loop = []
+		for endpoint in args.endpoints:
+			for rate in args.rates:
+				res = run_open_loop(workload, endpoint, rate, args.duration, args.max_in_flight, args.seed)
+				logger.info("open loop %s", res)
+				open_loop.append(res)
+
+		concurrency = []
+		for endpoint in args.endpoints:
+			for n_clients in args.concurrency:
+				res = run_concurrency(workload, endpoint, n_clients, args.duration)
+				logger.info("concurrency %s", res)
+				concurrency.append(res)
+	finally:
+		if process is not None:
+			process.terminate()
+			process.wait(30)
+		tmp_dir.cleanup()
+
+	report = {
+		"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"target": target,
+		"duration": args.duration,
+		"hydrate": args.hydrate,
+		"open_loop": open_loop,
+		"concurrency": concurrency
+	}
+	text = json.dumps(report, indent=2)
+	if args.output:
+		os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+		with open(args.output, "w") as f:
+			f.write(text + "\n")
+		logger.info("saved results to %s", args.output)
+	else:
+		print(text)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,162 @@
+"""
+Prometheus metrics of the API and the sampled profiler of slow requests.
+
+Latency is measured per endpoint and per processing stage:
+
+tokenize        ruCLIP processor, texts to input ids
+encode          text tower pass
+encoder_wait    time a query waits in the micro-batcher queue
+image_decode, image_preprocess, image_encode, image_encoder_wait
+                the same for query images of /search_by_image
+image_search    search in the index of product photos
+index_search    faiss search, with exact re-ranking of updated products
+filter_search   search restricted by attribute filters
+lexical_search  BM25 search in the lexical index
+fusion          reciprocal rank fusion of dense, lexical and photo results
+neighbor_table  lookup in the precomputed neighbor table
+diversify       MMR re-ranking of recommendations with brand and category caps
+session_update  events of /get_personalized added to the session profile
+map_skus        catalog slots to skus
+hydrate         product records for the response
+
+With several uvicorn workers serve.py sets PROMETHEUS_MULTIPROC_DIR: every worker writes its metrics to files
+there and /metrics of any worker reports all of them.
+"""
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from prometheus_client import (
+	CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 10000)
+
+REQUEST_LATENCY = Histogram(
+	"api_request_duration_seconds", "Request latency by endpoint", ["endpoint"], buckets=LATENCY_BUCKETS
+)
+REQUESTS = Counter("api_requests_total", "Requests by endpoint and status code", ["endpoint", "status"])
+ERRORS = Counter("api_errors_total", "Requests failed with 5xx status or an exception", ["endpoint"])
+STAGE_LATENCY = Histogram(
+	"api_stage_duration_seconds", "Latency of request processing stages", ["stage"], buckets=LATENCY_BUCKETS
+)
+BATCH_SIZE = Histogram(
+	"api_batch_size", "Items per batch: requests of batch endpoints and encoder passes", ["kind"],
+	buckets=BATCH_SIZE_BUCKETS
+)
+SEARCH_CACHE = Gauge(
+	"api_search_cache", "Search cache counters of the current snapshot, summed over workers", ["stat"],
+	multiprocess_mode="livesum"
+)
+LEXICAL_TIMEOUTS = Counter(
+	"api_lexical_timeouts_total", "Hybrid searches answered without BM25 results, which missed the latency budget"
+)
+SESSION_STORE_SIZE = Gauge(
+	"api_session_store_size", "Session profiles of personalized recommendations, shared by workers",
+	multiprocess_mode="livemax"
+)
+SESSION_EVICTIONS = Gauge(
+	"api_session_evictions", "Session profiles evicted or expired, summed over workers", multiprocess_mode="livesum"
+)
+INDEX_VECTORS = Gauge(
+	"api_index_vectors", "Vectors in the index: total, products alive and stale ones", ["kind"],
+	multiprocess_mode="livemax"
+)
+
+
+@contextmanager
+def timed(stage: str):
+	"""
+	Observe duration of the block in the stage latency histogram.
+	"""
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		STAGE_LATENCY.labels(stage).observe(time.perf_counter() - start)
+
+
+def set_search_cache_stats(stats: dict) -> None:
+	for stat in ("size", "hits", "misses", "evictions", "coalesced", "in_flight"):
+		SEARCH_CACHE.labels(stat).set(stats[stat])
+
+
+def set_session_store_stats(stats: dict) -> None:
+	SESSION_STORE_SIZE.set(stats["size"])
+	SESSION_EVICTIONS.set(stats["evictions"])
+
+
+def set_index_size(total: int, products: int, stale: int) -> None:
+	INDEX_VECTORS.labels("total").set(total)
+	INDEX_VECTORS.labels("products").set(products)
+	INDEX_VECTORS.labels("stale").set(stale)
+
+
+def is_multiprocess() -> bool:
+	return "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+
+def render() -> bytes:
+	"""
+	Metrics in Prometheus text format, of all workers in multiprocess mode.
+	"""
+	if is_multiprocess():
+		registry = CollectorRegistry()
+		multiprocess.MultiProcessCollector(registry)
+		return generate_latest(registry)
+	return generate_latest(REGISTRY)
+
+
+def mark_process_dead() -> None:
+	"""
+	Drop live gauges of the exiting worker in multiprocess mode.
+	"""
+	if is_multiprocess():
+		multiprocess.mark_process_dead(os.getpid())
+
+
+class SlowRequestProfiler:
+	"""
+	Profile a random sample of requests with cProfile and dump stats of those slower than the threshold.
+
+	One request per process is profiled at a time. The profiler sees only the event loop thread: time of
+	other requests interleaved with the sampled one is included, work in executor threads (the encoder) is not.
+	Read the dumps with python -m pstats <file>.
+	"""
+
+	def __init__(self, sample_rate: float, threshold_ms: float, out_dir: str):
+		self.sample_rate = sample_rate
+		self.threshold = threshold_ms / 1000
+		self.out_dir = out_dir
+		self.lock = threading.Lock()
+
+	def start(self) -> Optional[cProfile.Profile]:
+		if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+			return None
+		if not self.lock.acquire(blocking=False):
+			return None
+		profile = cProfile.Profile()
+		profile.enable()
+		return profile
+
+	def stop(self, profile: cProfile.Profile, endpoint: str, duration: float) -> None:
+		profile.disable()
+		self.lock.release()
+		if duration < self.threshold:
+			return
+
+		os.makedirs(self.out_dir, exist_ok=True)
+		name = endpoint.strip("/").replace("/", "_") or "root"
+		path = os.path.join(
+			self.out_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{name}-{int(duration * 1000)}ms.prof"
+		)
+		profile.dump_stats(path)
+		logger.warning("%s took %.0f ms, profile saved to %s", endpoint, duration * 1000, path)
@@ -0,0 +1,121 @@
+import asyncio
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+import numpy as np
+
+from metrics import BATCH_SIZE, STAGE_LATENCY
+
+
+class MicroBatcher:
+	"""
+	Dynamic micro-batching of encoder calls.
+
+	Texts submitted within max_wait_ms of the first queued one (up to max_batch_size texts) are encoded
+	together on a dedicated single-thread executor, so the event loop is never blocked by the encoder and
+	encoder passes never run concurrently. Each caller gets its own row of the batch result.
+	"""
+
+	def __init__(self, encode: Callable[[list], np.ndarray], max_batch_size: int = 32, max_wait_ms: float = 5.0,
+				 name: str = "encoder"):
+		"""
+		:param: encode: function encoding a list of items, texts or images
+		:param: max_batch_size: items per encoder pass
+		:param: max_wait_ms: how long the first queued item waits for others
+		:param: name: label of batch size and wait metrics, <name>_wait is the stage
+		"""
+		self.encode = encode
+		self.name = name
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait_ms / 1000
+		self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+		self._queue = None
+		self._task = None
+		self.batches = 0
+		self.items = 0
+		self.batch_sizes = Counter()
+		self.wait_total = 0.0
+		self.wait_max = 0.0
+
+	async def start(self) -> None:
+		self._queue = asyncio.Queue()
+		self._task = asyncio.create_task(self._run())
+
+	async def stop(self) -> None:
+		if self._task is not None:
+			self._task.cancel()
+		self._executor.shutdown(wait=False)
+
+	async def submit(self, text: str) -> np.ndarray:
+		"""
+		Encode one text as a part of the next batch.
+
+		:param: text: text to encode
+		:return: embedding of the text
+		"""
+		future = asyncio.get_running_loop().create_future()
+		await self._queue.put((text, future, time.monotonic()))
+		return await future
+
+	async def encode_many(self, texts: List[str]) -> np.ndarray:
+		"""
+		Encode already batched texts on the same executor, bypassing the queue.
+		"""
+		BATCH_SIZE.labels(self.name).observe(len(texts))
+		return await asyncio.get_running_loop().run_in_executor(self._executor, self.encode, texts)
+
+	async def _run(self) -> None:
+		loop = asyncio.get_running_loop()
+		while True:
+			batch = [await self._queue.get()]
+			deadline = loop.time() + self.max_wait
+			self._drain(batch)
+			if len(batch) < self.max_batch_size and deadline > loop.time():
+				await asyncio.sleep(deadline - loop.time())
+				self._drain(batch)
+
+			# запросы, которые отменили, пока ждали в очереди, не кодируем
+			batch = [item for item in batch if not item[1].done()]
+			if not batch:
+				continue
+			self._record(batch)
+
+			try:
+				embeddings = await loop.run_in_executor(self._executor, self.encode, [text for text, _, _ in batch])
+			except Exception as err:
+				for _, future, _ in batch:
+					if not future.done():
+						future.set_exception(err)
+			else:
+				for (_, future, _), embedding in zip(batch, embeddings):
+					if not future.done():
+						future.set_result(embedding)
+
+	def _drain(self, batch: list) -> None:
+		while len(batch) < self.max_batch_size and not self._queue.empty():
+			batch.append(self._queue.get_nowait())
+
+	def _record(self, batch: list) -> None:
+		now = time.monotonic()
+		waits = [now - enqueued for _, _, enqueued in batch]
+		self.batches += 1
+		self.items += len(batch)
+		self.batch_sizes[len(batch)] += 1
+		self.wait_total += sum(waits)
+		self.wait_max = max(self.wait_max, max(waits))
+		BATCH_SIZE.labels(self.name).observe(len(batch))
+		wait_histogram = STAGE_LATENCY.labels(f"{self.name}_wait")
+		for wait in waits:
+			wait_histogram.observe(wait)
+
+	def stats(self) -> dict:
+		return {
+			"queue_depth": self._queue.qsize() if self._queue is not None else 0,
+			"batches": self.batches,
+			"items": self.items,
+			"batch_sizes": dict(sorted(self.batch_sizes.items())),
+			"wait_ms_avg": 1000 * self.wait_total / self.items if self.items else 0.0,
+			"wait_ms_max": 1000 * self.wait_max,
+		}
@@ -0,0 +1,181 @@
+"""
+Precomputed item-to-item neighbors for every product.
+
+Neighbors are exact L2 nearest neighbors (same as IndexFlatL2) computed blockwise with matrix
+multiplication: ||q - x||^2 = ||q||^2 - 2 q.x + ||x||^2, where ||q||^2 does not change the order.
+Blocks of rows are processed in a thread pool, numpy releases the GIL in matmul and partition.
+
+The table is stored as an int32 matrix n_rows x k of rows of the embeddings store (.npy, memory-mapped
+by the API) and a json file with the checksum of the store sku table.
+
+Usage (from src/api):
+	python neighbor_table.py --k 50 --export ../../data/embeddings/text_ruCLIP_neighbors.csv
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+import config
+from embedding_store import EmbeddingStore
+
+logger = logging.getLogger(__name__)
+
+# сколько float32 расстояний держим в памяти на один блок
+BLOCK_ELEMENTS = 16 * 1024 * 1024
+
+
+def compute_neighbors(matrix: np.ndarray, k: int, block_size: int = None, workers: int = None) -> np.ndarray:
+	"""
+	Compute top-k nearest neighbors for every row, excluding the row itself.
+
+	:param: matrix: embeddings matrix, may be memory-mapped or float16
+	:param: k: number of neighbors
+	:param: block_size: rows per block, by default chosen to keep a block distances under BLOCK_ELEMENTS
+	:param: workers: number of threads
+	:return: int32 matrix n_rows x k of neighbor rows sorted by distance, k is cut to n_rows - 1
+	"""
+	base = np.ascontiguousarray(matrix, dtype="float32")
+	n_rows = base.shape[0]
+	k = min(k, n_rows - 1)
+	if k <= 0:
+		# у единственного товара нет соседей: пустая таблица, API ищет по индексу
+		return np.empty((n_rows, 0), dtype="int32")
+	block_size = block_size or max(1, BLOCK_ELEMENTS // max(n_rows, 1))
+	norms = np.einsum("ij,ij->i", base, base)
+	res = np.empty((n_rows, k), dtype="int32")
+
+	def process(start: int) -> None:
+		end = min(start + block_size, n_rows)
+		distances = norms[None, :] - 2 * (base[start:end] @ base.T)
+		# исключаем сам товар из его соседей
+		distances[np.arange(end - start), np.arange(start, end)] = np.inf
+
+		top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+		order = np.argsort(np.take_along_axis(distances, top, axis=1), axis=1, kind="stable")
+		res[start:end] = np.take_along_axis(top, order, axis=1)
+
+	with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+		list(pool.map(process, range(0, n_rows, block_size)))
+
+	return res
+
+
+class NeighborTable:
+	"""
+	Sku -> neighbor skus lookup over the precomputed table.
+	"""
+
+	def __init__(self, neighbors: np.ndarray, store: EmbeddingStore):
+		self.neighbors = neighbors
+		self.store = store
+
+	@property
+	def k(self) -> int:
+		return self.neighbors.shape[1]
+
+	@staticmethod
+	def write(path: str, neighbors: np.ndarray, store: EmbeddingStore) -> None:
+		"""
+		Write the table and its json, each file is replaced atomically: the API may map the old table meanwhile.
+		"""
+		meta = {"n_rows": len(store), "k": neighbors.shape[1], "skus_crc32": store.skus_crc32}
+		_write_atomic(path, lambda f: np.save(f, neighbors))
+		_write_atomic(_meta_path(path), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+	@classmethod
+	def open(cls, path: str, store: EmbeddingStore) -> Optional["NeighborTable"]:
+		"""
+		Open table if it exists and was computed for the same embeddings.
+
+		:param: path: path to .npy table
+		:param: store: embeddings store the table was computed from
+		:return: table or None
+		"""
+		if not os.path.exists(path) or not os.path.exists(_meta_path(path)):
+			return None
+		with open(_meta_path(path)) as f:
+			meta = json.load(f)
+		neighbors = np.load(path, mmap_mode="r")
+		# таблица и json заменяются по очереди, между заменами они могут быть от разных расчетов
+		if (meta["skus_crc32"] != store.skus_crc32 or meta["n_rows"] != len(store)
+				or neighbors.shape != (len(store), meta["k"])):
+			logger.warning("neighbor table %s does not match embeddings, ignored", path)
+			return None
+
+		return cls(neighbors, store)
+
+	def rows(self, sku: str) -> Optional[np.ndarray]:
+		"""
+		Get embeddings rows of all stored neighbors of the product, None if the product is not in the table.
+		"""
+		row = self.store.rows.get(sku)
+		return None if row is None else self.neighbors[row]
+
+	def get(self, sku: str, k: int) -> Optional[List[str]]:
+		"""
+		Get k nearest neighbors of the product or None if the table can not answer.
+		"""
+		rows = self.rows(sku)
+		if rows is None or k > self.k:
+			return None
+		return [self.store.skus[neighbor] for neighbor in rows[:k]]
+
+	def export(self, path: str) -> None:
+		"""
+		Write the table as csv with columns sku, rank, neighbor_sku for batch consumers.
+		"""
+		skus = np.array(self.store.skus, dtype=object)
+		n_rows, k = self.neighbors.shape
+		pd.DataFrame({
+			"sku": np.repeat(skus, k),
+			"rank": np.tile(np.arange(1, k + 1), n_rows),
+			"neighbor_sku": skus[np.asarray(self.neighbors).ravel()],
+		}).to_csv(path, index=False)
+
+
+def _meta_path(path: str) -> str:
+	return os.path.splitext(path)[0] + ".json"
+
+
+def _write_atomic(path: str, write) -> None:
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			write(f)
+		os.chmod(tmp_path, 0o644)
+		os.replace(tmp_path, path)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Precompute nearest neighbors for every product")
+	parser.add_argument("--embeddings", default=config.EMBEDDINGS_PATH, help="binary embeddings file")
+	parser.add_argument("--output", default=config.NEIGHBORS_PATH, help="where to write the table (.npy)")
+	parser.add_argument("--k", type=int, default=50, help="neighbors per product")
+	parser.add_argument("--workers", type=int, default=None, help="threads, default number of cores")
+	parser.add_argument("--export", default=None, help="also write the table as csv to this path")
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+	store = EmbeddingStore.open(args.embeddings)
+	neighbors = compute_neighbors(store.matrix, args.k, workers=args.workers)
+	NeighborTable.write(args.output, neighbors, store)
+	logger.info("saved %d x %d neighbors to %s", *neighbors.shape, args.output)
+
+	if args.export:
+		NeighborTable(neighbors, store).export(args.export)
+		logger.info("exported neighbors to %s", args.export)
+
+
+if __name__ == "__main__":
+	main()
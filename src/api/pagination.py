@@ -0,0 +1,76 @@
+"""
+Pages of search results and recommendations: k, offset and opaque cursors.
+
+A page is cut from the candidate list of its query, over-fetched by PAGE_CANDIDATES and kept in the search
+cache of the snapshot, so the next pages neither encode the query again nor repeat the search while the list
+is cached. A cursor holds the snapshot version, a fingerprint of the query and the offset of the next page:
+it can not be used with another query and fails once another snapshot is served, instead of silently
+mixing results of two snapshots.
+"""
+import base64
+import binascii
+import hashlib
+import json
+from typing import Hashable, NamedTuple
+
+
+class CursorError(ValueError):
+	"""
+	The cursor is malformed or was made for another query.
+	"""
+
+
+class StaleCursorError(CursorError):
+	"""
+	The cursor was made for another snapshot, paging must start over.
+	"""
+
+
+class Page(NamedTuple):
+	k: int
+	offset: int = 0
+
+	@property
+	def end(self) -> int:
+		return self.offset + self.k
+
+
+def query_fingerprint(key: Hashable) -> str:
+	return hashlib.blake2b(repr(key).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def encode_cursor(version: str, key: Hashable, offset: int) -> str:
+	data = json.dumps([version, query_fingerprint(key), offset], separators=(",", ":")).encode("utf-8")
+	return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, version: str, key: Hashable) -> int:
+	"""
+	Check the cursor against the query and the served snapshot.
+
+	:param: cursor: next_cursor of the previous page
+	:param: version: version of the served snapshot
+	:param: key: the query, as given to encode_cursor
+	:return: offset of the page
+	"""
+	try:
+		cursor_version, fingerprint, offset = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+	except (binascii.Error, ValueError, TypeError) as err:
+		raise CursorError("malformed cursor") from err
+	if fingerprint != query_fingerprint(key) or not isinstance(offset, int) or offset < 0:
+		raise CursorError("cursor was made for another query")
+	if cursor_version != version:
+		raise StaleCursorError(f"cursor was made for snapshot {cursor_version}, start from the first page")
+	return offset
+
+
+def next_cursor(version: str, key: Hashable, page: Page, n_found: int, max_results: int):
+	"""
+	Cursor of the page after the given one, None if the candidate list ends on this page.
+
+	:param: n_found: length of the candidate list, searched for at least page.end + 1 results
+	:param: max_results: deepest position a page may reach
+	"""
+	if n_found <= page.end or page.end >= max_results:
+		return None
+	return encode_cursor(version, key, page.end)
@@ -0,0 +1,141 @@
+"""
+Compact columnar store of product fields shown by the front ends.
+
+Text columns are int32 codes into one string table: all distinct values encoded as utf-8 and concatenated
+into a single bytes blob with an offsets array. Prices are a float64 array. The store is built once per
+snapshot from the products dataframe, lookups use only numpy arrays and the blob, no pandas.
+"""
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+# текстовые колонки products.csv, которые отдаются фронтендам
+TEXT_COLUMNS = ("name", "dimension17", "dimension18", "brand", "category", "description", "product_usage")
+
+
+class ProductStore:
+	def __init__(self, skus: List[str], codes: Dict[str, np.ndarray], prices: np.ndarray, blob: bytes,
+				 offsets: np.ndarray):
+		"""
+		:param: skus: skus in the order of rows
+		:param: codes: int32 string table codes of every text column, -1 for missing values
+		:param: prices: float64 prices, nan for missing values
+		:param: blob: utf-8 encoded distinct strings
+		:param: offsets: start of every string in blob and the end of the last one
+		"""
+		self.skus = skus
+		self.rows = {sku: row for row, sku in enumerate(skus)}
+		self.codes = codes
+		self.prices = prices
+		self.blob = blob
+		self.offsets = offsets
+		# коды значений для фильтров, значений немного
+		self.category_codes = self._value_codes("category")
+		self.brand_codes = self._value_codes("brand")
+		self.same_usage = (codes["description"] == codes["product_usage"]) & (codes["description"] >= 0)
+
+	@classmethod
+	def from_frame(cls, products: pd.DataFrame) -> "ProductStore":
+		"""
+		Build the store from products dataframe indexed by sku. Missing columns are stored as missing values.
+		"""
+		n_rows = len(products)
+		columns = [
+			products[column] if column in products else pd.Series([None] * n_rows, index=products.index, dtype=object)
+			for column in TEXT_COLUMNS
+		]
+		# одна таблица строк на все колонки: одинаковые значения хранятся один раз и имеют одинаковый код
+		codes, uniques = pd.factorize(pd.concat(columns, ignore_index=True))
+		encoded = [str(value).encode("utf-8") for value in uniques]
+		offsets = np.zeros(len(encoded) + 1, dtype="int64")
+		np.cumsum([len(value) for value in encoded], out=offsets[1:])
+
+		codes = codes.astype("int32")
+		return cls(
+			products.index.astype(str).to_list(),
+			{column: codes[num * n_rows:(num + 1) * n_rows] for num, column in enumerate(TEXT_COLUMNS)},
+			pd.to_numeric(products["price"], errors="coerce").to_numpy(dtype="float64"),
+			b"".join(encoded),
+			offsets
+		)
+
+	def __len__(self) -> int:
+		return len(self.skus)
+
+	def __contains__(self, sku: str) -> bool:
+		return sku in self.rows
+
+	def _value_codes(self, column: str) -> Dict[str, int]:
+		return {self.string(code): int(code) for code in np.unique(self.codes[column]) if code >= 0}
+
+	def string(self, code: int) -> Optional[str]:
+		if code < 0:
+			return None
+		return self.blob[self.offsets[code]:self.offsets[code + 1]].decode("utf-8")
+
+	def record(self, row: int) -> dict:
+		"""
+		Get display fields of the product in the row, names are columns of products.csv.
+		"""
+		price = self.prices[row].item()
+		if price != price:
+			price = None
+		elif price.is_integer():
+			# целые цены отдаем как в products.csv, без ".0"
+			price = int(price)
+		res = {"sku": self.skus[row], "price": price}
+		for column in TEXT_COLUMNS:
+			res[column] = self.string(self.codes[column][row])
+		return res
+
+	def records(self, skus: List[str]) -> List[Optional[dict]]:
+		"""
+		Get display fields of the products, None for unknown skus.
+		"""
+		res = []
+		for sku in skus:
+			row = self.rows.get(sku)
+			res.append(None if row is None else self.record(row))
+		return res
+
+	def _mask(self, column_codes: Dict[str, int], codes: np.ndarray, values: List[str]) -> np.ndarray:
+		return np.isin(codes, [column_codes[value] for value in values if value in column_codes])
+
+	def select(self, category: List[str] = None, brand: List[str] = None, exclude_category: List[str] = None,
+			   distinct_usage: bool = False) -> np.ndarray:
+		"""
+		Get rows of products matching all given conditions.
+
+		:param: category: allowed categories
+		:param: brand: allowed brands
+		:param: exclude_category: categories to skip
+		:param: distinct_usage: skip products whose product_usage repeats the description
+		:return: rows
+		"""
+		mask = np.ones(len(self), dtype=bool)
+		if category:
+			mask &= self._mask(self.category_codes, self.codes["category"], category)
+		if brand:
+			mask &= self._mask(self.brand_codes, self.codes["brand"], brand)
+		if exclude_category:
+			mask &= ~self._mask(self.category_codes, self.codes["category"], exclude_category)
+		if distinct_usage:
+			mask &= ~self.same_usage
+		return np.flatnonzero(mask)
+
+	def facets(self, category: List[str] = None, exclude_category: List[str] = None) -> dict:
+		"""
+		Get categories and brands of the selected categories, both ordered by number of products.
+		"""
+		rows = self.select(exclude_category=exclude_category)
+		res = {"categories": self._counts(self.codes["category"][rows])}
+		if category:
+			rows = self.select(category=category, exclude_category=exclude_category)
+			res["brands"] = self._counts(self.codes["brand"][rows])
+		return res
+
+	def _counts(self, codes: np.ndarray) -> List[str]:
+		values, counts = np.unique(codes[codes >= 0], return_counts=True)
+		return [self.string(values[num]) for num in np.argsort(-counts, kind="stable")]
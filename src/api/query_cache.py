@@ -0,0 +1,136 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, NamedTuple, Optional
+
+import numpy as np
+
+
+class CachedQuery(NamedTuple):
+	embedding: Optional[np.ndarray]
+	skus: list
+	# результат без части поиска, например BM25 не уложился в бюджет; такой не кэшируется
+	partial: bool = False
+	# сколько результатов искали; если skus короче, результатов больше нет
+	limit: int = 0
+
+	@property
+	def exhausted(self) -> bool:
+		return len(self.skus) < self.limit
+
+
+class QueryCache:
+	"""
+	LRU cache with TTL for search queries.
+
+	Concurrent misses for the same key are coalesced: the first caller computes the value,
+	the others wait for its result. Must be used from one event loop.
+
+	clear() starts a new generation: values computed from data of an older one are not cached.
+	"""
+
+	def __init__(self, max_size: int, ttl: float):
+		self.max_size = max_size
+		self.ttl = ttl
+		self._items = OrderedDict()
+		self._in_flight = {}
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.coalesced = 0
+		self.generation = 0
+
+	@staticmethod
+	def normalize(text: str) -> str:
+		"""
+		Cache key for a query: the encoder lowercases text itself, so case and extra spaces do not matter.
+		"""
+		return " ".join(text.lower().split())
+
+	def get(self, key: Hashable) -> Optional[CachedQuery]:
+		item = self._items.get(key)
+		if item is None:
+			self.misses += 1
+			return None
+
+		expires_at, value = item
+		if expires_at < time.monotonic():
+			del self._items[key]
+			self.evictions += 1
+			self.misses += 1
+			return None
+
+		self._items.move_to_end(key)
+		self.hits += 1
+		return value
+
+	def put(self, key: Hashable, value: CachedQuery, generation: int = None) -> None:
+		"""
+		:param: generation: generation the value was computed in, the value is dropped if the cache was cleared since
+		"""
+		if self.max_size <= 0 or (generation is not None and generation != self.generation):
+			return
+		self._items[key] = (time.monotonic() + self.ttl, value)
+		self._items.move_to_end(key)
+		while len(self._items) > self.max_size:
+			self._items.popitem(last=False)
+			self.evictions += 1
+
+	async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[CachedQuery]]) -> CachedQuery:
+		"""
+		Get cached value or compute it, waiting for the same computation if it is already running.
+
+		The value is computed in a task of its own: a cancelled caller, the first one included, stops waiting,
+		but the others still get the value and it is still cached.
+
+		:param: key: normalized query
+		:param: compute: coroutine function computing the value, partial values are returned but not cached
+		:return: cached or computed value
+		"""
+		value = self.get(key)
+		if value is not None:
+			return value
+
+		task = self._in_flight.get(key)
+		if task is None:
+			task = asyncio.ensure_future(self._compute(key, compute, self.generation))
+			# ошибку получат ожидающие запросы, если они есть; сама задача не должна писать в лог
+			task.add_done_callback(lambda done: done.cancelled() or done.exception())
+			self._in_flight[key] = task
+		else:
+			self.coalesced += 1
+		return await asyncio.shield(task)
+
+	async def _compute(self, key: Hashable, compute: Callable[[], Awaitable[CachedQuery]],
+					   generation: int) -> CachedQuery:
+		try:
+			value = await compute()
+		finally:
+			# после clear под этим ключом может считаться уже другое значение
+			if self._in_flight.get(key) is asyncio.current_task():
+				del self._in_flight[key]
+		if not value.partial:
+			self.put(key, value, generation)
+		return value
+
+	def clear(self) -> None:
+		"""
+		Drop all cached values, e.g. after the index was reloaded. Computations in flight still answer their
+		callers, but their values are not cached and new callers do not wait for them.
+		"""
+		self.evictions += len(self._items)
+		self._items.clear()
+		self._in_flight.clear()
+		self.generation += 1
+
+	def stats(self) -> dict:
+		return {
+			"size": len(self._items),
+			"max_size": self.max_size,
+			"ttl": self.ttl,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"coalesced": self.coalesced,
+			"in_flight": len(self._in_flight),
+		}
@@ -0,0 +1,59 @@
+"""
+Run the API in one or several uvicorn worker processes.
+
+Workers import back.py themselves, this module does not load any data, so the supervisor process stays small.
+It only converts the embeddings csv of the default data to the binary format once before the workers start,
+so they do not all convert it at the same time.
+Embeddings and the index are memory-mapped (INDEX_MMAP=1), so N workers share one copy of them
+through the page cache.
+
+Session profiles of /get_personalized are kept in a file in SESSION_STORE_DIR shared by the workers,
+a fresh temporary directory by default.
+
+With several workers prometheus_client runs in multiprocess mode: workers write metrics to PROMETHEUS_MULTIPROC_DIR,
+a fresh temporary directory by default, and /metrics of any worker reports all of them.
+
+Usage (from src/api):
+	python serve.py --workers 4 --threads 2
+"""
+import argparse
+import glob
+import os
+import tempfile
+
+import uvicorn
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Run recommendations API")
+	parser.add_argument("--host", default="0.0.0.0")
+	parser.add_argument("--port", type=int, default=8080)
+	parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "1")), help="uvicorn worker processes")
+	parser.add_argument(
+		"--threads", type=int, default=int(os.getenv("WORKER_THREADS", "0")),
+		help="torch, onnxruntime and faiss threads per worker, default cores / workers"
+	)
+	args = parser.parse_args()
+
+	import config
+	from embedding_store import convert_if_stale
+
+	convert_if_stale(config.EMBEDDINGS_PATH, config.EMBEDDINGS_CSV_PATH)
+
+	# воркеры читают настройки из config.py, поэтому передаем их через окружение
+	os.environ["WORKERS"] = str(args.workers)
+	os.environ["WORKER_THREADS"] = str(args.threads or max(1, (os.cpu_count() or 1) // args.workers))
+	if args.workers > 1:
+		metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR") or tempfile.mkdtemp(prefix="api_metrics_")
+		os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+		# метрики прошлого запуска не должны попасть в новые
+		for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+			os.remove(path)
+	# профили сессий в общем файле, иначе у каждого воркера была бы своя часть событий сессии
+	os.environ["SESSION_STORE_DIR"] = os.getenv("SESSION_STORE_DIR") or tempfile.mkdtemp(prefix="api_sessions_")
+
+	uvicorn.run("back:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,272 @@
+"""
+Session profiles for personalized recommendations: a time-decayed running mean of embeddings of the products
+a session viewed or put in the cart.
+
+A profile holds the decayed sum of weighted event embeddings and the decayed sum of event weights, both as of
+its latest event. A new event decays the profile to its own time and adds its embedding, an event that comes
+late is decayed to the time of the profile instead. The result does not depend on the order of events, an
+update is a few operations on one vector and the history is never read again. The mean is the sum divided
+by the weight.
+
+Events are deduplicated by (sku, timestamp), so a client may send the recent events of a session with every
+request: the last max_events events of a session are remembered and skipped when they come again.
+
+Profiles are shared by all worker processes of the API: they live in a memory-mapped file, a table of rows
+grouped in buckets of WAYS rows by a hash of the session id. A new session takes a free or expired row of its
+bucket or evicts the least recently used one, so the store never grows. A bucket is locked while a session
+in it is read or updated, workers wait for each other only on sessions of the same bucket.
+"""
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+
+# строк в одной корзине таблицы: столько сессий с одним хэшем корзины живут одновременно
+WAYS = 8
+# блокировок потоков одного процесса, корзина берет блокировку по своему номеру
+LOCK_STRIPES = 64
+
+
+def item_key(*parts) -> int:
+	"""
+	Nonzero 64-bit hash of a session id, a sku or an event, 0 marks a free slot.
+	"""
+	digest = hashlib.blake2b("\x00".join(str(part) for part in parts).encode("utf-8"), digest_size=8).digest()
+	return int.from_bytes(digest, "little") or 1
+
+
+def decay_add(vector_sum: np.ndarray, weight: float, updated_at: Optional[float], vector: np.ndarray,
+			  event_weight: float, timestamp: float, half_life: float) -> Tuple[float, float]:
+	"""
+	Add an event to a time-decayed sum in O(dim), vector_sum is updated in place.
+
+	:param: vector_sum: decayed sum of weighted embeddings as of updated_at
+	:param: weight: decayed sum of weights as of updated_at
+	:param: updated_at: time of the latest event, None for an empty sum
+	:param: vector: embedding of the event product
+	:param: event_weight: weight of the event type
+	:param: timestamp: time of the event, unix seconds
+	:param: half_life: seconds after which an event weighs half as much
+	:return: new weight and time of the sum
+	"""
+	if updated_at is None:
+		updated_at = timestamp
+	elif timestamp >= updated_at:
+		decay = 0.5 ** ((timestamp - updated_at) / half_life)
+		vector_sum *= np.float32(decay)
+		weight *= decay
+		updated_at = timestamp
+	else:
+		event_weight *= 0.5 ** ((updated_at - timestamp) / half_life)
+	vector_sum += np.float32(event_weight) * vector
+	return weight + event_weight, updated_at
+
+
+class SessionTable:
+	"""
+	Columns of all session rows in one memory-mapped file, created zero-filled, i.e. with all rows free.
+	"""
+
+	def __init__(self, path: str, n_rows: int, dim: int, max_seen: int, max_events: int):
+		self.path = path
+		self.n_rows = n_rows
+		self.dim = dim
+		shapes = [
+			("keys", "<u8", (n_rows,)), ("accessed_at", "<f8", (n_rows,)), ("updated_at", "<f8", (n_rows,)),
+			("weight", "<f8", (n_rows,)), ("seen_pos", "<i8", (n_rows,)), ("events_pos", "<i8", (n_rows,)),
+			("seen", "<u8", (n_rows, max_seen)), ("events", "<u8", (n_rows, max_events)),
+			("vector_sum", "<f4", (n_rows, dim)),
+		]
+		size = sum(np.dtype(dtype).itemsize * int(np.prod(shape)) for _, dtype, shape in shapes)
+
+		self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+		# воркеры открывают файл одновременно: ftruncate до того же размера безопасен и заполняет нулями
+		if os.fstat(self.fd).st_size < size:
+			os.ftruncate(self.fd, size)
+		raw = np.memmap(path, dtype="uint8", mode="r+", shape=(size,))
+		offset = 0
+		for name, dtype, shape in shapes:
+			n_bytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+			setattr(self, name, raw[offset:offset + n_bytes].view(dtype).reshape(shape))
+			offset += n_bytes
+
+	@contextmanager
+	def locked(self, bucket: int) -> Iterator[None]:
+		# блокировка байта с номером корзины, сами данные она не защищает от чтения без блокировки
+		fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, bucket)
+		try:
+			yield
+		finally:
+			fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, bucket)
+
+	def close(self) -> None:
+		os.close(self.fd)
+
+
+class SessionProfile:
+	"""
+	A row of the session table, valid only while its bucket is locked, see SessionStore.profile.
+	"""
+
+	def __init__(self, table: SessionTable, row: int, half_life: float):
+		self.table = table
+		self.row = row
+		self.half_life = half_life
+
+	def add(self, sku: str, vector: np.ndarray, weight: float, timestamp: float) -> bool:
+		"""
+		Add an event to the running mean in O(dim).
+
+		:param: sku: product of the event
+		:param: vector: embedding of the product
+		:param: weight: weight of the event type
+		:param: timestamp: time of the event, unix seconds
+		:return: False if the event was already added
+		"""
+		table, row = self.table, self.row
+		event = item_key(sku, repr(float(timestamp)))
+		if (table.events[row] == event).any():
+			return False
+		table.events[row, table.events_pos[row] % table.events.shape[1]] = event
+		table.events_pos[row] += 1
+
+		updated_at = table.updated_at[row] if table.weight[row] > 0 else None
+		table.weight[row], table.updated_at[row] = decay_add(
+			table.vector_sum[row], float(table.weight[row]), updated_at, vector, weight, timestamp, self.half_life
+		)
+
+		seen = item_key(sku)
+		if not (table.seen[row] == seen).any():
+			table.seen[row, table.seen_pos[row] % table.seen.shape[1]] = seen
+			table.seen_pos[row] += 1
+		return True
+
+	def mean(self) -> Optional[np.ndarray]:
+		"""
+		Time-decayed mean embedding of the events, None if there were none.
+		"""
+		weight = self.table.weight[self.row]
+		if weight <= 0:
+			return None
+		return self.table.vector_sum[self.row] / np.float32(weight)
+
+	def seen(self) -> set:
+		"""
+		Keys of the recently seen products, compare with item_key(sku).
+		"""
+		return set(int(key) for key in self.table.seen[self.row] if key)
+
+
+class SessionStore:
+	"""
+	Session profiles in a file shared by the worker processes, one table per embedding dimension.
+
+	Thread-safe: fcntl locks only separate processes, so threads of one process also take a thread lock of the
+	bucket, one of LOCK_STRIPES shared by buckets with the same remainder.
+	"""
+
+	def __init__(self, directory: Optional[str], max_size: int, ttl: float, half_life: float, max_seen: int,
+				 max_events: int):
+		"""
+		:param: directory: directory of table files, the same for all workers; None - a new temporary one
+		:param: max_size: most sessions kept, rounded up to whole buckets
+		:param: ttl: seconds since the last access after which a session is dropped
+		:param: half_life: seconds after which an event weighs half as much
+		:param: max_seen: most recent products of a session excluded from its recommendations
+		:param: max_events: most recent events of a session remembered to skip repeated ones
+		"""
+		self.directory = directory
+		self.n_buckets = max(1, -(-max_size // WAYS))
+		self.ttl = ttl
+		self.half_life = half_life
+		self.max_seen = max_seen
+		self.max_events = max_events
+		self.evictions = 0
+		self._tables = {}
+		self._lock = threading.Lock()
+		self._bucket_locks = [threading.Lock() for _ in range(min(self.n_buckets, LOCK_STRIPES))]
+
+	def table(self, dim: int) -> SessionTable:
+		"""
+		Table of profiles of the given dimension, a snapshot of another model gets a table of its own.
+		"""
+		with self._lock:
+			if dim not in self._tables:
+				if self.directory is None:
+					self.directory = tempfile.mkdtemp(prefix="api_sessions_")
+				name = f"sessions_{dim}d_{self.n_buckets * WAYS}x{self.max_seen}x{self.max_events}.bin"
+				self._tables[dim] = SessionTable(
+					os.path.join(self.directory, name), self.n_buckets * WAYS, dim, self.max_seen, self.max_events
+				)
+			return self._tables[dim]
+
+	@contextmanager
+	def profile(self, session_id: str, dim: int, create: bool) -> Iterator[Optional[SessionProfile]]:
+		"""
+		Lock and get the profile of the session.
+
+		:param: session_id: session id
+		:param: dim: embedding dimension
+		:param: create: create the profile if the session has none, evicting another session if needed
+		:return: profile, None if the session has none and create is false
+		"""
+		key = item_key(session_id)
+		bucket = key % self.n_buckets
+		rows = slice(bucket * WAYS, (bucket + 1) * WAYS)
+		table = self.table(dim)
+		with self._bucket_locks[bucket % len(self._bucket_locks)]:
+			with table.locked(bucket):
+				now = time.time()
+				keys, accessed_at = table.keys[rows], table.accessed_at[rows]
+				expired = (keys != 0) & (accessed_at < now - self.ttl)
+				evicted = int(expired.sum())
+				keys[expired] = 0
+
+				found = np.flatnonzero(keys == key)
+				if len(found):
+					way = int(found[0])
+				elif create:
+					free = np.flatnonzero(keys == 0)
+					if len(free):
+						way = int(free[0])
+					else:
+						way = int(np.argmin(accessed_at))
+						evicted += 1
+					row = bucket * WAYS + way
+					table.keys[row] = key
+					table.weight[row] = 0
+					table.updated_at[row] = 0
+					table.seen_pos[row] = table.events_pos[row] = 0
+					table.seen[row] = table.events[row] = 0
+					table.vector_sum[row] = 0
+				else:
+					way = None
+				if evicted:
+					with self._lock:
+						self.evictions += evicted
+				if way is None:
+					yield None
+					return
+
+				row = bucket * WAYS + way
+				table.accessed_at[row] = now
+				yield SessionProfile(table, row, self.half_life)
+
+	def stats(self) -> dict:
+		now = time.time()
+		size = sum(
+			int(((table.keys != 0) & (table.accessed_at >= now - self.ttl)).sum()) for table in list(self._tables.values())
+		)
+		return {"size": size, "max_size": self.n_buckets * WAYS, "ttl": self.ttl, "evictions": self.evictions}
+
+	def close(self) -> None:
+		for table in self._tables.values():
+			table.close()
+		self._tables.clear()
@@ -0,0 +1,377 @@
+"""
+Versioned data snapshots served by the API.
+
+A snapshot is a directory SNAPSHOTS_DIR/<version> with products.csv, text_ruCLIP_embeddings.bin,
+text_ruCLIP_faiss.index and optionally the neighbor table and image embeddings with their index. SNAPSHOTS_DIR/CURRENT holds the version to serve.
+Without snapshots the files from DATA_DIR are served as version "default".
+
+The API loads a new snapshot in the background, warms it up and swaps it in, requests keep the snapshot
+they started with. The old snapshot is released when its last request finishes.
+
+Usage (from src/api), publish the files built in ../../data/embeddings as a new version:
+	python snapshot.py --version 2023-03-01 --activate
+"""
+import argparse
+import asyncio
+import copy
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import NamedTuple, Optional
+
+import numpy as np
+from starlette.concurrency import run_in_threadpool
+
+import config
+from catalog import read_products
+from catalog_index import CatalogIndex, CatalogVectors
+from embedding_store import EmbeddingStore, open_or_convert
+from filters import AttributeFilter, SearchFilter
+from index_backends import describe_index, load_index
+from lexical_index import LexicalIndex
+from neighbor_table import NeighborTable
+from product_store import ProductStore
+from query_cache import QueryCache
+from startup import NotReadyError
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILE = "CURRENT"
+DEFAULT_VERSION = "default"
+# имя версии - одна папка внутри SNAPSHOTS_DIR, без разделителей пути
+VERSION_PATTERN = re.compile(r"[\w.-]+")
+
+
+class SnapshotPaths(NamedTuple):
+	version: str
+	products: str
+	embeddings: str
+	embeddings_csv: Optional[str]
+	index: str
+	neighbors: str
+	image_embeddings: str
+	image_index: str
+
+
+def check_version(version: str) -> None:
+	"""
+	Raise ValueError unless the version names a snapshot directory right inside SNAPSHOTS_DIR.
+	"""
+	if (not VERSION_PATTERN.fullmatch(version) or ".." in version or version.startswith(".")
+			or version.endswith(".tmp") or version == CURRENT_FILE):
+		raise ValueError(f"wrong snapshot version: {version!r}")
+
+
+def snapshot_paths(version: str = None) -> SnapshotPaths:
+	"""
+	Get paths of the snapshot files, by default of the current snapshot.
+	"""
+	version = version or current_version()
+	if version is None or version == DEFAULT_VERSION:
+		return SnapshotPaths(
+			DEFAULT_VERSION, config.PRODUCTS_PATH, config.EMBEDDINGS_PATH, config.EMBEDDINGS_CSV_PATH,
+			config.INDEX_PATH, config.NEIGHBORS_PATH, config.IMAGE_EMBEDDINGS_PATH, config.IMAGE_INDEX_PATH
+		)
+
+	check_version(version)
+	path = os.path.join(config.SNAPSHOTS_DIR, version)
+	if not os.path.isdir(path):
+		raise FileNotFoundError(f"snapshot {path} not found")
+	return SnapshotPaths(
+		version,
+		os.path.join(path, os.path.basename(config.PRODUCTS_PATH)),
+		os.path.join(path, os.path.basename(config.EMBEDDINGS_PATH)),
+		None,
+		os.path.join(path, os.path.basename(config.INDEX_PATH)),
+		os.path.join(path, os.path.basename(config.NEIGHBORS_PATH)),
+		os.path.join(path, os.path.basename(config.IMAGE_EMBEDDINGS_PATH)),
+		os.path.join(path, os.path.basename(config.IMAGE_INDEX_PATH))
+	)
+
+
+def current_version() -> Optional[str]:
+	"""
+	Read the version from SNAPSHOTS_DIR/CURRENT, None if there are no snapshots.
+	"""
+	try:
+		with open(os.path.join(config.SNAPSHOTS_DIR, CURRENT_FILE)) as f:
+			return f.read().strip() or None
+	except FileNotFoundError:
+		return None
+
+
+def set_current_version(version: str) -> None:
+	check_version(version)
+	path = os.path.join(config.SNAPSHOTS_DIR, CURRENT_FILE)
+	with open(path + ".tmp", "w") as f:
+		f.write(version + "\n")
+	os.replace(path + ".tmp", path)
+
+
+class Snapshot:
+	"""
+	Products, embeddings and index of one version, with its own search cache.
+
+	products is the full dataframe used for filters and catalog updates, product_store serves display
+	fields to the front ends. lexical_index covers products of the snapshot files: products added or changed
+	through the admin API are found by vector search only until the next snapshot. image_index searches
+	normalized photo embeddings, its slots are its own, not the catalog ones.
+	"""
+
+	def __init__(self, version: str, products, text_embeddings: EmbeddingStore, index: CatalogIndex,
+				 neighbor_table: Optional[NeighborTable], image_index: Optional[CatalogIndex] = None):
+		self.version = version
+		self.products = products
+		self.product_store = ProductStore.from_frame(products)
+		self.text_embeddings = text_embeddings
+		self.catalog_vectors = index.vectors
+		self.ru_text_index = index
+		self.neighbor_table = neighbor_table
+		self.attribute_filter = AttributeFilter(products, index.vectors)
+		self.image_index = image_index
+		self.image_filter = AttributeFilter(products, image_index.vectors) if image_index is not None else None
+		self.lexical_index = None
+		if config.LEXICAL_INDEX:
+			start = time.perf_counter()
+			self.lexical_index = LexicalIndex.from_frame(products.reindex(index.vectors.skus[:index.vectors.n_base]))
+			logger.info("built lexical index of %s in %.1f s: %s", version, time.perf_counter() - start,
+						self.lexical_index.describe())
+		self.search_cache = QueryCache(config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL)
+		self.in_flight = 0
+		self.retired = False
+
+	@classmethod
+	def load(cls, paths: SnapshotPaths) -> "Snapshot":
+		start = time.perf_counter()
+		products = read_products(paths.products)
+		if paths.embeddings_csv is not None:
+			text_embeddings = open_or_convert(paths.embeddings, paths.embeddings_csv)
+		else:
+			text_embeddings = EmbeddingStore.open(paths.embeddings)
+		text_embeddings.check_skus(products.index.to_list())
+
+		index = CatalogIndex(
+			load_index(paths.index, config.INDEX_NPROBE, config.INDEX_EF_SEARCH, config.INDEX_MMAP, text_embeddings.matrix),
+			CatalogVectors(text_embeddings),
+			paths.index
+		)
+		neighbor_table = NeighborTable.open(paths.neighbors, text_embeddings)
+		image_index = None
+		if os.path.exists(paths.image_embeddings) and os.path.exists(paths.image_index):
+			image_embeddings = EmbeddingStore.open(paths.image_embeddings)
+			image_index = CatalogIndex(
+				load_index(paths.image_index, config.INDEX_NPROBE, config.INDEX_EF_SEARCH, config.INDEX_MMAP,
+						   image_embeddings.matrix),
+				CatalogVectors(image_embeddings),
+				paths.image_index
+			)
+		res = cls(paths.version, products, text_embeddings, index, neighbor_table, image_index)
+		logger.info(
+			"loaded snapshot %s in %.1f s: index %s, neighbor table %s, image index %s", paths.version,
+			time.perf_counter() - start, describe_index(index.index),
+			f"k={neighbor_table.k}" if neighbor_table else "not found",
+			describe_index(image_index.index) if image_index else "not found"
+		)
+		return res
+
+	def updated(self, index: CatalogIndex, products) -> "Snapshot":
+		"""
+		Copy of the snapshot with the catalog changed by the admin API, the data that did not change is shared.
+		The copy is swapped in like a new snapshot: requests in flight finish on this one, and the copy starts
+		with an empty search cache.
+		"""
+		res = copy.copy(self)
+		res.ru_text_index, res.catalog_vectors = index, index.vectors
+		res.products = products
+		res.product_store = ProductStore.from_frame(products)
+		res.attribute_filter = AttributeFilter(products, index.vectors)
+		if self.image_index is not None:
+			res.image_filter = AttributeFilter(products, self.image_index.vectors)
+		res.search_cache = QueryCache(config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL)
+		res.in_flight = 0
+		res.retired = False
+		return res
+
+	def warmup(self, n_queries: int = 64) -> None:
+		"""
+		Run searches with stored vectors, so the first requests do not pay for page faults of the mapped files.
+		"""
+		if not len(self.catalog_vectors):
+			return
+		start = time.perf_counter()
+		slots = np.random.default_rng(0).integers(0, self.catalog_vectors.n_base, n_queries)
+		query = self.catalog_vectors.vectors(slots)
+		self.ru_text_index.search(query, 11)
+		brand = self.products["brand"].iloc[0]
+		mask = self.attribute_filter.mask(SearchFilter.create(brand=[brand]))
+		self.attribute_filter.search(self.ru_text_index, query, 11, mask, config.FILTER_EXACT_LIMIT, config.FILTER_MAX_CANDIDATES)
+		if self.neighbor_table is not None:
+			np.asarray(self.neighbor_table.neighbors[slots])
+		if self.image_index is not None and self.image_index.vectors.n_base:
+			image_slots = np.random.default_rng(0).integers(0, self.image_index.vectors.n_base, n_queries)
+			self.image_index.search(self.image_index.vectors.vectors(image_slots), 11)
+		if self.lexical_index is not None:
+			self.lexical_index.search(str(brand), 11, max_postings=config.LEXICAL_MAX_POSTINGS)
+		logger.info("warmed up snapshot %s in %.2f s", self.version, time.perf_counter() - start)
+
+	def close(self) -> None:
+		"""
+		Drop references to the data, memory-mapped files are unmapped when the last request releases them.
+		"""
+		self.products = self.product_store = self.text_embeddings = self.catalog_vectors = self.ru_text_index = None
+		self.neighbor_table = self.attribute_filter = self.lexical_index = self.image_index = self.image_filter = None
+		self.search_cache.clear()
+		logger.info("released snapshot %s", self.version)
+
+
+class SnapshotManager:
+	"""
+	Current snapshot with reference counting of requests that use it. There is no current snapshot until
+	the first one is swapped in, requests get NotReadyError meanwhile.
+	"""
+
+	def __init__(self, snapshot: Snapshot = None):
+		self.current = snapshot
+		self.lock = threading.Lock()
+		self.reload_lock = asyncio.Lock()
+
+	@contextmanager
+	def use(self):
+		"""
+		Use the current snapshot until the end of the request, even if a new one is swapped in meanwhile.
+		"""
+		with self.lock:
+			snapshot = self.current
+			if snapshot is None:
+				raise NotReadyError("snapshot")
+			snapshot.in_flight += 1
+		try:
+			yield snapshot
+		finally:
+			self._release(snapshot)
+
+	@contextmanager
+	def hold(self, snapshot: Snapshot):
+		"""
+		Keep a snapshot the caller is using open, e.g. for a task that may outlive the request.
+		"""
+		with self.lock:
+			snapshot.in_flight += 1
+		try:
+			yield snapshot
+		finally:
+			self._release(snapshot)
+
+	def _release(self, snapshot: Snapshot) -> None:
+		with self.lock:
+			snapshot.in_flight -= 1
+			release = snapshot.retired and snapshot.in_flight == 0
+		if release:
+			snapshot.close()
+
+	def swap(self, snapshot: Snapshot) -> None:
+		with self.lock:
+			old, self.current = self.current, snapshot
+			if old is not None:
+				old.retired = True
+				release = old.in_flight == 0
+		if old is None:
+			logger.info("serving snapshot %s", snapshot.version)
+			return
+		logger.info("serving snapshot %s, previous %s has %d requests in flight", snapshot.version, old.version, old.in_flight)
+		if release:
+			old.close()
+
+	async def reload(self, version: str = None) -> Snapshot:
+		"""
+		Load and warm up the snapshot in a worker thread and swap it in, by default the current version.
+		"""
+		async with self.reload_lock:
+			paths = await run_in_threadpool(snapshot_paths, version)
+			snapshot = await run_in_threadpool(Snapshot.load, paths)
+			await run_in_threadpool(snapshot.warmup)
+			self.swap(snapshot)
+			return snapshot
+
+	async def watch(self, interval: float) -> None:
+		"""
+		Reload when SNAPSHOTS_DIR/CURRENT points to another version. Every worker process watches on its own.
+		"""
+		while True:
+			await asyncio.sleep(interval)
+			version = current_version()
+			# первый снимок загружается при старте, watcher подключается после этого
+			if version is None or self.current is None or version == self.current.version:
+				continue
+			try:
+				await self.reload(version)
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				logger.exception("failed to load snapshot %s, still serving %s", version, self.current.version)
+				# не пытаемся загрузить сломанный снимок снова до следующей смены CURRENT
+				while current_version() == version:
+					await asyncio.sleep(interval)
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+	try:
+		os.link(src, dst)
+	except OSError:
+		shutil.copy2(src, dst)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Publish data files as a new API snapshot")
+	parser.add_argument("--version", required=True, help="snapshot name, e.g. date of the catalog export")
+	parser.add_argument("--products", default=config.PRODUCTS_PATH, help="products.csv")
+	parser.add_argument("--embeddings", default=config.EMBEDDINGS_PATH, help="binary embeddings file")
+	parser.add_argument("--index", default=config.INDEX_PATH, help="faiss index")
+	parser.add_argument("--neighbors", default=config.NEIGHBORS_PATH, help="neighbor table, skipped if missing")
+	parser.add_argument("--image-embeddings", default=config.IMAGE_EMBEDDINGS_PATH, help="skipped if missing")
+	parser.add_argument("--image-index", default=config.IMAGE_INDEX_PATH, help="skipped if missing")
+	parser.add_argument("--activate", action="store_true", help="make it the current snapshot")
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+	try:
+		check_version(args.version)
+	except ValueError as err:
+		raise SystemExit(str(err))
+	if args.version == DEFAULT_VERSION:
+		raise SystemExit(f"wrong snapshot version: {args.version!r}")
+	path = os.path.join(config.SNAPSHOTS_DIR, args.version)
+	if os.path.exists(path):
+		raise SystemExit(f"{path} already exists")
+
+	# сначала собираем снимок во временной папке, чтобы API никогда не увидел его частично
+	tmp_path = path + ".tmp"
+	shutil.rmtree(tmp_path, ignore_errors=True)
+	os.makedirs(tmp_path)
+	files = [(args.products, config.PRODUCTS_PATH), (args.embeddings, config.EMBEDDINGS_PATH), (args.index, config.INDEX_PATH)]
+	if os.path.exists(args.neighbors):
+		files += [
+			(args.neighbors, config.NEIGHBORS_PATH),
+			(os.path.splitext(args.neighbors)[0] + ".json", os.path.splitext(config.NEIGHBORS_PATH)[0] + ".json")
+		]
+	if os.path.exists(args.image_embeddings) and os.path.exists(args.image_index):
+		files += [(args.image_embeddings, config.IMAGE_EMBEDDINGS_PATH), (args.image_index, config.IMAGE_INDEX_PATH)]
+	for src, name in files:
+		_link_or_copy(src, os.path.join(tmp_path, os.path.basename(name)))
+
+	store = EmbeddingStore.open(os.path.join(tmp_path, os.path.basename(config.EMBEDDINGS_PATH)))
+	store.check_skus(read_products(os.path.join(tmp_path, os.path.basename(config.PRODUCTS_PATH))).index.to_list())
+
+	os.replace(tmp_path, path)
+	logger.info("created snapshot %s", path)
+	if args.activate:
+		set_current_version(args.version)
+		logger.info("activated snapshot %s", args.version)
+
+
+if __name__ == "__main__":
+	main()
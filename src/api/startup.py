@@ -0,0 +1,73 @@
+"""
+Startup of the API in phases.
+
+uvicorn binds the port only after the startup handlers return, so the handlers only schedule loading:
+first the snapshot, then the text encoder, each followed by a warmup. Recommendations are served as soon
+as the snapshot is ready, text search answers 503 with Retry-After until the encoder is ready as well.
+Every phase is timed and logged, the timings are reported by /health/ready.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+class NotReadyError(RuntimeError):
+	"""
+	A component needed by the request is still loading.
+	"""
+
+	def __init__(self, component: str):
+		super().__init__(f"{component} is not ready yet")
+		self.component = component
+
+
+class StartupPhases:
+	"""
+	Durations and failures of startup phases, counted from the creation of the object.
+	"""
+
+	def __init__(self):
+		self.started = time.monotonic()
+		self.timings: Dict[str, float] = {}
+		self.failed: Dict[str, str] = {}
+		# необязательные фазы, которые не удались: сервис работает без них
+		self.unavailable: Dict[str, str] = {}
+		self.finished = None
+
+	@contextmanager
+	def phase(self, name: str, optional: bool = False):
+		"""
+		Time a phase. A failed phase is re-raised and fails the startup, unless it is optional: then the failure
+		is logged and reported as unavailable, and the startup goes on.
+		"""
+		start = time.perf_counter()
+		logger.info("startup phase %s started", name)
+		try:
+			yield
+		except Exception as err:
+			(self.unavailable if optional else self.failed)[name] = f"{type(err).__name__}: {err}"
+			logger.exception("startup phase %s failed after %.2f s", name, time.perf_counter() - start)
+			if not optional:
+				raise
+			return
+		self.timings[name] = round(time.perf_counter() - start, 3)
+		logger.info("startup phase %s done in %.2f s", name, self.timings[name])
+
+	def finish(self) -> None:
+		self.finished = round(time.monotonic() - self.started, 3)
+		logger.info(
+			"startup finished in %.2f s: %s", self.finished,
+			", ".join(f"{name} {seconds:.2f} s" for name, seconds in self.timings.items())
+		)
+
+	def describe(self) -> dict:
+		return {
+			"uptime": round(time.monotonic() - self.started, 3),
+			"startup_time": self.finished,
+			"phases": dict(self.timings),
+			"failed": dict(self.failed),
+			"unavailable": dict(self.unavailable)
+		}
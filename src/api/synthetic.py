@@ -0,0 +1,120 @@
+"""
+Synthetic data for benchmarks and load tests: catalog, embeddings and a text encoder without a model.
+
+Real embeddings form clusters of similar products, uniform random vectors would make approximate indexes
+look much worse than they are. Rows are drawn around random cluster centers instead, the stub encoder
+maps every text to a point near one of the same centers.
+"""
+import hashlib
+import time
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+# размерность текстовых эмбеддингов ruclip-vit-base-patch32-384
+EMBEDDING_DIM = 512
+CATEGORIES = (
+	"makijazh", "uhod", "volosy", "parfjumerija", "zdorov-e-i-apteka", "azija", "organika", "dlja-muzhchin",
+	"dlja-detej", "tehnika", "dlja-doma", "odezhda-i-aksessuary", "nizhnee-bel-jo", "ukrashenija", "lajfstajl",
+	"ini-formaty", "tovary-dlja-zhivotnyh"
+)
+CATEGORY_TYPES = ("крем", "шампунь", "помада", "тушь", "сыворотка", "маска", "гель для душа", "парфюмерная вода")
+COUNTRIES = ("франция", "корея", "италия", "сша", "германия", None)
+
+
+def default_clusters(n_rows: int) -> int:
+	return max(1, int(np.sqrt(n_rows)))
+
+
+def cluster_centers(n_clusters: int, dim: int = EMBEDDING_DIM, seed: int = 0) -> np.ndarray:
+	return np.random.default_rng(seed).standard_normal((n_clusters, dim), dtype="float32")
+
+
+def synthetic_embeddings(n_rows: int, dim: int = EMBEDDING_DIM, n_clusters: int = None, spread: float = 0.5,
+						 seed: int = 0, chunk_size: int = 65536) -> np.ndarray:
+	"""
+	Generate a clustered float32 embeddings matrix.
+
+	:param: n_rows: number of rows
+	:param: dim: embeddings dimension
+	:param: n_clusters: number of cluster centers, default_clusters(n_rows)
+	:param: spread: standard deviation of rows around their center, centers have 1
+	:param: seed: random seed, the same arguments give the same matrix
+	:param: chunk_size: rows generated at once, limits temporary memory
+	:return: float32 matrix n_rows x dim
+	"""
+	centers = cluster_centers(n_clusters or default_clusters(n_rows), dim, seed)
+	rng = np.random.default_rng(seed + 1)
+	res = np.empty((n_rows, dim), dtype="float32")
+	for start in range(0, n_rows, chunk_size):
+		end = min(start + chunk_size, n_rows)
+		rng.standard_normal((end - start, dim), dtype="float32", out=res[start:end])
+		res[start:end] *= spread
+		res[start:end] += centers[rng.integers(0, len(centers), end - start)]
+	return res
+
+
+def synthetic_catalog(n_rows: int, n_brands: int = 500, seed: int = 0) -> pd.DataFrame:
+	"""
+	Generate products with the columns of products.csv.
+
+	Brands follow a long-tailed distribution like the real catalog, every tenth product has
+	product_usage equal to its description.
+
+	:param: n_rows: number of products
+	:param: n_brands: number of distinct brands
+	:param: seed: random seed
+	:return: products dataframe indexed by sku
+	"""
+	rng = np.random.default_rng(seed)
+	numbers = pd.Series(np.arange(n_rows)).astype(str)
+	brand_weights = 1 / np.arange(1, n_brands + 1)
+	brands = "brand " + pd.Series(rng.choice(n_brands, n_rows, p=brand_weights / brand_weights.sum())).astype(str)
+	description = "описание товара " + numbers
+	product_usage = ("применение товара " + numbers).where(np.arange(n_rows) % 10 != 0, description)
+	return pd.DataFrame({
+		"sku": (10_000_000 + np.arange(n_rows)).astype(str),
+		"name": "товар " + numbers,
+		"category": np.array(CATEGORIES)[rng.integers(0, len(CATEGORIES), n_rows)],
+		"brand": brands,
+		"dimension17": brands,
+		"dimension18": "линия " + pd.Series(rng.integers(0, 5 * n_brands, n_rows)).astype(str),
+		"category_type": np.array(CATEGORY_TYPES)[rng.integers(0, len(CATEGORY_TYPES), n_rows)],
+		"country": np.array(COUNTRIES, dtype=object)[rng.integers(0, len(COUNTRIES), n_rows)],
+		"price": rng.integers(100, 20000, n_rows),
+		"description": description,
+		"product_usage": product_usage
+	}).set_index("sku")
+
+
+class StubTextEncoder:
+	"""
+	Deterministic text encoder without a model, used by load tests instead of ruCLIP (TEXT_ENCODER=stub).
+
+	Every text gets the same vector on every call and in every process: a point near one of the cluster
+	centers of synthetic_embeddings with the same n_clusters, dim and seed, so searches return ordinary
+	neighbors. The time of an encoder pass can be imitated with a delay per pass and per text.
+	"""
+
+	def __init__(self, dim: int = EMBEDDING_DIM, n_clusters: int = 1000, spread: float = 0.5, seed: int = 0,
+				 delay_ms: float = 0.0, per_text_ms: float = 0.0):
+		self.centers = cluster_centers(n_clusters, dim, seed)
+		self.spread = spread
+		self.delay = delay_ms / 1000
+		self.per_text = per_text_ms / 1000
+
+	def encode(self, texts: List[str], batch_size: int = 256) -> np.ndarray:
+		"""
+		Encode texts, batch_size is accepted for compatibility with ruCLIP encoders.
+		"""
+		res = np.empty((len(texts), self.centers.shape[1]), dtype="float32")
+		for num, text in enumerate(texts):
+			seed = int.from_bytes(hashlib.blake2b(text.lower().encode("utf-8"), digest_size=8).digest(), "little")
+			rng = np.random.default_rng(seed)
+			res[num] = self.centers[rng.integers(0, len(self.centers))]
+			res[num] += self.spread * rng.standard_normal(self.centers.shape[1], dtype="float32")
+		if self.delay or self.per_text:
+			time.sleep(self.delay + self.per_text * len(texts))
+		return res
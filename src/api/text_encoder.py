@@ -0,0 +1,108 @@
+"""
+ruCLIP text encoders used by the API.
+
+torch      eager PyTorch model loaded with ruclip.load, both towers
+onnx       text tower exported by export_text_encoder.py, run by onnxruntime on CPU
+onnx_int8  the same with dynamic int8 quantization of weights
+
+In onnx modes only the tokenizer files are read from the model directory, the vision tower is never loaded.
+"""
+import os
+from typing import List
+
+import numpy as np
+import ruclip
+import torch
+from ruclip.processor import RuCLIPProcessor
+
+import config
+from metrics import timed
+
+
+TEXT_ENCODERS = ("torch", "onnx", "onnx_int8")
+
+
+class TorchTextEncoder:
+	"""
+	Eager PyTorch ruCLIP text tower.
+	"""
+
+	def __init__(self, model_name: str, cache_dir: str, device: str = "cpu", threads: int = 0):
+		if threads:
+			torch.set_num_threads(threads)
+		self.model, self.processor = ruclip.load(model_name, device=device, cache_dir=cache_dir)
+		self.device = device
+
+	def encode(self, texts: List[str], batch_size: int = 256) -> np.ndarray:
+		"""
+		Encode texts.
+
+		:param: texts: texts to encode
+		:param: batch_size: texts per encoder pass, limits memory
+		:return: float32 matrix of embeddings, one row per text
+		"""
+		res = []
+		with torch.no_grad():
+			for start in range(0, len(texts), batch_size):
+				with timed("tokenize"):
+					input_ids = self.processor(text=texts[start:start + batch_size])["input_ids"]
+				with timed("encode"):
+					res.append(self.model.encode_text(input_ids.to(self.device)).cpu().numpy())
+
+		return np.ascontiguousarray(np.concatenate(res), dtype="float32")
+
+
+class OnnxTextEncoder:
+	"""
+	ruCLIP text tower exported to ONNX and run by onnxruntime.
+	"""
+
+	def __init__(self, onnx_path: str, model_dir: str, threads: int = 0):
+		try:
+			import onnxruntime
+		except ImportError as err:
+			raise RuntimeError("onnx text encoder requires onnxruntime, install it or set TEXT_ENCODER=torch") from err
+
+		if not os.path.exists(onnx_path):
+			raise RuntimeError(f"{onnx_path} not found, run export_text_encoder.py first")
+
+		self.processor = RuCLIPProcessor.from_pretrained(model_dir)
+		options = onnxruntime.SessionOptions()
+		options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+		options.intra_op_num_threads = threads
+		self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+
+	def encode(self, texts: List[str], batch_size: int = 256) -> np.ndarray:
+		"""
+		Encode texts.
+
+		:param: texts: texts to encode
+		:param: batch_size: texts per encoder pass, limits memory
+		:return: float32 matrix of embeddings, one row per text
+		"""
+		res = []
+		for start in range(0, len(texts), batch_size):
+			with timed("tokenize"):
+				input_ids = self.processor(text=texts[start:start + batch_size])["input_ids"].numpy()
+			with timed("encode"):
+				res.append(self.session.run(None, {"input_ids": input_ids})[0])
+
+		return np.ascontiguousarray(np.concatenate(res), dtype="float32")
+
+
+def load_text_encoder(kind: str = config.TEXT_ENCODER):
+	"""
+	Load text encoder of the given kind.
+
+	:param: kind: one of TEXT_ENCODERS
+	:return: encoder with encode(texts) method
+	"""
+	model_dir = os.path.join(config.MODEL_CACHE_DIR, config.MODEL_NAME)
+	if kind == "torch":
+		return TorchTextEncoder(config.MODEL_NAME, config.MODEL_CACHE_DIR, threads=config.WORKER_THREADS)
+	if kind == "onnx":
+		return OnnxTextEncoder(config.ONNX_TEXT_ENCODER_PATH, model_dir, config.WORKER_THREADS)
+	if kind == "onnx_int8":
+		return OnnxTextEncoder(config.ONNX_INT8_TEXT_ENCODER_PATH, model_dir, config.WORKER_THREADS)
+
+	raise ValueError(f"Wrong text encoder: {kind}. Should be one of: {', '.join(TEXT_ENCODERS)}")
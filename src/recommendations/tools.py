@@ -1,16 +1,14 @@
 from __future__ import annotations
 
-from os import listdir
-
-import numpy as np
-import pandas as pd
-import requests
 import streamlit as st
-from PIL import Image
+
+from api_client import ApiError, get_api_client
+from images import get_image_by_sku
+from tiles import show_tiles
 
 
-API_HOST = "api"
-API_PORT = 8080
+# категории, которые не показываются в демо
+EXCLUDED_CATEGORIES = ["sexual-wellness"]
 
 
 def show_theory_block():
@@ -152,7 +150,6 @@ Customer Experience и сделать навигацию по каталогу 
 
 
 def show_rec_example():
-	all_products = get_products_data()
 	user_select = st.selectbox(
 		label="Какую рекомендацию получить?",
 		options=[
@@ -165,9 +162,14 @@ def show_rec_example():
 	if user_select == "Для случайного продукта":
 		get_prediction_for_random_product = st.button("Получить рекомендации для случайного продукта")
 		if get_prediction_for_random_product:
-			random_product = get_random_product()
-			product_index = random_product.name
-			image = get_image_by_sku(product_index)
+			try:
+				random_product = get_random_product()
+				products = get_api_client().get_recommendation(random_product["sku"])
+			except ApiError:
+				st.error("Сервис рекомендаций временно недоступен, попробуйте позже")
+				return
+
+			image = get_image_by_sku(random_product["sku"])
 			st.image(image)
 			st.write(f"Название: {random_product['dimension17']} {random_product['name']}")
 			st.write(f"Цена: {random_product['price']} RUB")
@@ -175,113 +177,41 @@ def show_rec_example():
 
 			# блок рекомендаций по описанию
 			st.subheader("Список рекомендованного")
-			indexes = requests.post(
-				url=f"http://{API_HOST}:{API_PORT}/get_recommendation",
-				params={"product_index": product_index}
-			).json()["indexes"]
-
-			# создаем 4 колонки по 2 товара из рекомендаций
-			# в первую колонку попадают ближайшие эмбеддинги с нечетными индексами
-			# во вторую колонку попадают ближайшие эмбеддинги с четными индексами
-			for col, index_1 in zip(st.columns(4), range(1, 5)):
-				# первая колонка с рекомендацией
-				same = all_products.loc[indexes[index_1]]
-				image = get_image_by_sku(same.name)
-				col.image(
-					image,
-					caption=f"{same['dimension17'] if not isinstance(same['dimension17'], float) else ''} {same['name']} - {same['price']} RUB"
-				)
-				col.write(f"""
-					##### {same['dimension17'].title() if not isinstance(same['dimension17'], float) else ''} {same['name']}
-					{same['description'].capitalize()}
-					"""[:200] + "..."
-				)
-				col.markdown("---")
-				# вторая колонка с рекомендацией
-
-			for col, index_2 in zip(st.columns(4), range(5, 9)):
-				same = all_products.loc[indexes[index_2]]
-				image = get_image_by_sku(same.name)
-				col.image(
-					image,
-					caption=f"{same['dimension17'] if not isinstance(same['dimension17'], float) else ''} {same['name']} - {same['price']} RUB"
-				)
-				col.write(f"""
-					##### {same['dimension17'].title() if not isinstance(same['dimension17'], float) else ''} {same['name']}
-					{same['description'].capitalize()}
-					"""[:200] + "..."
-				)
+			show_tiles(products[:8])
 
 	if user_select == "Выбрать из категории":
-		# получаем список категорий с русским названием
-		categories: list = st.multiselect("Выберете категорию продукта", options=get_category_options())
-		# конвертируем список категорий в вид, в котором они содержатся в датафрейме
-		eng_categories = [get_category_data("ru_to_eng", cat) for cat in categories]
-		# если выбрана хотя бы одна категория
-		if len(categories) > 0:
-			# получаем все бренды из данной категории
-			brands = st.multiselect(
-				"Выберете бренд",
-				options=list(all_products[all_products["category"].isin(eng_categories)]["brand"].value_counts().index)
-			)
-			# если выбран хотя бы один бренд
-			if len(brands) > 0:
-				# создаем кнопку выбора нового продукта
-				change_product = st.button("Сменить продукт")
-				# отфильтровываем продукты по выбранным пользователем критериям
-				selected_products = all_products[
-					all_products["category"].isin(eng_categories) & all_products["brand"].isin(brands)]
-				# получаем рандомный продукт
-				double_index = all_products[all_products["description"] == all_products["product_usage"]].index
-				product = selected_products.loc[
-					np.random.choice(list(set(selected_products.index).difference(set(double_index))))]
-				# если юзер жмакнул кнопку сменить продукт
-				if change_product:
-					# выбираем новый продукт
-					product = selected_products.loc[np.random.choice(selected_products.index)]
-				image = get_image_by_sku(product.name)
-				st.image(image)
-				st.write(f"Название: {product['dimension17']} {product['name']}")
-				st.write(f"Цена: {product['price']} RUB")
-				st.write(f"Описание: {product['description']}")
-
-				# блок рекомендаций по описанию
-				st.subheader("Рекомендации по описанию продукта")
-				indexes = requests.post(
-					url=f"http://{API_HOST}:{API_PORT}/get_recommendation",
-					params={"product_index": product.name}).json()["indexes"]
-
-				# создаем 4 колонки по 2 товара из рекомендаций
-				# в первую колонку попадают ближайшие эмбеддинги с нечетными индексами
-				# во вторую колонку попадают ближайшие эмбеддинги с четными индексами
-				for col, index_1 in zip(st.columns(4), range(1, 5)):
-					# первая колонка с рекомендацией
-					same = all_products.loc[indexes[index_1]]
-					image = get_image_by_sku(same.name)
-					col.image(
-						image,
-						caption=f"{same['dimension17'] if not isinstance(same['dimension17'], float) else ''} {same['name']} - {same['price']} RUB"
-					)
-					col.write(f"""
-						##### {same['dimension17'].title() if not isinstance(same['dimension17'], float) else ''} {same['name']}
-						{same['description'].capitalize()}
-						"""[:200] + "..."
-							  )
-					col.markdown("---")
-				# вторая колонка с рекомендацией
-
-				for col, index_2 in zip(st.columns(4), range(5, 9)):
-					same = all_products.loc[indexes[index_2]]
-					image = get_image_by_sku(same.name)
-					col.image(
-						image,
-						caption=f"{same['dimension17'] if not isinstance(same['dimension17'], float) else ''} {same['name']} - {same['price']} RUB"
-					)
-					col.write(f"""
-						##### {same['dimension17'].title() if not isinstance(same['dimension17'], float) else ''} {same['name']}
-						{same['description'].capitalize()}
-						"""[:200] + "..."
-							  )
+		try:
+			# получаем список категорий с русским названием
+			categories: list = st.multiselect("Выберете категорию продукта", options=get_category_options())
+			# конвертируем список категорий в вид, в котором они содержатся в каталоге
+			eng_categories = [get_category_data("ru_to_eng", cat) for cat in categories]
+			# если выбрана хотя бы одна категория
+			if len(categories) > 0:
+				# получаем все бренды из данной категории
+				brands = st.multiselect(
+					"Выберете бренд",
+					options=get_api_client().get_facets(eng_categories, EXCLUDED_CATEGORIES)["brands"]
+				)
+				# если выбран хотя бы один бренд
+				if len(brands) > 0:
+					# создаем кнопку выбора нового продукта
+					change_product = st.button("Сменить продукт")
+					# получаем рандомный продукт по выбранным пользователем критериям,
+					# если юзер не жмакнул кнопку сменить продукт, пропускаем продукты без отдельного описания применения
+					product = get_random_product(eng_categories, brands, distinct_usage=not change_product)
+					products = get_api_client().get_recommendation(product["sku"])
+					image = get_image_by_sku(product["sku"])
+					st.image(image)
+					st.write(f"Название: {product['dimension17']} {product['name']}")
+					st.write(f"Цена: {product['price']} RUB")
+					st.write(f"Описание: {product['description']}")
+
+					# блок рекомендаций по описанию
+					st.subheader("Рекомендации по описанию продукта")
+					show_tiles(products[:8])
+		except ApiError:
+			st.error("Сервис рекомендаций временно недоступен, попробуйте позже")
+
 
 def show_quiz():
 	st.write(
@@ -470,62 +400,27 @@ def get_category_data(type: str, cat_name: str = None) -> int | list:
 		raise ValueError("type should be 'cat_names', 'id' or 'ru_name'")
 
 
-@st.experimental_memo
-def get_products_data() -> pd.DataFrame:
-	data = pd.read_csv("data/products.csv", index_col="sku")
-	return data.drop(data[data["category"] == "sexual-wellness"].index)
-
-
-@st.experimental_memo
-def get_image_data() -> pd.DataFrame:
-	image_data = pd.read_csv("data/product_images.csv", index_col="sku")
-	image_data = image_data.groupby(image_data.index)["image"].apply(list)
-	return image_data
-
-
-@st.experimental_memo
+@st.experimental_memo(ttl=600)
 def get_category_options() -> list:
 	"""
 	Returns category list in RU lang
 
 	:return: list of categories in RU lang
 	"""
-	data = get_products_data()
-	ru_cat_names = [get_category_data("ru_name", cat) for cat in data["category"].value_counts().index]
+	categories = get_api_client().get_facets(exclude_category=EXCLUDED_CATEGORIES)["categories"]
+	ru_cat_names = [get_category_data("ru_name", cat) for cat in categories]
 	return ru_cat_names
 
 
-def get_random_product() -> pd.Series:
+def get_random_product(category: list = None, brand: list = None, distinct_usage: bool = False) -> dict:
 	"""
 	Returns random product
 
+	:param: category: choose from these categories
+	:param: brand: choose from these brands
+	:param: distinct_usage: skip products whose usage text repeats the description
 	:return: random product data
 	"""
-	data = get_products_data()
-	res = data.loc[np.random.choice(data.index)]
-
-	return res
-
-
-def get_image_by_sku(sku: str or int) -> np.array:
-	"""
-	Get image by product sku.
-
-	:param: sku: product sku
-	:return: image product if existed, else image with 'No image' text
-	"""
-	image_data = get_image_data()
-	try:
-		for num, dir in enumerate(listdir("data/images")):
-			try:
-				image_name = image_data.loc[str(sku)][0]
-				with Image.open(f"data/images/{dir}/{image_name}") as img:
-					res = np.array(img)
-				return res
-			except:
-				if num == 2:
-					raise Exception
-	except Exception as err:
-		with Image.open("data/service_images/" + "no_img.jpg") as img:
-			res = np.array(img)
-		return res
\ No newline at end of file
+	return get_api_client().get_random_product(
+		category=category, brand=brand, exclude_category=EXCLUDED_CATEGORIES, distinct_usage=distinct_usage
+	)
@@ -1,13 +1,7 @@
-import numpy as np
-import pandas as pd
-import requests
 import streamlit as st
-from PIL import Image
-from os import listdir
 
-
-API_HOST = "api"
-API_PORT = 8080
+from api_client import ApiError, get_api_client
+from tiles import show_tiles
 
 
 def show_theory_block():
@@ -123,7 +117,6 @@ def show_theory_block():
 
 
 def show_rec_example():
-    all_products = get_products_data()
     random_product_description = get_random_product_description()
 
     if 'text' not in st.session_state:
@@ -143,42 +136,13 @@ def show_rec_example():
     if find:
         # блок рекомендаций по описанию
         st.subheader("Поисковая выдача")
-        indexes = requests.post(
-            url=f"http://{API_HOST}:{API_PORT}/get_search",
-            params={"user_text_input": st.session_state.text}
-        ).json()["indexes"]
-
-        # создаем 4 колонки по 2 товара из рекомендаций
-        # в первую колонку попадают ближайшие эмбеддинги с нечетными индексами
-        # во вторую колонку попадают ближайшие эмбеддинги с четными индексами
-        for col, index_1 in zip(st.columns(4), range(1, 5)):
-            # первая колонка с рекомендацией
-            same = all_products.loc[indexes[index_1]]
-            image = get_image_by_sku(same.name)
-            col.image(
-                image,
-                caption=f"{same['dimension17'] if not isinstance(same['dimension17'], float) else ''} {same['name']} - {same['price']} RUB"
-            )
-            col.write(f"""
-        		##### {same['dimension17'].title() if not isinstance(same['dimension17'], float) else ''} {same['name']}
-        		{same['description'].capitalize()}
-        		"""[:200] + "..."
-                      )
-            col.markdown("---")
-        # вторая колонка с рекомендацией
-
-        for col, index_2 in zip(st.columns(4), range(5, 9)):
-            same = all_products.loc[indexes[index_2]]
-            image = get_image_by_sku(same.name)
-            col.image(
-                image,
-                caption=f"{same['dimension17'] if not isinstance(same['dimension17'], float) else ''} {same['name']} - {same['price']} RUB"
-            )
-            col.write(f"""
-        		##### {same['dimension17'].title() if not isinstance(same['dimension17'], float) else ''} {same['name']}
-        		{same['description'].capitalize()}
-        		"""[:200] + "..."
-                      )
+        try:
+            products = get_api_client().get_search(st.session_state.text)
+        except ApiError:
+            st.error("Поиск временно недоступен, попробуйте позже")
+            return
+
+        show_tiles(products[:8])
 
 
 def show_quiz():
@@ -281,43 +245,10 @@ def show_quiz():
                 "Отлично! Вы хорошо усвоили теоретический блок."
             )
 
-@st.experimental_memo
-def get_products_data() -> pd.DataFrame:
-    data = pd.read_csv("data/products.csv", index_col="sku")
-    return data.drop(data[data["category"] == "sexual-wellness"].index)
-
-@st.experimental_memo
-def get_image_data() -> pd.DataFrame:
-    image_data = pd.read_csv("data/product_images.csv", index_col="sku")
-    image_data = image_data.groupby(image_data.index)["image"].apply(list)
-    return image_data
-
 def get_random_product_description() -> str:
-    data = get_products_data()
-    res = data.loc[np.random.choice(data.index)]
-    product_desc = f"{res['dimension17']} {res['name']} {res['dimension18']}"
-    return product_desc
-
-
-def get_image_by_sku(sku: str or int) -> np.array:
-    """
-    Get image by product sku.
-
-    :param: sku: product sku
-    :return: image product if existed, else image with 'No image' text
-    """
-    image_data = get_image_data()
     try:
-        for num, dir in enumerate(listdir("data/images")):
-            try:
-                image_name = image_data.loc[str(sku)][0]
-                with Image.open(f"data/images/{dir}/{image_name}") as img:
-                    res = np.array(img)
-                return res
-            except:
-                if num == 2:
-                    raise Exception
-    except Exception as err:
-        with Image.open("data/service_images/" + "no_img.jpg") as img:
-            res = np.array(img)
-        return res
+        res = get_api_client().get_random_product(exclude_category=["sexual-wellness"])
+    except ApiError:
+        return "крем для лица"
+    product_desc = f"{res['dimension17'] or ''} {res['name']} {res['dimension18'] or ''}"
+    return product_desc
@@ -0,0 +1,140 @@
+"""
+Client of the recommendation API for the Streamlit front ends.
+
+One keep-alive connection pool per process, timeouts on every call and bounded retries with exponential
+backoff for connection errors and 502/503/504. Recommendations are cached per sku and filters for the
+snapshot version that served them: the version reported by the latest response invalidates older entries.
+
+Search and recommendations are requested with display fields of the products (hydrate=true), so the front
+ends do not keep the catalog.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, NamedTuple, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+API_HOST = os.getenv("API_HOST", "api")
+API_PORT = int(os.getenv("API_PORT", "8080"))
+# таймауты соединения и ответа, секунд
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "2"))
+API_READ_TIMEOUT = float(os.getenv("API_READ_TIMEOUT", "10"))
+# повторы при ошибках соединения и 502/503/504, паузы backoff * 2^n секунд
+API_RETRIES = int(os.getenv("API_RETRIES", "3"))
+API_BACKOFF = float(os.getenv("API_BACKOFF", "0.2"))
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "16"))
+# кэш рекомендаций: число записей и время, через которое запись перепроверяется
+API_CACHE_SIZE = int(os.getenv("API_CACHE_SIZE", "4096"))
+API_CACHE_TTL = float(os.getenv("API_CACHE_TTL", "300"))
+
+
+class ApiError(Exception):
+	"""
+	API is unavailable or returned an error after all retries.
+	"""
+
+
+class CachedResponse(NamedTuple):
+	snapshot: Optional[str]
+	created: float
+	products: List[dict]
+
+
+class ApiClient:
+	def __init__(self, host: str = API_HOST, port: int = API_PORT, retries: int = API_RETRIES,
+				 backoff: float = API_BACKOFF, pool_size: int = API_POOL_SIZE, cache_size: int = API_CACHE_SIZE,
+				 cache_ttl: float = API_CACHE_TTL):
+		self.url = f"http://{host}:{port}"
+		self.timeout = (API_CONNECT_TIMEOUT, API_READ_TIMEOUT)
+		retry = Retry(
+			total=retries,
+			backoff_factor=backoff,
+			status_forcelist=(502, 503, 504),
+			# все методы API только читают данные, повтор POST безопасен
+			allowed_methods=None,
+			respect_retry_after_header=True,
+			raise_on_status=False
+		)
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+		self.session = requests.Session()
+		self.session.mount("http://", adapter)
+
+		self.cache = OrderedDict()
+		self.cache_size = cache_size
+		self.cache_ttl = cache_ttl
+		self.snapshot = None
+		self.lock = threading.Lock()
+
+	def request(self, method: str, path: str, params: dict = None, json: dict = None) -> dict:
+		try:
+			response = self.session.request(method, self.url + path, params=params, json=json, timeout=self.timeout)
+			response.raise_for_status()
+			res = response.json()
+		except (requests.RequestException, ValueError) as err:
+			raise ApiError(f"{path}: {err}") from err
+
+		if res.get("snapshot") is not None:
+			self.snapshot = res["snapshot"]
+		return res
+
+	def get_recommendation(self, sku, **filters) -> List[dict]:
+		"""
+		Get similar products through the cache.
+
+		:param: sku: product sku
+		:param: filters: category, brand, price_min, price_max
+		:return: similar products, dicts with columns of products.csv
+		"""
+		params = {
+			"product_index": str(sku), "hydrate": "true",
+			**{name: value for name, value in filters.items() if value is not None}
+		}
+		key = tuple(sorted((name, tuple(value) if isinstance(value, list) else value) for name, value in params.items()))
+		with self.lock:
+			cached = self.cache.get(key)
+			if cached is not None and cached.snapshot == self.snapshot \
+					and time.monotonic() - cached.created < self.cache_ttl:
+				self.cache.move_to_end(key)
+				return cached.products
+
+		res = self.request("POST", "/get_recommendation", params=params)
+		with self.lock:
+			self.cache[key] = CachedResponse(res.get("snapshot"), time.monotonic(), res["products"])
+			self.cache.move_to_end(key)
+			while len(self.cache) > self.cache_size:
+				self.cache.popitem(last=False)
+		return res["products"]
+
+	def get_search(self, user_text_input: str, **filters) -> List[dict]:
+		"""
+		Get products matching the text, results are cached by the API.
+		"""
+		params = {
+			"user_text_input": user_text_input, "hydrate": "true",
+			**{name: value for name, value in filters.items() if value is not None}
+		}
+		return self.request("POST", "/get_search", params=params)["products"]
+
+	def get_random_product(self, **conditions) -> dict:
+		"""
+		Get a random product, conditions are category, brand, exclude_category and distinct_usage.
+		"""
+		params = {name: value for name, value in conditions.items() if value is not None}
+		return self.request("GET", "/products/random", params=params)["product"]
+
+	def get_facets(self, category: List[str] = None, exclude_category: List[str] = None) -> dict:
+		"""
+		Get categories and brands of the given categories ordered by number of products.
+		"""
+		return self.request("GET", "/products/facets", params={"category": category, "exclude_category": exclude_category})
+
+
+@lru_cache(maxsize=1)
+def get_api_client() -> ApiClient:
+	return ApiClient()
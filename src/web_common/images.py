@@ -0,0 +1,150 @@
+"""
+Product images for the Streamlit front ends.
+
+Images are looked up through a sku -> file index built once from product_images.csv with one listdir per
+images_N directory. Tiles show display-size thumbnails from an on-disk cache, decoded thumbnails are kept
+in an in-memory LRU. Thumbnails missing in the cache are made on the first request.
+
+Prebuild the cache in parallel (from the repository root or the app root):
+	python src/web_common/images.py --workers 8
+"""
+import argparse
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Optional
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+
+IMAGES_DIR = os.getenv("IMAGES_DIR", "data/images")
+IMAGES_CSV = os.getenv("IMAGES_CSV", "data/product_images.csv")
+THUMBNAILS_DIR = os.getenv("THUMBNAILS_DIR", "data/thumbnails")
+NO_IMAGE_PATH = os.getenv("NO_IMAGE_PATH", "data/service_images/no_img.jpg")
+# наибольшая сторона картинки в плитке, пикселей
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "512"))
+# сколько декодированных картинок держим в памяти
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "512"))
+
+
+def build_image_index(images_dir: str = IMAGES_DIR, images_csv: str = IMAGES_CSV) -> Dict[str, str]:
+	"""
+	Map every sku to the absolute path of its first image found in images_dir/images_N.
+
+	:param: images_dir: directory with images_N subdirectories
+	:param: images_csv: csv with sku and image columns
+	:return: sku -> image path, skus without image files are skipped
+	"""
+	image_data = pd.read_csv(images_csv, dtype={"sku": str})
+	dir_by_name = {}
+	for name in sorted(os.listdir(images_dir)):
+		path = os.path.abspath(os.path.join(images_dir, name))
+		if os.path.isdir(path):
+			for image_name in os.listdir(path):
+				dir_by_name.setdefault(image_name, path)
+
+	res = {}
+	for sku, image_name in zip(image_data["sku"], image_data["image"]):
+		if sku not in res and image_name in dir_by_name:
+			res[sku] = os.path.join(dir_by_name[image_name], image_name)
+	return res
+
+
+@lru_cache(maxsize=1)
+def get_image_index() -> Dict[str, str]:
+	# кэш процесса, а не streamlit: индекс читается и из потоков пула плиток
+	return build_image_index()
+
+
+def thumbnail_path(sku: str, thumbnails_dir: str = THUMBNAILS_DIR) -> str:
+	return os.path.join(thumbnails_dir, quote(sku, safe="") + ".jpg")
+
+
+def make_thumbnail(image_path: str, path: str, size: int = THUMBNAIL_SIZE) -> None:
+	"""
+	Resize the image to fit size x size and save it as jpeg.
+	"""
+	with Image.open(image_path) as img:
+		img.draft("RGB", (size, size))
+		img = img.convert("RGB")
+		img.thumbnail((size, size))
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		# несколько сессий могут делать одну картинку одновременно
+		tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+		img.save(tmp_path, "JPEG", quality=85)
+	os.replace(tmp_path, path)
+
+
+def get_thumbnail_file(sku: str) -> Optional[str]:
+	"""
+	Get the cached thumbnail of the product, making it if needed. None if the product has no image.
+	"""
+	image_path = get_image_index().get(sku)
+	if image_path is None:
+		return None
+
+	path = thumbnail_path(sku)
+	if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(image_path):
+		try:
+			make_thumbnail(image_path, path)
+		except OSError:
+			return None
+	return path
+
+
+@lru_cache(maxsize=1)
+def get_placeholder() -> np.ndarray:
+	with Image.open(NO_IMAGE_PATH) as img:
+		img = img.convert("RGB")
+		img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+		return np.array(img)
+
+
+@lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def get_image_by_sku(sku) -> np.ndarray:
+	"""
+	Get image by product sku.
+
+	:param: sku: product sku
+	:return: image product if existed, else image with 'No image' text
+	"""
+	path = get_thumbnail_file(str(sku))
+	if path is None:
+		return get_placeholder()
+	with Image.open(path) as img:
+		res = np.array(img)
+	res.flags.writeable = False
+	return res
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Make thumbnails of all product images")
+	parser.add_argument("--workers", type=int, default=os.cpu_count(), help="threads, PIL releases the GIL")
+	parser.add_argument("--size", type=int, default=THUMBNAIL_SIZE, help="largest side of a thumbnail")
+	args = parser.parse_args()
+
+	index = build_image_index()
+
+	def process(item) -> bool:
+		sku, image_path = item
+		path = thumbnail_path(sku)
+		if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(image_path):
+			return False
+		try:
+			make_thumbnail(image_path, path, args.size)
+		except OSError as err:
+			print(f"{image_path}: {err}")
+			return False
+		return True
+
+	with ThreadPoolExecutor(max_workers=args.workers) as pool:
+		made = sum(pool.map(process, index.items()))
+	print(f"{len(index)} products with images, {made} thumbnails made in {THUMBNAILS_DIR}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,68 @@
+"""
+Result tiles shared by the Streamlit front ends.
+
+Products are records returned by the API with hydrate=true. Images of a whole result page are prepared
+concurrently in a bounded thread pool, then the tiles are drawn in the script thread, the only one allowed
+to call streamlit.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple
+
+import numpy as np
+import streamlit as st
+
+from images import get_image_by_sku
+
+
+# потоков на подготовку плиток, пул один на процесс и общий для всех сессий
+TILE_WORKERS = int(os.getenv("TILE_WORKERS", "8"))
+
+tile_pool = ThreadPoolExecutor(max_workers=TILE_WORKERS, thread_name_prefix="tiles")
+
+
+class Tile(NamedTuple):
+	image: np.ndarray
+	caption: str
+	text: str
+
+
+def make_tile(product: dict) -> Tile:
+	"""
+	Prepare the image and texts of one product tile.
+
+	:param: product: product record from the API
+	:return: tile
+	"""
+	brand = product["dimension17"] or ""
+	return Tile(
+		get_image_by_sku(product["sku"]),
+		f"{brand} {product['name']} - {product['price']} RUB",
+		f"""
+		##### {brand.title()} {product['name']}
+		{(product['description'] or '').capitalize()}
+		"""[:200] + "..."
+	)
+
+
+def fetch_tiles(products: List[dict]) -> List[Tile]:
+	"""
+	Prepare tiles of all products concurrently, in the order of products. Unknown products are skipped.
+	"""
+	return list(tile_pool.map(make_tile, [product for product in products if product is not None]))
+
+
+def show_tiles(products: List[dict], n_columns: int = 4) -> None:
+	"""
+	Draw product tiles in rows of n_columns columns.
+
+	:param: products: product records from the API
+	:param: n_columns: tiles per row
+	"""
+	tiles = fetch_tiles(products)
+	for start in range(0, len(tiles), n_columns):
+		for col, tile in zip(st.columns(n_columns), tiles[start:start + n_columns]):
+			col.image(tile.image, caption=tile.caption)
+			col.write(tile.text)
+			if start + n_columns < len(tiles):
+				col.markdown("---")
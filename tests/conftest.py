@@ -0,0 +1,5 @@
+import os
+import sys
+
+# модули API импортируются как в src/api, без установки пакета
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "api"))
@@ -0,0 +1,128 @@
+import faiss
+import numpy as np
+import pytest
+
+from catalog import sku_ids
+from catalog_index import MAX_STALE_CANDIDATES, CatalogIndex, CatalogVectors
+from embedding_store import EmbeddingStore
+from index_backends import MemoryMappedFlatIndex, build_index, set_search_params
+
+N_ROWS, DIM = 200, 16
+
+
+@pytest.fixture
+def store(tmp_path):
+	matrix = np.random.default_rng(0).random((N_ROWS, DIM)).astype("float32")
+	skus = [str(1000 + num) for num in range(N_ROWS - 1)] + ["0123"]
+	EmbeddingStore.write(str(tmp_path / "emb.bin"), skus, matrix)
+	return EmbeddingStore.open(str(tmp_path / "emb.bin"))
+
+
+def make_index(store, kind):
+	matrix = store.vectors(slice(None))
+	if kind == "mmap_flat":
+		return CatalogIndex(MemoryMappedFlatIndex(store.matrix), CatalogVectors(store))
+	if kind == "positional_flat":
+		return CatalogIndex(build_index(matrix, "flat"), CatalogVectors(store))
+	index = build_index(matrix, kind, ids=sku_ids(store.skus))
+	# глубокий поиск HNSW на маленьком каталоге точен, результаты сравниваются с точным перебором
+	set_search_params(index, ef_search=256)
+	return CatalogIndex(index, CatalogVectors(store))
+
+
+def exact_skus(catalog_index, query, k):
+	vectors = catalog_index.vectors
+	slots = np.flatnonzero(vectors.alive)
+	_, found = faiss.knn(query, vectors.vectors(slots), k)
+	return [[vectors.skus[slots[num]] for num in row] for row in found]
+
+
+def found_skus(catalog_index, query, k):
+	_, slots = catalog_index.search(query, k)
+	return [[catalog_index.vectors.skus[slot] for slot in row if slot >= 0] for row in slots]
+
+
+KINDS = ["mmap_flat", "positional_flat", "flat", "hnsw"]
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_search_returns_store_rows(store, kind):
+	index = make_index(store, kind)
+	query = store.vectors(np.arange(5))
+	assert found_skus(index, query, 10) == exact_skus(index, query, 10)
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_upsert_adds_and_replaces(store, kind):
+	index = make_index(store, kind)
+	new_vectors = np.random.default_rng(1).random((2, DIM)).astype("float32")
+	updated = index.upsert(["1005", "new"], new_vectors)
+
+	assert updated.vectors.slot("1005") >= N_ROWS and updated.vectors.slot("new") >= N_ROWS
+	assert found_skus(updated, new_vectors, 1) == [["1005"], ["new"]]
+	# старый вектор товара больше не находится
+	assert "1005" not in found_skus(updated, store.vectors(np.array([5])), 10)[0][1:]
+	query = store.vectors(np.arange(20))
+	assert found_skus(updated, query, 10) == exact_skus(updated, query, 10)
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_delete(store, kind):
+	index = make_index(store, kind)
+	updated, deleted = index.delete(["1003", "0123", "missing"])
+	assert deleted == ["1003", "0123"]
+	assert "1003" not in updated.vectors and "0123" not in updated.vectors and "123" not in updated.vectors
+	query = store.vectors(np.array([3, N_ROWS - 1, 7]))
+	found = found_skus(updated, query, 10)
+	assert all("1003" not in row and "0123" not in row for row in found)
+	assert found == exact_skus(updated, query, 10)
+	assert updated.describe()["products"] == N_ROWS - 2
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_updates_do_not_change_the_searched_index(store, kind):
+	index = make_index(store, kind)
+	query = store.vectors(np.arange(5))
+	before = found_skus(index, query, 10)
+	index.upsert(["1001"], np.zeros((1, DIM), dtype="float32"))
+	index.delete(["1000", "1002"])
+	assert found_skus(index, query, 10) == before
+	assert "1000" in index.vectors and index.vectors.slot("1001") == 1
+	assert index.describe() == {"stale": 0, "products": N_ROWS}
+
+
+def test_tombstones_are_filtered_and_reranked(store):
+	index = make_index(store, "hnsw")
+	query = store.vectors(np.array([10]))
+	# новый вектор далеко от старого: в индексе остается надгробие со старым id
+	updated = index.upsert(["1010"], np.full((1, DIM), 5.0, dtype="float32"))
+	updated, _ = updated.delete(["1011"])
+	assert updated.n_stale == 2
+
+	distances, slots = updated.search(query, 10)
+	skus = [updated.vectors.skus[slot] for slot in slots[0]]
+	assert "1010" not in skus and "1011" not in skus
+	assert len(set(slots[0])) == 10 and (slots[0] >= 0).all()
+	# расстояния пересчитаны по текущим векторам и отсортированы
+	expected = ((updated.vectors.vectors(slots[0]) - query) ** 2).sum(axis=1)
+	np.testing.assert_allclose(distances[0], expected, rtol=1e-4)
+	assert (np.diff(distances[0]) >= 0).all()
+	assert skus == exact_skus(updated, query, 10)[0]
+
+
+def test_stale_candidates_are_over_fetched(store):
+	index = make_index(store, "hnsw")
+	updated, _ = index.delete([str(1000 + num) for num in range(50)])
+	assert updated.n_stale == 50 < MAX_STALE_CANDIDATES
+	query = store.vectors(np.arange(3))
+	_, slots = updated.search(query, 20)
+	# без запаса кандидатов удаленные товары заняли бы места в выдаче
+	assert (slots >= 0).all()
+	assert found_skus(updated, query, 20) == exact_skus(updated, query, 20)
+
+
+def test_search_pads_with_missing(store):
+	index, _ = make_index(store, "flat").delete(store.skus[:-3])
+	distances, slots = index.search(store.vectors(np.array([0])), 5)
+	assert list(slots[0, 3:]) == [-1, -1] and np.isinf(distances[0, 3:]).all()
+	assert sorted(index.vectors.skus[slot] for slot in slots[0, :3]) == sorted(store.skus[-3:])
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from diversity import mmr_rerank
+
+
+@pytest.fixture
+def candidates():
+	rng = np.random.default_rng(0)
+	query = rng.random(16).astype("float32")
+	vectors = (query + 0.3 * rng.random((40, 16))).astype("float32")
+	return query, vectors
+
+
+def similarity_order(query, vectors):
+	normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+	return np.argsort(-(normalized @ (query / np.linalg.norm(query))), kind="stable")
+
+
+def test_lambda_one_keeps_similarity_order(candidates):
+	query, vectors = candidates
+	res = mmr_rerank(query, vectors, 10, lambda_=1.0)
+	np.testing.assert_array_equal(res, similarity_order(query, vectors)[:10])
+
+
+def test_first_pick_is_most_relevant(candidates):
+	query, vectors = candidates
+	assert mmr_rerank(query, vectors, 5, lambda_=0.3)[0] == similarity_order(query, vectors)[0]
+
+
+def test_near_duplicates_are_pushed_down():
+	query = np.array([1.0, 0.0, 0.0], dtype="float32")
+	vectors = np.array([[1.0, 0.1, 0.0], [1.0, 0.11, 0.0], [1.0, 0.0, 0.3]], dtype="float32")
+	assert list(mmr_rerank(query, vectors, 2, lambda_=1.0)) == [0, 1]
+	assert list(mmr_rerank(query, vectors, 2, lambda_=0.5)) == [0, 2]
+
+
+def test_caps_are_respected(candidates):
+	query, vectors = candidates
+	brands = np.arange(40) % 4
+	categories = np.arange(40) % 5
+	res = mmr_rerank(query, vectors, 12, 1.0, groups=[brands, categories], caps=[3, 3])
+	assert len(set(res)) == 12
+	assert np.bincount(brands[res]).max() <= 3
+	assert np.bincount(categories[res]).max() <= 3
+
+
+def test_uncapped_group_and_zero_cap(candidates):
+	query, vectors = candidates
+	brands = np.full(40, -1)
+	brands[:2] = 0
+	res = mmr_rerank(query, vectors, 10, 1.0, groups=[brands, np.zeros(40, dtype="int64")], caps=[1, 0])
+	assert np.isin([0, 1], res).sum() <= 1
+
+
+def test_caps_relaxed_when_too_few_groups(candidates):
+	query, vectors = candidates
+	brands = np.zeros(40, dtype="int64")
+	res = mmr_rerank(query, vectors, 5, 1.0, groups=[brands], caps=[2])
+	assert len(set(res)) == 5
+	np.testing.assert_array_equal(res[:2], similarity_order(query, vectors)[:2])
+
+
+def test_k_larger_than_candidates(candidates):
+	query, vectors = candidates
+	assert sorted(mmr_rerank(query, vectors[:3], 10)) == [0, 1, 2]
@@ -0,0 +1,114 @@
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from embedding_store import HEADER_SIZE, EmbeddingStore, StaleEmbeddingsError, convert_if_stale
+
+
+@pytest.fixture
+def matrix():
+	return np.random.default_rng(0).random((5, 8)).astype("float32")
+
+
+@pytest.fixture
+def skus():
+	return ["0123", "123", "a-1", "ёлка", "5"]
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_round_trip(tmp_path, matrix, skus, dtype):
+	path = str(tmp_path / "emb.bin")
+	EmbeddingStore.write(path, skus, matrix, dtype)
+	store = EmbeddingStore.open(path, verify=True)
+	assert store.skus == skus
+	assert store.matrix.dtype == np.dtype(dtype)
+	np.testing.assert_array_equal(store.vectors(slice(None)), matrix.astype(dtype).astype("float32"))
+	np.testing.assert_array_equal(store.vector("123")[0], matrix[1].astype(dtype).astype("float32"))
+	assert store.row("0123") == 0
+	assert "missing" not in store
+	store.check_skus(skus)
+	with pytest.raises(StaleEmbeddingsError):
+		store.check_skus(skus[::-1])
+
+
+def test_empty_store(tmp_path):
+	path = str(tmp_path / "emb.bin")
+	EmbeddingStore.write(path, [], np.empty((0, 8), dtype="float32"))
+	store = EmbeddingStore.open(path, verify=True)
+	assert len(store) == 0 and store.dim == 8
+
+
+def test_write_leaves_no_temporary_files(tmp_path, matrix, skus):
+	EmbeddingStore.write(str(tmp_path / "emb.bin"), skus, matrix)
+	EmbeddingStore.write(str(tmp_path / "emb.bin"), skus, matrix * 2)
+	assert os.listdir(tmp_path) == ["emb.bin"]
+
+
+def test_shape_mismatch(tmp_path, matrix, skus):
+	with pytest.raises(ValueError):
+		EmbeddingStore.write(str(tmp_path / "emb.bin"), skus[:-1], matrix)
+
+
+def corrupt(path, offset, data):
+	with open(path, "r+b") as f:
+		f.seek(offset)
+		f.write(data)
+
+
+def test_truncated_file(tmp_path, matrix, skus):
+	path = str(tmp_path / "emb.bin")
+	EmbeddingStore.write(path, skus, matrix)
+	os.truncate(path, HEADER_SIZE // 2)
+	with pytest.raises(StaleEmbeddingsError, match="truncated"):
+		EmbeddingStore.open(path)
+
+
+def test_wrong_magic_and_version(tmp_path, matrix, skus):
+	path = str(tmp_path / "emb.bin")
+	EmbeddingStore.write(path, skus, matrix)
+	corrupt(path, 8, struct.pack("<H", 99))
+	with pytest.raises(StaleEmbeddingsError, match="version"):
+		EmbeddingStore.open(path)
+	corrupt(path, 0, b"NOTEMB\x00\x00")
+	with pytest.raises(StaleEmbeddingsError, match="not an embeddings file"):
+		EmbeddingStore.open(path)
+
+
+def test_broken_sku_table(tmp_path, matrix, skus):
+	path = str(tmp_path / "emb.bin")
+	EmbeddingStore.write(path, skus, matrix)
+	corrupt(path, HEADER_SIZE, b"X")
+	with pytest.raises(StaleEmbeddingsError, match="sku table"):
+		EmbeddingStore.open(path)
+
+
+def test_broken_matrix_found_only_with_verify(tmp_path, matrix, skus):
+	path = str(tmp_path / "emb.bin")
+	EmbeddingStore.write(path, skus, matrix)
+	corrupt(path, os.path.getsize(path) - 4, b"\xff\xff\xff\xff")
+	EmbeddingStore.open(path)
+	with pytest.raises(StaleEmbeddingsError, match="matrix"):
+		EmbeddingStore.open(path, verify=True)
+
+
+def test_convert_if_stale(tmp_path, matrix, skus):
+	csv_path, path = str(tmp_path / "emb.csv"), str(tmp_path / "emb.bin")
+	pd.DataFrame(matrix, index=pd.Index(skus, name="sku")).to_csv(csv_path)
+	convert_if_stale(path, csv_path)
+	store = EmbeddingStore.open(path, verify=True)
+	assert store.skus == skus
+	np.testing.assert_allclose(store.matrix, matrix, rtol=1e-6)
+
+	# свежий файл не пересоздается
+	mtime = os.path.getmtime(path)
+	convert_if_stale(path, csv_path)
+	assert os.path.getmtime(path) == mtime
+
+	# csv новее - файл пересоздается
+	pd.DataFrame(matrix * 2, index=pd.Index(skus, name="sku")).to_csv(csv_path)
+	os.utime(csv_path, (mtime + 10, mtime + 10))
+	convert_if_stale(path, csv_path)
+	np.testing.assert_allclose(EmbeddingStore.open(path).matrix, matrix * 2, rtol=1e-6)
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from lexical_index import LexicalIndex, reciprocal_rank_fusion, stem, tokenize
+
+
+@pytest.fixture
+def index():
+	products = pd.DataFrame({
+		"brand": ["Estel", "Kapous", "Estel", "Librederm"],
+		"name": ["Крем для волос", "Шампунь для волос", "Маска для лица", "Крем для лица"],
+		"description": ["увлажняющий", None, "ночная маска", "с гиалуроновой кислотой"],
+	})
+	return LexicalIndex.from_frame(products)
+
+
+def test_stem_strips_russian_endings_only():
+	assert stem("крема") == stem("крем") == "крем"
+	assert stem("волосами") == stem("волос")
+	assert stem("estel") == "estel"
+	assert stem("для") == "для"
+
+
+def test_tokenize_normalizes_case_and_yo():
+	assert tokenize("Ёлочный КРЕМ, 50мл") == tokenize("елочный крем 50мл")
+
+
+def test_inflected_query_matches(index):
+	docs, scores = index.search("крема для волос", 10)
+	assert docs[0] == 0
+	assert set(docs) >= {0, 3}
+	assert (np.diff(scores) <= 0).all()
+
+
+def test_terms_match_any_field(index):
+	docs, _ = index.search("маска", 10)
+	assert list(docs) == [2]
+	docs, _ = index.search("estel", 10)
+	assert sorted(docs) == [0, 2]
+
+
+def test_mask_filters_documents(index):
+	mask = np.array([False, True, True, True])
+	docs, _ = index.search("крем", 10, mask=mask)
+	assert list(docs) == [3]
+	docs, _ = index.search("крем", 10, mask=np.zeros(4, dtype=bool))
+	assert len(docs) == 0
+
+
+def test_unknown_terms_and_k(index):
+	docs, scores = index.search("несуществующее", 10)
+	assert len(docs) == len(scores) == 0
+	docs, _ = index.search("для", 2)
+	assert len(docs) == 2
+
+
+def test_postings_budget_limits_read(index):
+	docs, _ = index.search("для", 10, max_postings=1)
+	assert len(docs) == 1
+
+
+def test_reciprocal_rank_fusion():
+	dense, lexical = np.array([1, 2, 3, -1]), np.array([3, 4])
+	assert reciprocal_rank_fusion([dense, lexical], 10) == [3, 1, 2, 4]
+	assert reciprocal_rank_fusion([dense, lexical], 2) == [3, 1]
+	assert reciprocal_rank_fusion([dense, lexical], 10, weights=[1.0, 0.0])[:3] == [1, 2, 3]
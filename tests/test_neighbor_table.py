@@ -0,0 +1,72 @@
+import json
+
+import faiss
+import numpy as np
+import pytest
+
+from embedding_store import EmbeddingStore
+from neighbor_table import NeighborTable, compute_neighbors
+
+
+@pytest.fixture
+def store(tmp_path):
+	matrix = np.random.default_rng(0).random((100, 8)).astype("float32")
+	EmbeddingStore.write(str(tmp_path / "emb.bin"), [str(num) for num in range(100)], matrix)
+	return EmbeddingStore.open(str(tmp_path / "emb.bin"))
+
+
+@pytest.mark.parametrize("block_size", [None, 7])
+def test_matches_exact_search(store, block_size):
+	matrix = store.vectors(slice(None))
+	neighbors = compute_neighbors(store.matrix, 10, block_size=block_size, workers=2)
+	_, exact = faiss.knn(matrix, matrix, 11)
+	assert neighbors.shape == (100, 10) and neighbors.dtype == np.int32
+	assert not (neighbors == np.arange(100)[:, None]).any()
+	# сам товар первый в точной выдаче, остальные совпадают по порядку
+	np.testing.assert_array_equal(neighbors, exact[:, 1:])
+
+
+@pytest.mark.parametrize("n_rows, k", [(0, 5), (1, 5), (2, 5), (3, 0)])
+def test_tiny_catalogs(n_rows, k):
+	matrix = np.random.default_rng(0).random((n_rows, 4)).astype("float32")
+	neighbors = compute_neighbors(matrix, k)
+	assert neighbors.shape == (n_rows, max(0, min(k, n_rows - 1)))
+	if n_rows == 2 and k:
+		assert list(neighbors[:, 0]) == [1, 0]
+
+
+def test_write_and_open(store, tmp_path):
+	path = str(tmp_path / "neighbors.npy")
+	neighbors = compute_neighbors(store.matrix, 5)
+	NeighborTable.write(path, neighbors, store)
+	assert sorted(p.name for p in tmp_path.iterdir()) == ["emb.bin", "neighbors.json", "neighbors.npy"]
+
+	table = NeighborTable.open(path, store)
+	assert table.k == 5
+	assert table.get("3", 5) == [str(row) for row in neighbors[3]]
+	assert table.get("3", 6) is None
+	assert table.get("missing", 1) is None
+
+
+def test_empty_table_of_one_product(tmp_path):
+	EmbeddingStore.write(str(tmp_path / "emb.bin"), ["1"], np.ones((1, 4), dtype="float32"))
+	store = EmbeddingStore.open(str(tmp_path / "emb.bin"))
+	path = str(tmp_path / "neighbors.npy")
+	NeighborTable.write(path, compute_neighbors(store.matrix, 50), store)
+	table = NeighborTable.open(path, store)
+	assert table.k == 0 and table.get("1", 1) is None
+
+
+def test_table_of_other_embeddings_is_ignored(store, tmp_path):
+	path = str(tmp_path / "neighbors.npy")
+	NeighborTable.write(path, compute_neighbors(store.matrix, 5), store)
+	EmbeddingStore.write(str(tmp_path / "other.bin"), [str(num) for num in range(100, 200)], np.asarray(store.matrix))
+	assert NeighborTable.open(path, EmbeddingStore.open(str(tmp_path / "other.bin"))) is None
+
+	# json от другого расчета, чем таблица
+	with open(tmp_path / "neighbors.json") as f:
+		meta = json.load(f)
+	with open(tmp_path / "neighbors.json", "w") as f:
+		json.dump({**meta, "k": 7}, f)
+	assert NeighborTable.open(path, store) is None
+	assert NeighborTable.open(str(tmp_path / "missing.npy"), store) is None
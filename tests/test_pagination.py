@@ -0,0 +1,54 @@
+import base64
+import json
+
+import pytest
+
+from pagination import CursorError, Page, StaleCursorError, decode_cursor, encode_cursor, next_cursor
+
+KEY = ("крем для волос", None, "dense")
+
+
+def test_cursor_round_trip():
+	assert decode_cursor(encode_cursor("v1", KEY, 30), "v1", KEY) == 30
+
+
+def test_cursor_of_another_query():
+	cursor = encode_cursor("v1", KEY, 10)
+	with pytest.raises(CursorError, match="another query") as err:
+		decode_cursor(cursor, "v1", ("шампунь", None, "dense"))
+	assert not isinstance(err.value, StaleCursorError)
+
+
+def test_stale_cursor():
+	cursor = encode_cursor("v1", KEY, 10)
+	with pytest.raises(StaleCursorError):
+		decode_cursor(cursor, "v2", KEY)
+
+
+def encode_raw(data) -> str:
+	return base64.urlsafe_b64encode(json.dumps(data).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+@pytest.mark.parametrize("cursor", [
+	"not base64!", "", "e30", encode_raw("text"), encode_raw(["v1", "fingerprint"]),
+	base64.urlsafe_b64encode(b"\xff\xfe").decode("ascii"),
+])
+def test_malformed_cursor(cursor):
+	with pytest.raises(CursorError):
+		decode_cursor(cursor, "v1", KEY)
+
+
+@pytest.mark.parametrize("offset", [-10, "10", 1.5, None])
+def test_cursor_with_wrong_offset(offset):
+	fingerprint = json.loads(base64.urlsafe_b64decode(encode_cursor("v1", KEY, 0) + "=="))[1]
+	with pytest.raises(CursorError):
+		decode_cursor(encode_raw(["v1", fingerprint, offset]), "v1", KEY)
+
+
+def test_next_cursor():
+	page = Page(10, 20)
+	assert page.end == 30
+	assert decode_cursor(next_cursor("v1", KEY, page, 31, 1000), "v1", KEY) == 30
+	# список кончается на этой странице или страница на максимальной глубине
+	assert next_cursor("v1", KEY, page, 30, 1000) is None
+	assert next_cursor("v1", KEY, page, 100, 30) is None
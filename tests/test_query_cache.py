@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from query_cache import CachedQuery, QueryCache
+
+
+def make_compute(calls, value, started=None, release=None):
+	async def compute():
+		calls.append(1)
+		if started is not None:
+			started.set()
+		if release is not None:
+			await release.wait()
+		if isinstance(value, Exception):
+			raise value
+		return value
+	return compute
+
+
+def test_concurrent_misses_compute_once():
+	async def run():
+		cache, calls, release = QueryCache(10, 60), [], asyncio.Event()
+		compute = make_compute(calls, CachedQuery(None, ["1"], limit=1), release=release)
+		callers = [asyncio.ensure_future(cache.get_or_compute("q", compute)) for _ in range(3)]
+		await asyncio.sleep(0)
+		release.set()
+		results = await asyncio.gather(*callers)
+		return cache, calls, results
+
+	cache, calls, results = asyncio.run(run())
+	assert len(calls) == 1
+	assert [res.skus for res in results] == [["1"]] * 3
+	assert cache.stats()["coalesced"] == 2
+	assert cache.get("q").skus == ["1"]
+
+
+def test_cancelled_first_caller_does_not_cancel_waiters():
+	async def run():
+		cache, calls, started, release = QueryCache(10, 60), [], asyncio.Event(), asyncio.Event()
+		compute = make_compute(calls, CachedQuery(None, ["1"], limit=1), started, release)
+		first = asyncio.ensure_future(cache.get_or_compute("q", compute))
+		await started.wait()
+		waiter = asyncio.ensure_future(cache.get_or_compute("q", compute))
+		await asyncio.sleep(0)
+		first.cancel()
+		await asyncio.sleep(0)
+		release.set()
+		with pytest.raises(asyncio.CancelledError):
+			await first
+		return cache, calls, await waiter
+
+	cache, calls, value = asyncio.run(run())
+	assert value.skus == ["1"]
+	assert len(calls) == 1
+	assert cache.get("q").skus == ["1"]
+	assert cache.stats()["in_flight"] == 0
+
+
+def test_error_reaches_waiters_and_is_not_cached():
+	async def run():
+		cache, calls, release = QueryCache(10, 60), [], asyncio.Event()
+		compute = make_compute(calls, RuntimeError("index failed"), release=release)
+		callers = [asyncio.ensure_future(cache.get_or_compute("q", compute)) for _ in range(2)]
+		await asyncio.sleep(0)
+		release.set()
+		return cache, await asyncio.gather(*callers, return_exceptions=True)
+
+	cache, results = asyncio.run(run())
+	assert all(isinstance(res, RuntimeError) for res in results)
+	assert cache.get("q") is None
+	assert cache.stats()["in_flight"] == 0
+
+
+def test_partial_value_is_returned_but_not_cached():
+	async def run():
+		cache = QueryCache(10, 60)
+		value = await cache.get_or_compute("q", make_compute([], CachedQuery(None, ["1"], partial=True)))
+		return cache, value
+
+	cache, value = asyncio.run(run())
+	assert value.skus == ["1"]
+	assert cache.get("q") is None
+
+
+def test_clear_drops_values_computed_before_it():
+	async def run():
+		cache, release = QueryCache(10, 60), asyncio.Event()
+		stale = asyncio.ensure_future(
+			cache.get_or_compute("q", make_compute([], CachedQuery(None, ["old"], limit=1), release=release))
+		)
+		await asyncio.sleep(0)
+		cache.clear()
+		assert cache.stats()["in_flight"] == 0
+		# новый запрос после очистки не ждет старое вычисление
+		fresh = await cache.get_or_compute("q", make_compute([], CachedQuery(None, ["new"], limit=1)))
+		release.set()
+		return cache, await stale, fresh
+
+	cache, stale, fresh = asyncio.run(run())
+	assert stale.skus == ["old"] and fresh.skus == ["new"]
+	assert cache.get("q").skus == ["new"]
+
+
+def test_put_of_older_generation_is_dropped():
+	cache = QueryCache(10, 60)
+	generation = cache.generation
+	cache.clear()
+	cache.put("q", CachedQuery(None, ["old"]), generation)
+	assert cache.get("q") is None
+	cache.put("q", CachedQuery(None, ["new"]), cache.generation)
+	assert cache.get("q").skus == ["new"]
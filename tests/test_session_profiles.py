@@ -0,0 +1,181 @@
+import multiprocessing
+import threading
+
+import numpy as np
+import pytest
+
+from session_profiles import LOCK_STRIPES, WAYS, SessionStore, decay_add, item_key
+
+HALF_LIFE = 600.0
+
+
+def exact_mean(vectors, weights, timestamps):
+	decayed = weights * 0.5 ** ((timestamps.max() - timestamps) / HALF_LIFE)
+	return (decayed[:, None] * vectors).sum(axis=0) / decayed.sum()
+
+
+@pytest.fixture
+def events():
+	rng = np.random.default_rng(0)
+	return (
+		rng.random((30, 16)).astype("float32"), rng.choice([1.0, 3.0], 30), np.sort(rng.random(30) * 3600)
+	)
+
+
+def running_mean(vectors, weights, timestamps, order):
+	vector_sum, weight, updated_at = np.zeros(vectors.shape[1], dtype="float32"), 0.0, None
+	for num in order:
+		weight, updated_at = decay_add(
+			vector_sum, weight, updated_at, vectors[num], weights[num], timestamps[num], HALF_LIFE
+		)
+	return vector_sum / weight
+
+
+def test_running_mean_matches_full_recomputation(events):
+	vectors, weights, timestamps = events
+	mean = running_mean(vectors, weights, timestamps, range(len(vectors)))
+	np.testing.assert_allclose(mean, exact_mean(vectors, weights, timestamps), rtol=1e-5)
+
+
+def test_running_mean_does_not_depend_on_event_order(events):
+	vectors, weights, timestamps = events
+	in_order = running_mean(vectors, weights, timestamps, range(len(vectors)))
+	for seed in range(5):
+		order = np.random.default_rng(seed).permutation(len(vectors))
+		np.testing.assert_allclose(running_mean(vectors, weights, timestamps, order), in_order, rtol=1e-5)
+
+
+def test_event_weight_halves_after_half_life():
+	vector_sum, weight, updated_at = np.zeros(2, dtype="float32"), 0.0, None
+	weight, updated_at = decay_add(vector_sum, weight, updated_at, np.array([1, 0], "float32"), 1.0, 0.0, HALF_LIFE)
+	weight, updated_at = decay_add(
+		vector_sum, weight, updated_at, np.array([0, 1], "float32"), 1.0, HALF_LIFE, HALF_LIFE
+	)
+	np.testing.assert_allclose(vector_sum / weight, [1 / 3, 2 / 3], rtol=1e-6)
+	assert updated_at == HALF_LIFE
+
+
+def make_store(directory, max_size=64, ttl=1800.0):
+	return SessionStore(str(directory), max_size, ttl, HALF_LIFE, max_seen=4, max_events=8)
+
+
+def test_repeated_events_are_skipped(tmp_path):
+	store = make_store(tmp_path)
+	vector = np.ones(4, dtype="float32")
+	with store.profile("s", 4, create=True) as profile:
+		assert profile.add("a", vector, 1.0, 100.0)
+		assert not profile.add("a", vector, 1.0, 100.0)
+		assert profile.add("a", vector, 1.0, 101.0)
+		assert profile.seen() == {item_key("a")}
+		weight = store.table(4).weight[profile.row]
+	assert weight == pytest.approx(1.0 + 0.5 ** (1 / HALF_LIFE))
+
+
+def test_seen_keeps_the_most_recent_products(tmp_path):
+	store = make_store(tmp_path)
+	with store.profile("s", 4, create=True) as profile:
+		for num in range(6):
+			profile.add(f"sku{num}", np.ones(4, dtype="float32"), 1.0, float(num))
+		assert profile.seen() == {item_key(f"sku{num}") for num in range(2, 6)}
+
+
+def test_unknown_session_is_not_created(tmp_path):
+	store = make_store(tmp_path)
+	with store.profile("s", 4, create=False) as profile:
+		assert profile is None
+	assert store.stats()["size"] == 0
+
+
+def test_least_recently_used_session_is_evicted(tmp_path):
+	store = make_store(tmp_path, max_size=WAYS)
+	for num in range(WAYS + 1):
+		with store.profile(f"s{num}", 4, create=True) as profile:
+			profile.add("a", np.ones(4, dtype="float32"), 1.0, 0.0)
+	with store.profile("s0", 4, create=False) as profile:
+		assert profile is None
+	with store.profile(f"s{WAYS}", 4, create=False) as profile:
+		assert profile is not None
+	assert store.stats() == {"size": WAYS, "max_size": WAYS, "ttl": 1800.0, "evictions": 1}
+
+
+def test_idle_session_expires(tmp_path):
+	store = make_store(tmp_path, ttl=-1.0)
+	with store.profile("s", 4, create=True) as profile:
+		profile.add("a", np.ones(4, dtype="float32"), 1.0, 0.0)
+	with store.profile("s", 4, create=False) as profile:
+		assert profile is None
+	assert store.stats()["evictions"] == 1
+
+
+def add_events(directory, worker, n_events):
+	store = make_store(directory)
+	for num in range(n_events):
+		with store.profile("shared", 4, create=True) as profile:
+			profile.add(f"sku{worker}_{num}", np.ones(4, dtype="float32"), 1.0, 0.0)
+	store.close()
+
+
+def test_workers_share_sessions(tmp_path):
+	n_workers, n_events = 4, 50
+	workers = [
+		multiprocessing.Process(target=add_events, args=(tmp_path, worker, n_events)) for worker in range(n_workers)
+	]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+		assert worker.exitcode == 0
+
+	store = make_store(tmp_path)
+	with store.profile("shared", 4, create=False) as profile:
+		assert store.table(4).weight[profile.row] == n_workers * n_events
+		np.testing.assert_allclose(profile.mean(), np.ones(4))
+
+
+def test_sessions_of_other_buckets_do_not_wait(tmp_path):
+	store = make_store(tmp_path)
+	first = "session-0"
+	other = next(
+		f"session-{num}" for num in range(1, 1000)
+		if item_key(f"session-{num}") % store.n_buckets % LOCK_STRIPES != item_key(first) % store.n_buckets % LOCK_STRIPES
+	)
+	entered, release = threading.Event(), threading.Event()
+
+	def hold_first():
+		with store.profile(first, 4, create=True):
+			entered.set()
+			release.wait(5)
+
+	thread = threading.Thread(target=hold_first)
+	thread.start()
+	try:
+		assert entered.wait(5)
+		done = []
+
+		def use_other():
+			with store.profile(other, 4, create=True) as profile:
+				done.append(profile is not None)
+
+		worker = threading.Thread(target=use_other)
+		worker.start()
+		worker.join(2)
+		assert done == [True]
+	finally:
+		release.set()
+		thread.join()
+
+
+def test_threads_do_not_lose_events(tmp_path):
+	store = make_store(tmp_path)
+	vector = np.ones(4, dtype="float32")
+
+	def add(num):
+		for event in range(50):
+			with store.profile("shared", 4, create=True) as profile:
+				profile.add(f"sku{num}", vector, 1.0, 1000.0 + num * 50 + event)
+
+	threads = [threading.Thread(target=add, args=(num,)) for num in range(4)]
+	[thread.start() for thread in threads]
+	[thread.join() for thread in threads]
+	with store.profile("shared", 4, create=False) as profile:
+		assert profile.table.events_pos[profile.row] == 200
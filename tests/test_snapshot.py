@@ -0,0 +1,44 @@
+import pytest
+
+from snapshot import SnapshotManager
+from startup import NotReadyError
+
+
+class FakeSnapshot:
+	def __init__(self, version):
+		self.version = version
+		self.in_flight = 0
+		self.retired = False
+		self.closed = False
+
+	def close(self):
+		self.closed = True
+
+
+def test_use_before_first_snapshot():
+	with pytest.raises(NotReadyError):
+		with SnapshotManager().use():
+			pass
+
+
+def test_retired_snapshot_is_closed_by_its_last_request():
+	old, new = FakeSnapshot("v1"), FakeSnapshot("v2")
+	snapshots = SnapshotManager(old)
+	with snapshots.use() as snapshot:
+		snapshots.swap(new)
+		assert snapshot is old and not old.closed
+		with snapshots.use() as current:
+			assert current is new
+	assert old.closed and not new.closed
+
+
+def test_hold_keeps_snapshot_open_after_the_request():
+	old, new = FakeSnapshot("v1"), FakeSnapshot("v2")
+	snapshots = SnapshotManager(old)
+	with snapshots.use() as snapshot:
+		held = snapshots.hold(snapshot)
+		held.__enter__()
+	snapshots.swap(new)
+	assert not old.closed
+	held.__exit__(None, None, None)
+	assert old.closed and old.in_flight == 0
@@ -0,0 +1,23 @@
+import pytest
+
+from startup import StartupPhases
+
+
+def test_failed_phase_fails_startup():
+	startup = StartupPhases()
+	with pytest.raises(RuntimeError):
+		with startup.phase("snapshot_load"):
+			raise RuntimeError("broken snapshot")
+	assert startup.failed == {"snapshot_load": "RuntimeError: broken snapshot"}
+
+
+def test_failed_optional_phase_is_only_reported():
+	startup = StartupPhases()
+	with startup.phase("image_encoder_load", optional=True):
+		raise ImportError("no ruclip")
+	with startup.phase("warmup"):
+		pass
+	startup.finish()
+	res = startup.describe()
+	assert res["failed"] == {} and res["unavailable"] == {"image_encoder_load": "ImportError: no ruclip"}
+	assert list(res["phases"]) == ["warmup"] and res["startup_time"] is not None